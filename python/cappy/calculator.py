@@ -1,4 +1,15 @@
 from abc import ABCMeta, abstractmethod
+import array
+import hashlib
+import operator
+
+
+from cappy.future import Future
+import cappy.compression as compression
+import cappy.interface as interface
+import cappy.memo as memo
+import cappy.offload as offload
+import cappy.vector as vector
 
 
 class Calculator(metaclass=ABCMeta):
@@ -7,28 +18,157 @@ class Calculator(metaclass=ABCMeta):
         self.outbound_requester = outbound_requester
 
     @abstractmethod
-    def add(self, x, y):
-        """Add two numbers."""
+    def add(self, x: int, y: int) -> int:
+        """Add two numbers.
+
+        Implementations echo the sum back through the client before
+        answering. The answer only depends on x and y, so they are marked
+        cacheable: a repeated call skips the echo.
+        """
+
+    @vector.vectorized('add')
+    def add_many(self, xs, ys):
+        """Add two columns of numbers; map calls to add call this.
+
+        One NumPy operation when NumPy is installed. Unlike add it doesn't
+        echo, so a map call is one round trip however many rows it has.
+        """
+        if vector.numpy is not None:
+            return vector.numpy.add(xs, ys)
+        if len(xs) != len(ys):
+            raise ValueError("Columns differ in length: {} and {}".format(
+                len(xs), len(ys)))
+        sums = list(map(operator.add, xs, ys))
+        if type(xs) is array.array and type(ys) is array.array and \
+                xs.typecode == ys.typecode:
+            try:
+                return array.array(xs.typecode, sums)  # Sent as raw memory
+            except OverflowError:
+                pass
+        return sums
 
     def echo(self, x):
         print("Serving echo({})".format(x))
         return x
 
+    def accumulator(self, initial):
+        """Get a new Accumulator, which is passed back by reference."""
+        return Accumulator(initial)
+
+    @offload.in_thread
+    def digest(self, data: bytes) -> str:
+        """Get the SHA-256 of data as hex.
+
+        hashlib releases the GIL while hashing, so this runs in a thread.
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return hashlib.sha256(data).hexdigest()
+
+    def zeros(self, size: int, chunk_size: int = 1 << 16):
+        """Stream size zero bytes, chunk_size at a time.
+
+        A generator, so the result is sent as a stream; see cappy.streams.
+        """
+        chunk = bytes(chunk_size)
+        while size > 0:
+            yield chunk if size >= chunk_size else chunk[:size]
+            size -= chunk_size
+
+    @staticmethod
+    @offload.in_process
+    def count_primes(limit: int) -> int:
+        """Count the primes below limit. CPU bound, so runs in a process."""
+        sieve = bytearray([1]) * max(limit, 2)
+        sieve[0] = sieve[1] = 0
+        for i in range(2, int(limit ** 0.5) + 1):
+            if sieve[i]:
+                sieve[i * i::i] = bytes(len(range(i * i, limit, i)))
+        return sum(sieve[:limit])
+
+
+_codecs = None
+
+
+def register_codecs():
+    """Register the codecs made from the Calculator interface.
+
+    These are an interface codec, compiled from the annotations above (see
+    cappy.interface), and a compression scheme whose dictionary is made from
+    the interface (see cappy.compression). Programs which offer them call
+    this during setup, so that importing this module doesn't compile an
+    interface or build a dictionary, and doesn't fill the registries. Calls
+    after the first are free.
+
+    Returns:
+        (str, str): The names of the codec and the compression scheme, to
+            offer in a connection's codecs.
+    """
+    global _codecs
+    if _codecs is None:
+        _codecs = (
+            interface.register(Calculator),
+            compression.register(compression.Deflate(
+                compression.build_dictionary(
+                    compression.interface_samples(Calculator)))))
+    return _codecs
+
+
+class Accumulator:
+    """A running total, to demonstrate passing capabilities."""
+
+    def __init__(self, total):
+        self.total = total
+
+    def add(self, x):
+        self.total += x
+        return self.total
+
 
 class CalculatorAsyncio(Calculator):
 
+    @memo.cacheable(maxsize=4096)
     async def add(self, x, y):
         print("Serving add({}, {})".format(x, y))
         z = x + y
         result = await self.outbound_requester({'method': 'echo', 'args': z})
         return result
 
+    async def count_bytes(self, chunks):
+        """Count the bytes in a stream of bytes chunks."""
+        total = 0
+        async for chunk in chunks:
+            total += len(chunk)
+        return total
+
 
 class CalculatorFutures(Calculator):
 
-    def add(self, x, y):
+    @memo.cacheable(maxsize=4096)
+    def add(self, x, y) -> Future:
         print("Serving add({}, {})".format(x, y))
         z = x+y
         f = self.outbound_requester({'method': 'echo', 'args': z})
         return f
 
+    def count_bytes(self, chunks) -> Future:
+        """Count the bytes in a stream of bytes chunks."""
+        result = Future()
+        total = [0]
+
+        def read_next():
+            chunks.read().add_callbacks(got, ended)
+
+        def got(chunk):
+            total[0] += len(chunk)
+            read_next()
+
+        def ended(exception):
+            if isinstance(exception, EOFError):
+                result.set_result(total[0])
+            else:
+                result.set_exception(exception)
+
+        read_next()
+        return result
+
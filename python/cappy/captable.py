@@ -0,0 +1,175 @@
+"""Capability export and import tables.
+
+When we pass an object by reference, we put it in our ExportTable and send
+its capability id instead. The peer puts a RemoteRef for that id in its
+ImportTable, and calls on the RemoteRef become requests targeting the id.
+
+Both tables are indexed by capability id, and ids are reused as soon as
+they are released, so ids stay small and dense. That lets both tables be
+plain lists: a lookup on the call path is a list index, and memory is
+bounded by the number of capabilities alive at once rather than the number
+ever exported.
+
+Reference counting follows Cap'n Proto: each time we send an export we
+bump its count, and the importer counts how many times it has received it.
+When the importer's RemoteRef is released (explicitly or by garbage
+collection) it sends that count back in a release message, and the export
+is dropped once its count reaches zero.
+"""
+import functools
+import weakref
+
+
+import cappy.vector as vector
+
+
+PLAIN_TYPES = frozenset(
+    [type(None), bool, int, float, str, bytes, bytearray, list, tuple, dict] +
+    list(vector.ARRAY_TYPES))
+"""Types which are sent by value. Anything else is sent by reference."""
+
+
+def is_plain(value):
+    return type(value) in PLAIN_TYPES
+
+
+class ExportTable:
+    """Local objects the peer holds references to.
+
+    Attributes:
+        objects (list): Capability id -> object, or None for a free slot.
+        refcounts (list of int): Capability id -> number of references the
+            peer holds.
+        free (list of int): Free capability ids, reused last in first out.
+    """
+
+    def __init__(self):
+        self.objects = []
+        self.refcounts = []
+        self.free = []
+        self._ids = {}  # id(object) -> capability id
+
+    def __len__(self):
+        return len(self.objects) - len(self.free)
+
+    def __getitem__(self, cap_id):
+        obj = self.objects[cap_id] if 0 <= cap_id < len(self.objects) else None
+        if obj is None:
+            raise KeyError("No export with id {}".format(cap_id))
+        return obj
+
+    def export(self, obj):
+        """Add a reference to obj and get its capability id."""
+        cap_id = self._ids.get(id(obj))
+        if cap_id is not None:
+            self.refcounts[cap_id] += 1
+            return cap_id
+        if self.free:
+            cap_id = self.free.pop()
+            self.objects[cap_id] = obj
+            self.refcounts[cap_id] = 1
+        else:
+            cap_id = len(self.objects)
+            self.objects.append(obj)
+            self.refcounts.append(1)
+        self._ids[id(obj)] = cap_id
+        return cap_id
+
+    def release(self, cap_id, count):
+        """Drop count references to cap_id, freeing it if none are left."""
+        self[cap_id]  # Raise KeyError for unknown ids.
+        refcount = self.refcounts[cap_id] - count
+        if refcount < 0:
+            raise ValueError(
+                "Released capability {} {} times but it has {} "
+                "references".format(cap_id, count, self.refcounts[cap_id]))
+        self.refcounts[cap_id] = refcount
+        if refcount == 0:
+            del self._ids[id(self.objects[cap_id])]
+            self.objects[cap_id] = None
+            self.free.append(cap_id)
+
+
+class ImportTable:
+    """References to the peer's objects.
+
+    We hold only weak references to RemoteRefs, so a RemoteRef nobody uses
+    any more gets collected, and queues a release for its references.
+
+    Attributes:
+        requester (function): Called with (message, promise) to make
+            requests, i.e. Protocol.make_outbound_request.
+        refs (list): Capability id -> weakref to RemoteRef, or None.
+        releases (dict): Capability id -> number of references waiting to be
+            released in the next release message.
+    """
+
+    def __init__(self, requester):
+        self.requester = requester
+        self.refs = []
+        self.releases = {}
+
+    def receive(self, cap_id):
+        """Account for one received reference and get its RemoteRef."""
+        refs = self.refs
+        if cap_id >= len(refs):
+            refs.extend([None] * (cap_id + 1 - len(refs)))
+        weak = refs[cap_id]
+        ref = weak() if weak is not None else None
+        if ref is None:
+            ref = RemoteRef(self, cap_id)
+            refs[cap_id] = weakref.ref(ref)
+        ref._count += 1
+        return ref
+
+    def _release(self, ref):
+        if ref._count:
+            cap_id = ref.cap_id
+            self.releases[cap_id] = self.releases.get(cap_id, 0) + ref._count
+            ref._count = 0
+
+    def take_releases(self):
+        """Get and clear the pending releases, as [[cap_id, count], ...]."""
+        if not self.releases:
+            return []
+        releases = [[cap_id, count] for cap_id, count in self.releases.items()]
+        self.releases = {}
+        return releases
+
+
+class RemoteRef:
+    """A reference to an object exported by the peer.
+
+    Calling a method on a RemoteRef makes a request targeting the object and
+    returns a future of the result, e.g. `ref.add(1, 2)`.
+    """
+
+    __slots__ = ('_table', 'cap_id', '_count', '__weakref__')
+
+    def __init__(self, table, cap_id):
+        self._table = table
+        self.cap_id = cap_id
+        self._count = 0
+
+    def __repr__(self):
+        return "<RemoteRef {}>".format(self.cap_id)
+
+    def call(self, method_name, *args, promise=False):
+        return self._table.requester(
+            {'method': method_name, 'args': list(args), 'target': self.cap_id},
+            promise)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return functools.partial(self.call, name)
+
+    def release(self):
+        """Release our references now rather than on garbage collection."""
+        self._table._release(self)
+
+    def __del__(self):
+        try:
+            self._table._release(self)
+        except Exception:  # E.g. during interpreter shutdown.
+            pass
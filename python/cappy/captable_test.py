@@ -0,0 +1,68 @@
+import gc
+
+
+import pytest
+
+
+import cappy.captable as captable
+
+
+class TestExportTable:
+
+    def test_export_and_lookup(self):
+        t = captable.ExportTable()
+        a, b = object(), object()
+        assert t.export(a) == 0
+        assert t.export(b) == 1
+        assert t[0] is a
+        assert t[1] is b
+        assert len(t) == 2
+
+    def test_same_object_shares_id(self):
+        t = captable.ExportTable()
+        a = object()
+        assert t.export(a) == t.export(a) == 0
+        assert t.refcounts[0] == 2
+        t.release(0, 1)
+        assert t[0] is a
+        t.release(0, 1)
+        with pytest.raises(KeyError):
+            t[0]
+
+    def test_ids_are_reused(self):
+        t = captable.ExportTable()
+        for _ in range(100000):
+            cap_id = t.export(object())
+            t.release(cap_id, 1)
+        assert len(t.objects) == 1
+        assert len(t) == 0
+
+    def test_over_release(self):
+        t = captable.ExportTable()
+        t.export(object())
+        with pytest.raises(ValueError):
+            t.release(0, 2)
+
+
+class TestImportTable:
+
+    def test_collected_ref_is_released(self):
+        requests = []
+        t = captable.ImportTable(lambda m, p: requests.append(m))
+        ref = t.receive(3)
+        assert t.receive(3) is ref
+        ref.add(1, 2)
+        assert requests == [{'method': 'add', 'args': [1, 2], 'target': 3}]
+        assert t.take_releases() == []
+        del ref
+        gc.collect()
+        assert t.take_releases() == [[3, 2]]
+        assert t.take_releases() == []
+
+    def test_explicit_release(self):
+        t = captable.ImportTable(None)
+        ref = t.receive(0)
+        ref.release()
+        assert t.take_releases() == [[0, 1]]
+        del ref
+        assert t.take_releases() == []
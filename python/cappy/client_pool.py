@@ -0,0 +1,208 @@
+"""A pool of client connections to one or more servers.
+
+A ClientPool keeps up to size connections to each server and spreads
+requests over them. Every connection multiplexes any number of concurrent
+requests by message id, so a few connections are enough to keep a
+multi-worker server busy:
+
+```
+async with client_pool.ClientPool(['tcp://localhost:12344'], size=4) as pool:
+    results = await asyncio.gather(
+        *(pool.call('add', i, 1) for i in range(1000)))
+```
+
+Each request goes to the open connection with the fewest requests in
+flight. Connections are made lazily: a slot with no connection is only
+connected when every open connection is busy, and a slot whose connection
+was lost is connected again the next time it is picked. A slot which fails
+to connect isn't tried again for retry_delay seconds.
+
+Requests in flight on a connection which is lost fail with
+ConnectionError; we don't retry them, as the server may have acted on
+them. Promised results and capabilities belong to the connection they came
+from, so a pipelined chain of requests must be made on one connection; get
+one with connection().
+"""
+import asyncio
+import time
+
+
+import cappy.client_server_asyncio as client_server_asyncio
+import cappy.endpoints as endpoints
+
+
+def _endpoint(address):
+    if isinstance(address, str):
+        endpoint = endpoints.parse(address)
+        if endpoint.scheme == 'socketpair':
+            raise ValueError("A pool can't connect to socketpair://")
+        return endpoint
+    host, port = address
+    return endpoints.Endpoint('tcp', host, port, None)
+
+
+def _url(endpoint):
+    if endpoint.scheme == 'tcp':
+        host = endpoint.host
+        if ':' in host:
+            host = '[{}]'.format(host)  # IPv6
+        return 'tcp://{}:{}'.format(host, endpoint.port)
+    return '{}://{}'.format(endpoint.scheme, endpoint.path)
+
+
+class _Slot:
+    """One of the pool's connections, made or not."""
+
+    __slots__ = ('address', 'connection', 'connecting', 'waiting',
+                 'retry_at', 'error')
+
+    def __init__(self, address):
+        self.address = address
+        self.connection = None
+        self.connecting = None  # Task making the connection
+        self.waiting = 0  # Callers waiting for that task
+        self.retry_at = 0.0  # Don't connect before this monotonic time
+        self.error = None  # Why the last attempt to connect failed
+
+
+class ClientPool:
+    """Spreads outbound requests over connections to some servers.
+
+    Attributes:
+        addresses (list of endpoints.Endpoint): The servers. We take them
+            as URLs (see cappy.endpoints) or (host, port) for TCP.
+        size (int): Most connections to keep to each server.
+        factory (client_server_asyncio.ConnectionFactory): Makes our
+            connections; its connections are the ones still open.
+        connect_timeout (float): Seconds to wait for a connection.
+        retry_delay (float): Seconds to wait before connecting a slot again
+            after failing to.
+    """
+
+    def __init__(self, addresses, size=1, factory=None, connect_timeout=10.0,
+                 retry_delay=1.0):
+        if not addresses:
+            raise ValueError("A pool needs at least one address")
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.addresses = [_endpoint(address) for address in addresses]
+        self.size = size
+        if factory is None:
+            factory = client_server_asyncio.ConnectionFactory(
+                client_server_asyncio.Protocol, asyncio.get_running_loop)
+        self.factory = factory
+        self.connect_timeout = connect_timeout
+        self.retry_delay = retry_delay
+        self._slots = [_Slot(address)
+                       for _ in range(size) for address in self.addresses]
+        self._closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _open(self, slot):
+        connection = slot.connection
+        return (connection is not None and
+                connection in self.factory.connections and
+                not connection.transport.is_closing())
+
+    def _pick(self):
+        # Least loaded slot, counting an open connection's requests in
+        # flight, or a connecting slot's waiting callers. Ties go to open
+        # connections, so we only connect more when those are busy.
+        best = None
+        best_load = None
+        now = time.monotonic()
+        for slot in self._slots:
+            if self._open(slot):
+                load = (len(slot.connection.protocol.pending_requests), 0)
+            elif slot.connecting is not None:
+                load = (slot.waiting, 1)
+            elif slot.retry_at <= now:
+                load = (0, 2)
+            else:
+                continue
+            if best is None or load < best_load:
+                best, best_load = slot, load
+                if load == (0, 0):
+                    break
+        return best
+
+    async def connection(self):
+        """Get the open connection with the fewest requests in flight.
+
+        We may connect, or reconnect, a slot first.
+
+        Raises:
+            ConnectionError: If every slot has recently failed to connect,
+                or the one we picked fails to.
+        """
+        if self._closed:
+            raise ConnectionError("Pool is closed")
+        slot = self._pick()
+        if slot is None:
+            errors = [s.error for s in self._slots if s.error is not None]
+            raise ConnectionError(
+                "No server to connect to; last error: {}".format(errors[-1]))
+        if self._open(slot):
+            return slot.connection
+        if slot.connecting is None:
+            slot.connecting = asyncio.ensure_future(self._connect(slot))
+        slot.waiting += 1
+        try:
+            # Shielded so that one caller giving up doesn't stop the
+            # connection for the others.
+            return await asyncio.shield(slot.connecting)
+        finally:
+            slot.waiting -= 1
+
+    async def _connect(self, slot):
+        try:
+            _, connection = await asyncio.wait_for(
+                endpoints.open_connection(self.factory, slot.address),
+                self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            slot.error = e
+            slot.retry_at = time.monotonic() + self.retry_delay
+            raise ConnectionError("Can't connect to {}: {}".format(
+                _url(slot.address), e)) from e
+        finally:
+            slot.connecting = None
+        slot.error = None
+        slot.connection = connection
+        if self._closed:
+            connection.transport.close()
+            raise ConnectionError("Pool is closed")
+        return connection
+
+    async def request(self, data, timeout=None):
+        """Make a request on the least loaded connection and get its result.
+
+        Args:
+            data (dict): The request, e.g. {'method': 'add', 'args': [1, 2]}.
+            timeout (float): Fail with demo_protocol.RequestTimeout if the
+                response takes longer than this many seconds.
+        """
+        connection = await self.connection()
+        return await connection.make_outbound_request(data, timeout=timeout)
+
+    async def call(self, method, *args, timeout=None):
+        """Call method with args; see request."""
+        return await self.request({'method': method, 'args': list(args)},
+                                  timeout)
+
+    def in_flight(self):
+        """Get the number of requests in flight on each open connection."""
+        return [len(s.connection.protocol.pending_requests)
+                for s in self._slots if self._open(s)]
+
+    async def close(self):
+        """Close every connection, failing requests still in flight."""
+        self._closed = True
+        for slot in self._slots:
+            if slot.connecting is not None:
+                slot.connecting.cancel()
+        await self.factory.drain(0)
@@ -0,0 +1,192 @@
+import asyncio
+import socket
+
+
+import pytest
+
+
+import cappy.client_pool as client_pool
+import cappy.client_server_asyncio as client_server_asyncio
+
+
+class Gated:
+    """wait(x) answers x once the test opens the gate."""
+
+    gate = None
+
+    def __init__(self, outbound_requester):
+        pass
+
+    async def wait(self, x):
+        await self.gate.wait()
+        return x
+
+    def add(self, x, y):
+        return x + y
+
+
+async def start_server():
+    factory = client_server_asyncio.ConnectionFactory(
+        client_server_asyncio.Protocol, asyncio.get_running_loop,
+        implementation_class=Gated)
+    server = await asyncio.get_running_loop().create_server(
+        factory, '127.0.0.1', 0)
+    return server, factory, server.sockets[0].getsockname()[:2]
+
+
+def unused_address():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()
+
+
+def run(test):
+    """Run test(pool, servers) against two servers, where servers is a list
+    of their ConnectionFactories."""
+
+    async def main():
+        Gated.gate = asyncio.Event()
+        started = [await start_server() for _ in range(2)]
+        try:
+            return await test(
+                [address for _, _, address in started],
+                [factory for _, factory, _ in started])
+        finally:
+            for server, factory, _ in started:
+                server.close()
+                await factory.drain(0)
+                await server.wait_closed()
+
+    return asyncio.run(main())
+
+
+def test_connects_lazily():
+
+    async def test(addresses, servers):
+        async with client_pool.ClientPool(addresses[:1], size=4) as pool:
+            for i in range(5):
+                assert await pool.call('add', i, 1) == i + 1
+            return len(servers[0].connections)
+
+    assert run(test) == 1
+
+
+def test_least_in_flight():
+
+    async def test(addresses, servers):
+        async with client_pool.ClientPool(addresses[:1], size=3) as pool:
+            calls = [asyncio.ensure_future(pool.call('wait', i))
+                     for i in range(7)]
+            await asyncio.sleep(0.05)
+            in_flight = sorted(pool.in_flight())
+            Gated.gate.set()
+            return in_flight, await asyncio.gather(*calls)
+
+    in_flight, results = run(test)
+    assert in_flight == [2, 2, 3]
+    assert results == list(range(7))
+
+
+def test_spreads_over_servers():
+
+    async def test(addresses, servers):
+        async with client_pool.ClientPool(addresses) as pool:
+            calls = [asyncio.ensure_future(pool.call('wait', i))
+                     for i in range(4)]
+            await asyncio.sleep(0.05)
+            Gated.gate.set()
+            await asyncio.gather(*calls)
+            return [len(factory.connections) for factory in servers]
+
+    assert run(test) == [1, 1]
+
+
+def test_reconnects():
+
+    async def test(addresses, servers):
+        async with client_pool.ClientPool(addresses[:1]) as pool:
+            assert await pool.call('add', 1, 2) == 3
+            call = asyncio.ensure_future(pool.call('wait', 0))
+            await asyncio.sleep(0.05)
+            await servers[0].drain(0)  # Drop the connection.
+            with pytest.raises(ConnectionError):
+                await call
+            return await pool.call('add', 3, 4)
+
+    assert run(test) == 7
+
+
+def test_connect_failure_waits_to_retry():
+
+    async def test(addresses, servers):
+        pool = client_pool.ClientPool([unused_address()], retry_delay=60)
+        for message in ("Can't connect", "No server"):
+            with pytest.raises(ConnectionError, match=message):
+                await pool.call('add', 1, 2)
+        await pool.close()
+
+    run(test)
+
+
+def test_skips_failed_server():
+
+    async def test(addresses, servers):
+        pool = client_pool.ClientPool([unused_address(), addresses[0]],
+                                      retry_delay=60)
+        with pytest.raises(ConnectionError):
+            await pool.call('add', 1, 2)
+        assert await pool.call('add', 1, 2) == 3
+        await pool.close()
+
+    run(test)
+
+
+def test_pipelined_chain_on_one_connection():
+
+    async def test(addresses, servers):
+        async with client_pool.ClientPool(addresses, size=2) as pool:
+            connection = await pool.connection()
+            f = connection.make_outbound_request(
+                {'method': 'add', 'args': [1, 2]}, promise=True)
+            return await connection.make_outbound_request(
+                {'method': 'add', 'args': [f, 3]})
+
+    assert run(test) == 6
+
+
+def test_closed():
+
+    async def test(addresses, servers):
+        pool = client_pool.ClientPool(addresses)
+        await pool.close()
+        with pytest.raises(ConnectionError, match="closed"):
+            await pool.call('add', 1, 2)
+
+    run(test)
+
+
+def test_needs_addresses():
+    with pytest.raises(ValueError):
+        client_pool.ClientPool([])
+
+
+def test_accepts_urls(tmp_path):
+
+    async def test(addresses, servers):
+        host, port = addresses[0]
+        path = str(tmp_path / 'cappy.sock')
+        server = await asyncio.get_running_loop().create_unix_server(
+            servers[1], path)
+        urls = ['tcp://{}:{}'.format(host, port), 'unix://' + path]
+        try:
+            async with client_pool.ClientPool(urls) as pool:
+                calls = [asyncio.ensure_future(pool.call('wait', i))
+                         for i in range(4)]
+                await asyncio.sleep(0.05)
+                Gated.gate.set()
+                await asyncio.gather(*calls)
+                return [len(factory.connections) for factory in servers]
+        finally:
+            server.close()
+
+    assert run(test) == [1, 1]
@@ -1,31 +1,235 @@
 import argparse
 import asyncio
+import collections.abc
+import functools
+import inspect
+import logging
+import signal
+import time
 
-from cappy.calculator import CalculatorAsyncio as Calculator
+from cappy.calculator import CalculatorAsyncio as Calculator, register_codecs
 import cappy.demo_protocol as cprotocol
+import cappy.dispatch as dispatch
+import cappy.endpoints as endpoints
+from cappy.metrics import Metrics
+import cappy.offload as offload
+import cappy.stream as stream
+import cappy.streams as streams
+from cappy.workers import get_listen_socket, run_workers
+
+
+logger = logging.getLogger(__name__)
+
+
+class IncomingStream(streams.IncomingStream):
+    """A stream from the peer, which can be read with async for."""
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.read()
+        except EOFError:
+            raise StopAsyncIteration
 
 
 class Protocol(cprotocol.Protocol):
+    """Protocol for asyncio.
+
+    Besides iterators, async iterators (e.g. async generators) can be sent
+    as streams; a task pumps each one, waiting whenever it runs out of
+    credit.
+    """
+
+    future_class = asyncio.Future
+    incoming_stream_class = IncomingStream
+
+    def future_result(self, future):
+        try:
+            return future.result()
+        except asyncio.InvalidStateError:
+            raise ValueError("Future is not done")
+
+    def chain_future(self, source, target):
+        def settle(source):
+            if target.done():
+                return
+            if source.cancelled():
+                target.cancel()
+            elif source.exception() is not None:
+                _fail(target, source.exception())
+            else:
+                target.set_result(source.result())
+        source.add_done_callback(settle)
+
+    def wrap_concurrent_future(self, cf):
+        return asyncio.wrap_future(cf)
+
+    def call_later(self, delay, function, *args):
+        return asyncio.get_running_loop().call_later(delay, function, *args)
+
+    def pump_stream(self, stream_id, out):
+        if out.task is None:
+            if not isinstance(out.iterator, collections.abc.AsyncIterator):
+                super().pump_stream(stream_id, out)
+                return
+            out.task = asyncio.ensure_future(
+                self._pump_async(stream_id, out))
+        elif out.wakeup is not None and not out.wakeup.done():
+            out.wakeup.set_result(None)
+
+    async def _pump_async(self, stream_id, out):
+        iterator = out.iterator
+        try:
+            while 1:
+                while out.credit <= 0:
+                    out.wakeup = asyncio.get_running_loop().create_future()
+                    await out.wakeup
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                out.credit -= 1
+                self.send_control('chunk', stream=stream_id, data=item)
+        except asyncio.CancelledError:
+            aclose = getattr(iterator, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+            raise
+        except Exception as e:
+            self._end_stream(stream_id, e)
+            return
+        self._end_stream(stream_id)
 
-    async def handle_inbound_request(self, message):
-        message_id = message['id']
-        method_name = message['method']
-        args = message['args']
-        if not isinstance(args, (tuple, list)):
-            args = (args,)
-        method = getattr(self.implementation, method_name)
-        result = await asyncio.coroutine(method)(*args)
-        response = {'id': -message_id, 'result': result}
-        self.write(self.stream.pack_message(response))
+    def close_stream(self, out):
+        if out.task is not None:
+            out.task.cancel()
+        else:
+            super().close_stream(out)
 
+    def _cancelled(self, message_id, task):
+        if task.cancelled():
+            self.send_error(message_id, cprotocol.CancelledError(
+                "Cancelled by peer"))
 
-class Connection(asyncio.Protocol):
-    """Request/response messaging protocol"""
+    def handle_inbound_request(self, message, call, promised=()):
+        entry, obj = call
+        loop = asyncio.get_running_loop()
+        if entry.kind is dispatch.SYNC and not promised:
+            # Nothing to wait for, so skip creating a task.
+            try:
+                if entry.policy is offload.INLINE or self.executors is None:
+                    result = entry.function(obj, *message['args'])
+                else:
+                    result = self.offload(entry, obj, message['args'])
+            except Exception as e:
+                self.send_error(message['id'], e)
+                if not message.get('promise'):
+                    return None
+                answer = loop.create_future()
+                _fail(answer, e)
+                return answer
+            if not inspect.isawaitable(result):
+                self.send_response(message['id'], result)
+                if not message.get('promise'):
+                    return None
+                answer = loop.create_future()
+                answer.set_result(result)
+                return answer
+            answer = loop.create_future()
+            work = self._finish(message['id'], result, answer)
+        else:
+            answer = loop.create_future()
+            work = self._serve(message, entry, obj, promised, answer)
+        # The task never raises: it responds, and passes its outcome to
+        # the answer. Cancelling the answer (see cancel_work) cancels the
+        # task; a task cancelled before it starts never runs the code which
+        # would respond, so we respond from here instead.
+        task = asyncio.ensure_future(work)
+        answer.add_done_callback(
+            functools.partial(self._answer_done, message['id'], task))
+        return answer
 
-    def __init__(self, loop, protocol_class):
+    def _answer_done(self, message_id, task, answer):
+        if answer.cancelled() and task.cancel():
+            task.add_done_callback(
+                functools.partial(self._cancelled, message_id))
+
+    async def _serve(self, message, entry, obj, promised, answer):
+        try:
+            args = message['args']
+            for index, future in promised:
+                args[index] = await future
+            if entry.policy is offload.INLINE or self.executors is None:
+                result = entry.function(obj, *args)
+            else:
+                result = self.offload(entry, obj, args)
+        except Exception as e:
+            self.send_error(message['id'], e)
+            _fail(answer, e)
+            return
+        if entry.kind is dispatch.SYNC and not inspect.isawaitable(result):
+            self.send_response(message['id'], result)
+            if not answer.done():
+                answer.set_result(result)
+            return
+        await self._finish(message['id'], result, answer)
+
+    async def _finish(self, message_id, awaitable, answer):
+        try:
+            result = await awaitable
+        except Exception as e:
+            self.send_error(message_id, e)
+            _fail(answer, e)
+            return
+        self.send_response(message_id, result)
+        if not answer.done():
+            answer.set_result(result)
+
+
+def _fail(answer, exception):
+    if not answer.done():
+        answer.set_exception(exception)
+        # The error has gone to the peer. Nobody here need look at it
+        # unless a later request was promised the answer, so don't have
+        # asyncio complain if nobody does.
+        answer.exception()
+
+
+class Connection(asyncio.BufferedProtocol):
+    """Request/response messaging protocol
+
+    The transport reads straight into the protocol's framing buffer (see
+    get_buffer), and frames are parsed where they landed. We write each
+    flush's frames with transport.writelines, so large payloads aren't
+    copied in behind their headers first; transports which can gather
+    writes send them with one sendmsg.
+
+    Flow control: the transport calls pause_writing when its write buffer
+    goes above the FlowControl write_high mark and resume_writing when it
+    falls to write_low. We pause reading in between, and while the protocol
+    doesn't want input; see demo_protocol.Protocol.
+
+    Attributes:
+        recv_size (int): Least writable space we offer each read, in bytes.
+    """
+
+    def __init__(self, loop, protocol_class, codecs=cprotocol.DEFAULT_CODECS,
+                 implementation_class=Calculator, connection_closed=None,
+                 executors=None, metrics=None, flow=None, recv_size=65536):
         self.loop = loop
         self.protocol_class = protocol_class
+        self.codecs = codecs
+        self.implementation_class = implementation_class
+        self.connection_closed = connection_closed
+        self.executors = executors
+        self.metrics = metrics
+        self.flow = flow
         self.protocol = None
+        self.transport = None
+        self._reading = True
+        self.recv_size = recv_size
 
     def connection_made(self, transport):
         print("Connection made")
@@ -33,9 +237,56 @@ class Connection(asyncio.Protocol):
         self.protocol = self.protocol_class(
                 transport.write,
                 asyncio.Future,
-                Calculator)
+                self.implementation_class,
+                self.codecs,
+                self.executors,
+                self.metrics,
+                self.flow)
+        self.protocol.write_buffer_size = transport.get_write_buffer_size
+        self.protocol.writelines = transport.writelines
+        self.protocol.input_changed = self._update_reading
+        flow = self.protocol.flow
+        transport.set_write_buffer_limits(flow.write_high, flow.write_low)
+        if flow.flush_bytes is not None:
+            self.protocol.schedule_flush = self.loop.call_soon
+
+    def pause_writing(self):
+        self.protocol.set_write_paused(True)
+        self._update_reading()
+
+    def resume_writing(self):
+        self.protocol.set_write_paused(False)
+        self._update_reading()
+
+    def _update_reading(self):
+        reading = (not self.protocol.write_paused and
+                   self.protocol.wants_input())
+        if reading != self._reading and not self.transport.is_closing():
+            self._reading = reading
+            if reading:
+                self.transport.resume_reading()
+            else:
+                self.transport.pause_reading()
 
-    def make_outbound_request(self, data):
+    def drain(self):
+        """Get a future which fires when there is room for more requests;
+        see demo_protocol.Protocol.drain."""
+        return self.protocol.drain()
+
+    def connection_lost(self, exc):
+        if self.protocol is not None:
+            self.protocol.connection_lost()
+        if self.connection_closed is not None:
+            self.connection_closed(self)
+
+    def idle(self):
+        """Whether we have no requests to answer and nothing left to send."""
+        return (self.protocol is None or
+                (not self.protocol.inbound_in_flight and
+                 not self.protocol.unflushed_bytes and
+                 not self.transport.get_write_buffer_size()))
+
+    def make_outbound_request(self, data, promise=False, timeout=None):
         """Make an outbound request.
 
         This function should be awaited, as it may make outgoing requests, which
@@ -44,29 +295,95 @@ class Connection(asyncio.Protocol):
         Returns:
             We return a future which is fired when the result of the request is
             ready. This happens after we receive a response message and parse
-            it.
+            it. If promise is True the future may be passed as an argument
+            to further requests before it fires; see
+            demo_protocol.Protocol. If timeout seconds pass first, it fails
+            with demo_protocol.RequestTimeout.
         """
-        return self.protocol.make_outbound_request(data)
+        return self.protocol.make_outbound_request(data, promise, timeout)
+
+    def get_buffer(self, sizehint):
+        """Get space in the framing buffer for the transport to read into.
+
+        The selector transports pass a sizehint of -1, so we always offer
+        at least recv_size bytes.
+        """
+        return self.protocol.get_buffer(max(sizehint, self.recv_size))
+
+    def buffer_updated(self, nbytes):
+        """Parse the frames completed by nbytes more bytes and dispatch
+        them."""
+        try:
+            messages = self.protocol.buffer_updated(nbytes)
+        except stream.PARSE_ERRORS as e:
+            self._bad_input(e)
+            return
+        self.protocol.dispatch(messages)
 
     def data_received(self, data):
-        """Convert incoming bytes to messages and dispatch them."""
-        messages = self.protocol.data_received(data)
-        for m in messages:
-            if self.protocol.is_inbound_request(m):
-                self.loop.create_task(self.protocol.handle_inbound_request(m))
-            elif self.protocol.is_response(m):
-                self.protocol.handle_response(m)
+        """Convert incoming bytes to messages and dispatch them, for
+        transports which don't support BufferedProtocol."""
+        try:
+            messages = self.protocol.data_received(data)
+        except stream.PARSE_ERRORS as e:
+            self._bad_input(e)
+            return
+        self.protocol.dispatch(messages)
+
+    def _bad_input(self, error):
+        logger.warning("Closing connection from %s: bad input: %s",
+                       self.transport.get_extra_info('peername'), error)
+        self.transport.close()
 
 
 class ConnectionFactory:
+    """Makes Connections, and keeps track of the open ones.
+
+    Attributes:
+        connections (set of Connection): Connections not yet lost.
+        executors (offload.Executors): Pools for offloaded methods, shared
+            by all our connections, or None to run everything inline.
+        metrics (metrics.Metrics): Collects metrics for all our connections
+            if given.
+        flow (demo_protocol.FlowControl): Flow control limits for each
+            connection.
+    """
 
-    def __init__(self, protocol_class, loop_factory):
+    def __init__(self, protocol_class, loop_factory,
+                 codecs=cprotocol.DEFAULT_CODECS,
+                 implementation_class=Calculator, executors=None,
+                 metrics=None, flow=None):
         self.protocol_class = protocol_class
         self.loop_factory = loop_factory
+        self.codecs = codecs
+        self.implementation_class = implementation_class
+        self.executors = executors
+        self.metrics = metrics
+        self.flow = flow
+        self.connections = set()
 
     def __call__(self):
         loop = self.loop_factory()
-        return Connection(loop, self.protocol_class)
+        connection = Connection(loop, self.protocol_class, self.codecs,
+                                self.implementation_class,
+                                self.connections.discard, self.executors,
+                                self.metrics, self.flow)
+        self.connections.add(connection)
+        return connection
+
+    async def drain(self, timeout):
+        """Close each connection once it is idle, waiting at most timeout
+        seconds before closing the rest anyway."""
+        deadline = time.monotonic() + timeout
+        while self.connections:
+            for connection in list(self.connections):
+                if connection.transport is None:
+                    continue
+                if connection.idle() or time.monotonic() >= deadline:
+                    connection.transport.close()
+                    self.connections.discard(connection)
+            if self.connections:
+                await asyncio.sleep(0.05)
 
 
 default_connection_factory = ConnectionFactory(
@@ -74,46 +391,129 @@ default_connection_factory = ConnectionFactory(
     asyncio.get_event_loop)
 
 
-async def main_server(loop, connection_factory, done, host, port):
-    server = await loop.create_server(
-        connection_factory,
-        host,
-        port)
-    print("Server created. Listening on {}:{}".format(host, port))
+async def main_server(loop, connection_factory, done, host, port,
+                      backlog=128, reuse_port=False, sock=None,
+                      drain_timeout=10.0, listeners=()):
+    """Serve until done is set, then drain connections and close.
+
+    Args:
+        port (int): Port to listen on with TCP, or None to use only
+            listeners.
+        sock (socket): Accept connections on this listening socket, e.g.
+            one shared by several worker processes, rather than making one.
+        listeners (list of (endpoints.Endpoint, socket)): Also accept
+            connections on these listening sockets, from endpoints.listen.
+    """
+    servers = []
+    if sock is not None:
+        servers.append(await loop.create_server(connection_factory,
+                                                sock=sock))
+    elif port is not None:
+        servers.append(await loop.create_server(
+            connection_factory,
+            host,
+            port,
+            backlog=backlog,
+            reuse_port=reuse_port or None))
+    if servers:
+        print("Server created. Listening on {}:{}".format(host, port))
+    for endpoint, listener in listeners:
+        servers.append(await endpoints.start_server(
+            connection_factory, endpoint, listener))
+        print("Server created. Listening at {}".format(endpoint))
     await done.wait()
-    server.close()
-    await server.wait_closed()
+    for server in servers:
+        server.close()
+    await connection_factory.drain(drain_timeout)
+    for server in servers:
+        if hasattr(server, 'wait_closed'):
+            await server.wait_closed()
     print("Server closed")
 
 
-async def main_client(loop, connection_factory, done, host, port):
-    transport, connection = await loop.create_connection(
-        connection_factory,
-        host,
-        port)
-    print("Connection created at {}:{}".format(host, port))
+async def main_client(loop, connection_factory, done, host, port, url=None):
+    """Make some example calls, to host and port or to url, one of
+    cappy.endpoints' URLs."""
+    if url is None:
+        url = 'tcp://{}:{}'.format(host, port)
+    endpoint = endpoints.parse(url)
+    if endpoint.scheme == 'socketpair':
+        # Serve ourselves.
+        server_factory = ConnectionFactory(
+            connection_factory.protocol_class, connection_factory.loop_factory,
+            connection_factory.codecs)
+        transport, connection = await endpoints.connect_pair(
+            server_factory, connection_factory)
+    else:
+        transport, connection = await endpoints.open_connection(
+            connection_factory, endpoint)
+    print("Connection created at {}".format(url))
     result = await connection.make_outbound_request(
         {'method': 'add', 'args': [1, 2]})
     print("Result: {}".format(result))
+    # A pipelined chain: each add uses the previous, unresolved, result. All
+    # three requests go out at once and the server wires them together.
+    f = connection.make_outbound_request(
+        {'method': 'add', 'args': [1, 2]}, promise=True)
+    for y in (3, 4):
+        f = connection.make_outbound_request(
+            {'method': 'add', 'args': [f, y]}, promise=True)
+    print("Pipelined result: {}".format(await f))
+    # The accumulator lives on the server; we get a reference to it.
+    accumulator = await connection.make_outbound_request(
+        {'method': 'accumulator', 'args': [100]})
+    await accumulator.add(5)
+    print("Accumulator total: {}".format(await accumulator.add(6)))
+    del accumulator  # Sends a release so the server can drop it.
     await done.wait()
     print("connection should be closed here")
 
 
-def main(host, port, as_server):
+def main(host, port, as_server, codecs=cprotocol.DEFAULT_CODECS,
+         max_threads=None, max_processes=None, metrics_file=None,
+         flow=None, **server_options):
+    """Run a client or server until interrupted.
+
+    A server also stops, draining its connections first, on SIGTERM.
+    server_options are passed on to main_server; a client only takes url,
+    for main_client. max_threads and
+    max_processes size the pools for offloaded methods; see cappy.offload.
+    If metrics_file is given we collect metrics, and write a snapshot to it
+    on SIGUSR1 and when we stop. flow sets the flow control limits of each
+    connection; see demo_protocol.FlowControl.
+    """
     if as_server:
         main = main_server
     else:
         main = main_client
+        server_options = {'url': server_options.get('url')}
 
-    loop = asyncio.get_event_loop()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     done = asyncio.Event()
+    executors = offload.Executors(max_threads, max_processes)
+    metrics = None
+    if metrics_file is not None:
+        metrics = Metrics()
+        loop.add_signal_handler(
+            signal.SIGUSR1, metrics.dump, metrics_file)
 
+    connection_factory = ConnectionFactory(
+        Protocol,
+        asyncio.get_event_loop,
+        codecs,
+        executors=executors,
+        metrics=metrics,
+        flow=flow)
     future = loop.create_task(main(
         loop,
-        default_connection_factory,
+        connection_factory,
         done,
         host,
-        port))
+        port,
+        **server_options))
+    if as_server:
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
     try:
         loop.run_forever()
     except KeyboardInterrupt:
@@ -121,9 +521,45 @@ def main(host, port, as_server):
     done.set()
     loop.run_until_complete(future)
     loop.close()
+    executors.shutdown()
+    if metrics is not None:
+        metrics.dump(metrics_file)
+
+
+def main_workers(host, port, workers, codecs=cprotocol.DEFAULT_CODECS,
+                 backlog=128, reuse_port=False, drain_timeout=10.0,
+                 max_threads=None, max_processes=None, metrics_file=None,
+                 flow=None, listeners=()):
+    """Serve with several worker processes, each running its own loop.
+
+    The workers share one listening socket unless reuse_port is set, in
+    which case each binds its own with SO_REUSEPORT; see cappy.workers.
+    Each worker writes its metrics to metrics_file with its index appended.
+    They all share listeners, from endpoints.listen; if there are any, we
+    don't listen on host and port.
+    """
+    sock = None
+    if listeners:
+        port = None
+    elif not reuse_port:
+        sock = get_listen_socket(host, port, backlog)
+
+    def worker_main(index):
+        main(host, port, True, codecs, max_threads, max_processes,
+             None if metrics_file is None else
+             '{}.{}'.format(metrics_file, index), flow,
+             backlog=backlog, reuse_port=reuse_port, sock=sock,
+             drain_timeout=drain_timeout, listeners=listeners)
+
+    try:
+        run_workers(workers, worker_main, drain_timeout=drain_timeout)
+    finally:
+        if sock is not None:
+            sock.close()
 
 
 if __name__ == "__main__":
+    register_codecs()  # So that --codec can offer them.
     parser = argparse.ArgumentParser(description='Test asyncio server')
     parser.add_argument('--host',
                         '-ho',
@@ -131,8 +567,63 @@ if __name__ == "__main__":
                         help="Sets host address")
     parser.add_argument('--port',
                         '-p',
+                        type=int,
                         default=12344,
                         help="Sets connection port")
+    parser.add_argument('--codec',
+                        choices=sorted(stream.PARSERS) +
+                        sorted(stream.COMPRESSORS),
+                        action='append',
+                        help="Offer this codec; may be repeated, most "
+                             "preferred first")
+    parser.add_argument('--workers',
+                        '-w',
+                        type=int,
+                        default=1,
+                        help="Number of server worker processes")
+    parser.add_argument('--backlog',
+                        type=int,
+                        default=128,
+                        help="Server listen backlog")
+    parser.add_argument('--reuse-port',
+                        action='store_true',
+                        help="Give each worker its own socket bound with "
+                             "SO_REUSEPORT rather than sharing one")
+    parser.add_argument('--drain-timeout',
+                        type=float,
+                        default=10.0,
+                        help="Seconds to let connections finish on SIGTERM")
+    parser.add_argument('--threads',
+                        type=int,
+                        help="Thread pool size for methods run in threads")
+    parser.add_argument('--processes',
+                        type=int,
+                        help="Process pool size for methods run in "
+                             "processes, per worker")
+    parser.add_argument('--metrics-file',
+                        help="Collect metrics, and write them to this file "
+                             "as JSON on SIGUSR1 and on exit")
+    parser.add_argument('--max-in-flight',
+                        type=int,
+                        default=1024,
+                        help="Most requests to work on at once per "
+                             "connection; 0 for no limit")
+    parser.add_argument('--write-buffer',
+                        type=int,
+                        default=1 << 20,
+                        help="Stop reading from a connection while it has "
+                             "more than this many bytes waiting to be sent")
+    parser.add_argument('--listen',
+                        '-l',
+                        metavar='URL',
+                        action='append',
+                        help="Server: listen at URL instead of on host and "
+                             "port: tcp://host:port, unix://path or "
+                             "shm://path; may be repeated")
+    parser.add_argument('--connect',
+                        metavar='URL',
+                        help="Client: connect to URL instead of host and "
+                             "port; socketpair:// serves itself")
     server_group = parser.add_mutually_exclusive_group(required=True)
     server_group.add_argument('--server',
                               '-s',
@@ -147,5 +638,31 @@ if __name__ == "__main__":
     parser.set_defaults(as_server=False)
     args = parser.parse_args()
     host, port, as_server = args.host, args.port, args.as_server
+    codecs = args.codec or cprotocol.DEFAULT_CODECS
+    flow = cprotocol.FlowControl(args.write_buffer,
+                                 max_inbound_in_flight=args.max_in_flight)
 
-    main(host, port, as_server)
+    listeners = []
+    try:
+        for url in (args.listen or ()) if as_server else ():
+            endpoint = endpoints.parse(url)
+            listeners.append(
+                (endpoint, endpoints.listen(endpoint, args.backlog)))
+        if as_server and args.workers > 1:
+            main_workers(host, port, args.workers, codecs, args.backlog,
+                         args.reuse_port, args.drain_timeout, args.threads,
+                         args.processes, args.metrics_file, flow, listeners)
+        else:
+            options = {'url': args.connect}
+            if as_server:
+                options = dict(backlog=args.backlog,
+                               reuse_port=args.reuse_port,
+                               drain_timeout=args.drain_timeout,
+                               listeners=listeners)
+                if listeners:
+                    port = None
+            main(host, port, as_server, codecs, args.threads, args.processes,
+                 args.metrics_file, flow, **options)
+    finally:
+        for endpoint, sock in listeners:
+            endpoints.close_listener(endpoint, sock)
@@ -0,0 +1,65 @@
+"""Compare message size and codec throughput for JSON and binary codecs,
+and the interface codec compiled from calculator.Calculator (see
+cappy.interface). That compiles add, but not sum, so sum's messages show
+what falling back to the binary codec costs.
+
+Run from the python directory:
+```
+python -m cappy.codec_bench
+```
+"""
+import argparse
+import time
+
+
+import cappy.calculator as calculator
+import cappy.stream as stream
+
+
+MESSAGES = {
+    'request': {'id': 1234, 'method': 'add', 'args': [17, 25]},
+    'response': {'id': -1234, 'result': 42},
+    'float request': {'id': 77, 'method': 'add', 'args': [0.1, 2.75]},
+    '100 floats': {'id': 5, 'method': 'sum', 'args': [i / 7 for i in range(100)]},
+    '100 ints': {'id': 5, 'method': 'sum', 'args': list(range(-50000, 50000, 1000))},
+}
+
+
+def per_second(func, arg, seconds):
+    n = 0
+    batch = 1000
+    t0 = time.perf_counter()
+    while 1:
+        for _ in range(batch):
+            func(arg)
+        n += batch
+        elapsed = time.perf_counter() - t0
+        if elapsed > seconds:
+            return n / elapsed
+
+
+def main(seconds):
+    codec, _ = calculator.register_codecs()
+    parsers = [stream.JSONParser(), stream.BinaryParser(),
+               stream.PARSERS[codec]()]
+    print("{:<14} {:<20} {:>6} {:>12} {:>12}".format(
+        "message", "codec", "bytes", "encode/s", "decode/s"))
+    for label, message in MESSAGES.items():
+        for p in parsers:
+            flat = p.flatten(message)
+            # Decode as a Stream would, by the frame's marker, in case the
+            # message fell back to another codec.
+            parse = stream.Stream(stream.VarintByteStream(), p).parse
+            assert parse(memoryview(flat)) == message
+            encode = per_second(p.flatten, message, seconds)
+            decode = per_second(parse, memoryview(flat), seconds)
+            print("{:<14} {:<20} {:>6} {:>12.0f} {:>12.0f}".format(
+                label, p.name, len(flat), encode, decode))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Codec benchmark')
+    parser.add_argument('--seconds', type=float, default=0.3,
+                        help="Time spent on each measurement")
+    args = parser.parse_args()
+    main(args.seconds)
@@ -0,0 +1,359 @@
+"""Frame compression with a preset dictionary.
+
+Our messages are small and alike: the same keys, method names and control
+messages over and over. Compressing each frame on its own gains little,
+since deflate has nothing earlier in the frame to refer back to. So:
+
+- Each direction of a connection is one deflate stream, flushed at the end
+  of every frame, so a frame can refer back to the frames before it.
+- The stream starts from a preset dictionary of byte strings common in our
+  traffic, so even the first frames compress.
+
+A compression scheme is offered in the hello like a codec:
+
+```
+scheme = compression.register(compression.Deflate(dictionary))
+codecs = (scheme,) + demo_protocol.DEFAULT_CODECS
+```
+
+Each end compresses with the scheme it prefers among those both offer (see
+Protocol.handle_hello). Frames under the scheme's threshold go as they are:
+they gain a few bytes at most, for the cost of running deflate. A
+compressed frame is stream.COMPRESSED then the deflate data, which inflates
+to an ordinary frame.
+
+Both ends need the same dictionary. A scheme's name includes a fingerprint
+of it, so peers with different dictionaries don't agree on a scheme and
+send their frames uncompressed.
+
+build_dictionary makes a dictionary from sample frames, e.g. those from
+interface_samples and frames captured off the wire. Run this module to
+build one from captures:
+
+```
+python -m cappy.compression --interface cappy.calculator:Calculator \\
+    --output calculator.zdict capture.bin ...
+```
+
+A capture holds the bytes one end sent on an uncompressed connection, i.e.
+varint-framed frames, as recorded by a tool like tcpflow.
+"""
+import argparse
+import collections
+import hashlib
+import heapq
+import importlib
+import inspect
+import typing
+import zlib
+
+
+import cappy.stream as stream
+
+
+DICTIONARY_SIZE = 4096
+
+_MARKER = bytes([stream.COMPRESSED])
+# Z_SYNC_FLUSH ends each frame with an empty stored block. It is the same
+# every time, so we leave it off and the receiver puts it back.
+_SYNC_TAIL = b'\x00\x00\xff\xff'
+
+
+class Deflate:
+    """A compression scheme: raw deflate, starting from a preset dictionary.
+
+    Attributes:
+        name (str): 'deflate-' and a fingerprint of the dictionary and
+            window size.
+        dictionary (bytes): The preset dictionary, most useful strings last.
+        threshold (int): Smallest frame to compress, in bytes.
+        level (int): zlib compression level.
+        window_bits (int): Base two log of the window size, from 9 to 15.
+            Smaller windows use less memory per connection; deflate can only
+            use the last 2 ** window_bits bytes of the dictionary.
+        max_length (int): Largest frame we inflate, in bytes.
+    """
+
+    def __init__(self, dictionary=b'', threshold=32, level=6, window_bits=15,
+                 max_length=1 << 26):
+        self.dictionary = bytes(dictionary)
+        self.threshold = threshold
+        self.level = level
+        self.window_bits = window_bits
+        self.max_length = max_length
+        fingerprint = hashlib.sha256(
+            bytes([window_bits]) + self.dictionary).hexdigest()
+        self.name = 'deflate-{}'.format(fingerprint[:8])
+
+    def compressor(self):
+        """Make the state for compressing one connection's frames."""
+        if self.dictionary:
+            deflate = zlib.compressobj(self.level, zlib.DEFLATED,
+                                       -self.window_bits, 8,
+                                       zlib.Z_DEFAULT_STRATEGY,
+                                       self.dictionary)
+        else:
+            deflate = zlib.compressobj(self.level, zlib.DEFLATED,
+                                       -self.window_bits)
+        return _Compressor(deflate, self.threshold)
+
+    def decompressor(self):
+        """Make the state for inflating one connection's frames."""
+        if self.dictionary:
+            inflate = zlib.decompressobj(-self.window_bits, self.dictionary)
+        else:
+            inflate = zlib.decompressobj(-self.window_bits)
+        return _Decompressor(inflate, self.max_length)
+
+
+class _Compressor:
+
+    __slots__ = ('threshold', '_deflate')
+
+    def __init__(self, deflate, threshold):
+        self.threshold = threshold
+        self._deflate = deflate
+
+    def compress(self, payload):
+        """Compress a frame.
+
+        Returns:
+            (bytes) The compressed frame, starting with stream.COMPRESSED.
+        """
+        deflate = self._deflate
+        data = deflate.compress(payload) + deflate.flush(zlib.Z_SYNC_FLUSH)
+        return _MARKER + data[:-len(_SYNC_TAIL)]
+
+
+class _Decompressor:
+
+    __slots__ = ('max_length', '_inflate')
+
+    def __init__(self, inflate, max_length):
+        self.max_length = max_length
+        self._inflate = inflate
+
+    def decompress(self, data):
+        """Inflate a compressed frame, without its marker.
+
+        Raises:
+            ValueError: If the data is corrupt, or inflates to more than
+                max_length bytes.
+        """
+        inflate = self._inflate
+        try:
+            frame = inflate.decompress(b''.join((data, _SYNC_TAIL)),
+                                       self.max_length)
+        except zlib.error as e:
+            raise ValueError("Bad compressed frame: {}".format(e))
+        if inflate.unconsumed_tail:
+            raise ValueError(
+                "Compressed frame inflates to over {} bytes".format(
+                    self.max_length))
+        if inflate.eof:
+            raise ValueError("Compressed frame ended the deflate stream")
+        return frame
+
+
+def register(scheme):
+    """Add a compression scheme to stream.COMPRESSORS.
+
+    Returns:
+        (str) The scheme's name, to offer in a connection's codecs.
+    """
+    stream.COMPRESSORS.setdefault(scheme.name, scheme)
+    return scheme.name
+
+
+# Placeholder arguments and results for interface_samples, by annotation.
+_SAMPLE_VALUES = {int: 1, float: 1.0, bool: True, str: '', bytes: b''}
+
+
+def interface_samples(cls, codecs=('json', 'binary')):
+    """Make sample frames of an interface's traffic.
+
+    Args:
+        cls (type): The interface, e.g. calculator.Calculator. Each public
+            method gets a request and a response, with placeholder values
+            of the annotated types.
+        codecs (tuple of str): Names of the parsers in stream.PARSERS to
+            flatten the samples with.
+
+    Returns:
+        (list of bytes) Flattened messages, including control messages.
+    """
+    messages = []
+    for name, function in inspect.getmembers(cls, inspect.isfunction):
+        if name.startswith('_'):
+            continue
+        try:
+            hints = typing.get_type_hints(function)
+        except (NameError, TypeError):
+            hints = {}
+        params = list(inspect.signature(function).parameters)
+        if not isinstance(inspect.getattr_static(cls, name), staticmethod):
+            params = params[1:]  # self
+        args = [_SAMPLE_VALUES.get(hints.get(p), 0) for p in params]
+        messages.append({'id': 1, 'method': name, 'args': args})
+        messages.append(
+            {'id': -1, 'result': _SAMPLE_VALUES.get(hints.get('return'))})
+    messages += [
+        {'id': -1, 'error': 'RuntimeError: '},
+        {'id': 0, 'type': 'finish', 'ids': [1]},
+        {'id': 0, 'type': 'cancel', 'ids': [1]},
+        {'id': 0, 'type': 'release', 'caps': [[1, 1]]},
+        {'id': 0, 'type': 'chunk', 'stream': 1, 'data': b''},
+        {'id': 0, 'type': 'credit', 'stream': 1, 'n': 1},
+        {'id': 0, 'type': 'end', 'stream': 1},
+    ]
+    samples = []
+    for codec in codecs:
+        parser = stream.PARSERS[codec]()
+        for message in messages:
+            try:
+                samples.append(parser.flatten(message))
+            except TypeError:
+                pass  # e.g. bytes, which JSON can't carry
+    return samples
+
+
+def build_dictionary(samples, size=DICTIONARY_SIZE, segment_length=48,
+                     dmer_length=6):
+    """Make a preset dictionary from sample frames.
+
+    Picks segments of the samples greedily, as zstd's COVER algorithm does:
+    a segment is worth the number of samples containing each of its
+    dmer_length byte substrings (dmers) not already in the dictionary.
+    Segments picked first go last, since deflate reaches the end of the
+    dictionary with the shortest distances.
+
+    Args:
+        samples (iterable of bytes-like): Frames, e.g. from interface_samples
+            and captures.
+        size (int): Most bytes in the dictionary.
+        segment_length (int): Bytes per segment.
+        dmer_length (int): Bytes per dmer.
+
+    Returns:
+        (bytes) The dictionary, which may be shorter than size if the samples
+            don't have that much worth keeping.
+    """
+    samples = list(dict.fromkeys(bytes(s) for s in samples))
+    counts = collections.Counter()
+    for sample in samples:
+        counts.update({sample[i:i + dmer_length]
+                       for i in range(len(sample) - dmer_length + 1)})
+
+    def segment_at(index, start):
+        segment = samples[index][start:start + segment_length]
+        return segment, {segment[i:i + dmer_length]
+                         for i in range(len(segment) - dmer_length + 1)}
+
+    step = max(dmer_length // 2, 1)
+    heap = []
+    for index, sample in enumerate(samples):
+        for start in range(0, max(len(sample) - segment_length, 0) + 1, step):
+            _, dmers = segment_at(index, start)
+            heap.append((-sum(counts[d] for d in dmers), index, start))
+    heapq.heapify(heap)
+
+    # Segments are only worth less once picked ones cover some of their
+    # dmers, so we rescore the best one lazily.
+    picked = []
+    total = 0
+    while heap and total < size:
+        _, index, start = heapq.heappop(heap)
+        segment, dmers = segment_at(index, start)
+        score = sum(counts[d] for d in dmers)
+        if heap and score < -heap[0][0]:
+            heapq.heappush(heap, (-score, index, start))
+            continue
+        if not score:
+            break
+        segment = segment[:size - total]
+        picked.append(segment)
+        total += len(segment)
+        for dmer in dmers:
+            counts[dmer] = 0
+    return b''.join(reversed(picked))
+
+
+def compressed_size(scheme, frames):
+    """Count the bytes frames take on the wire, compressed by scheme on one
+    connection.
+
+    Returns:
+        (int) Bytes, not counting framing.
+    """
+    compressor = scheme.compressor()
+    total = 0
+    for frame in frames:
+        if len(frame) >= scheme.threshold:
+            frame = compressor.compress(frame)
+        total += len(frame)
+    return total
+
+
+def read_capture(path):
+    """Read the frames in a capture; see the module docstring.
+
+    Compressed frames are skipped, since we can't read them without the
+    stream they came from.
+    """
+    with open(path, 'rb') as f:
+        frames = stream.VarintByteStream().receive(f.read())
+    return [frame for frame in frames
+            if frame and frame[0] != stream.COMPRESSED]
+
+
+def _load_interface(spec):
+    module, _, name = spec.partition(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def main(captures, output, interfaces=(), size=DICTIONARY_SIZE, threshold=32):
+    """Build a dictionary from captures and interfaces, and write it to
+    output."""
+    frames = []
+    for path in captures:
+        frames += read_capture(path)
+    samples = list(frames)
+    for cls in interfaces:
+        samples += interface_samples(cls)
+    dictionary = build_dictionary(samples, size)
+    with open(output, 'wb') as f:
+        f.write(dictionary)
+    scheme = Deflate(dictionary, threshold)
+    print("{}: {} byte dictionary, scheme {}".format(
+        output, len(dictionary), scheme.name))
+    if frames:
+        raw = sum(map(len, frames))
+        print("{} frames, {} bytes; compressed without dictionary {}, "
+              "with {}".format(
+                  len(frames), raw,
+                  compressed_size(Deflate(b'', threshold), frames),
+                  compressed_size(scheme, frames)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Build a preset compression dictionary from captured "
+                    "frames")
+    parser.add_argument('captures', nargs='*', metavar='CAPTURE',
+                        help="File of varint-framed frames one end sent")
+    parser.add_argument('--output', '-o', required=True,
+                        help="Write the dictionary here")
+    parser.add_argument('--interface', action='append', default=[],
+                        metavar='MODULE:CLASS',
+                        help="Also sample calls to this interface; may be "
+                             "repeated")
+    parser.add_argument('--size', type=int, default=DICTIONARY_SIZE,
+                        help="Most bytes in the dictionary")
+    parser.add_argument('--threshold', type=int, default=32,
+                        help="Smallest frame to compress, when measuring")
+    args = parser.parse_args()
+    if not args.captures and not args.interface:
+        parser.error("Give captures, interfaces or both")
+    main(args.captures, args.output,
+         [_load_interface(spec) for spec in args.interface], args.size,
+         args.threshold)
@@ -0,0 +1,176 @@
+import pytest
+
+
+from cappy.future import Future
+import cappy.calculator as calculator
+import cappy.compression as compression
+import cappy.server_futures as server_futures
+import cappy.stream as stream
+
+
+_, COMPRESSION = calculator.register_codecs()
+
+
+@pytest.fixture
+def scheme():
+    scheme = compression.Deflate(DICTIONARY, threshold=32)
+    compression.register(scheme)
+    yield scheme
+    del stream.COMPRESSORS[scheme.name]
+
+
+def requests(n):
+    parser = stream.JSONParser()
+    return [parser.flatten({'id': i, 'method': 'add', 'args': [i, i * 7]})
+            for i in range(1, n + 1)]
+
+
+DICTIONARY = compression.build_dictionary(requests(50), size=1024)
+
+
+def test_round_trip(scheme):
+    compressor = scheme.compressor()
+    decompressor = scheme.decompressor()
+    frames = requests(20)
+    compressed = [compressor.compress(frame) for frame in frames]
+    assert all(c[0] == stream.COMPRESSED for c in compressed)
+    assert [decompressor.decompress(memoryview(c)[1:])
+            for c in compressed] == frames
+    assert sum(map(len, compressed)) < sum(map(len, frames)) / 2
+
+
+def test_dictionary_helps_first_frame():
+    frame = requests(1)[0]
+    plain = compression.Deflate(b'', threshold=0)
+    preset = compression.Deflate(DICTIONARY, threshold=0)
+    assert compression.compressed_size(preset, [frame]) < \
+        compression.compressed_size(plain, [frame])
+
+
+def test_name_follows_dictionary():
+    assert compression.Deflate(DICTIONARY).name == \
+        compression.Deflate(DICTIONARY, threshold=100).name
+    assert compression.Deflate(DICTIONARY).name != \
+        compression.Deflate(DICTIONARY[1:]).name
+    assert compression.Deflate(DICTIONARY).name != \
+        compression.Deflate(DICTIONARY, window_bits=12).name
+
+
+@pytest.mark.parametrize('data', [b'\xff\xff\xff', b'\x03\x00'])
+def test_bad_data(scheme, data):
+    with pytest.raises(ValueError):
+        scheme.decompressor().decompress(data)
+
+
+def test_inflates_too_much():
+    scheme = compression.Deflate(threshold=0, max_length=1000)
+    data = scheme.compressor().compress(bytes(1001))
+    with pytest.raises(ValueError):
+        scheme.decompressor().decompress(data[1:])
+
+
+class TestStream:
+
+    def make_pair(self, scheme):
+        a = stream.Stream(stream.VarintByteStream(), stream.JSONParser())
+        b = stream.Stream(stream.VarintByteStream(), stream.JSONParser())
+        a.compress_with(scheme.name)
+        b.decompress_with(scheme.name)
+        return a, b
+
+    def test_threshold(self, scheme):
+        a, b = self.make_pair(scheme)
+        small = {'id': 0, 'type': 'x'}
+        large = {'id': 1, 'method': 'add', 'args': [1, 2]}
+        frames = [a.pack_message(small), a.pack_message(large)]
+        assert frames[0][1] == ord('{')
+        assert frames[1][1] == stream.COMPRESSED
+        assert b.receive(b''.join(frames)) == [small, large]
+
+    def test_batches(self, scheme):
+        a, b = self.make_pair(scheme)
+        messages = [{'id': i, 'method': 'add', 'args': [i, i]}
+                    for i in range(1, 6)]
+        frames = a.pack_batch([a.flatten(m) for m in messages], combine=True)
+        assert len(frames) == 1 and frames[0][1] == stream.COMPRESSED
+        assert b.receive(frames[0]) == messages
+
+    def test_hello_in_same_read(self, scheme):
+        a = stream.Stream(stream.VarintByteStream(), stream.JSONParser())
+        b = stream.Stream(stream.VarintByteStream(), stream.JSONParser())
+        b.offer_compression([scheme.name])
+        hello = {'id': 0, 'type': 'hello', 'codecs': [scheme.name, 'json']}
+        data = a.pack_message(hello)
+        a.compress_with(scheme.name)
+        request = {'id': 1, 'method': 'add', 'args': [1, 2]}
+        data += a.pack_message(request)
+        assert b.receive(data) == [hello, request]
+
+    def test_not_agreed(self, scheme):
+        a, _ = self.make_pair(scheme)
+        b = stream.Stream(stream.VarintByteStream(), stream.JSONParser())
+        with pytest.raises(ValueError):
+            b.receive(a.pack_message({'id': 1, 'method': 'add',
+                                      'args': [1, 2]}))
+
+
+@pytest.mark.parametrize('codecs_b, compressed', [
+    ((COMPRESSION, 'json'), True),
+    (('json',), False),
+])
+def test_negotiated(codecs_b, compressed):
+    queues = ([], [])
+    a = server_futures.Protocol(
+        queues[0].append, Future, calculator.CalculatorFutures,
+        (COMPRESSION, 'json'))
+    b = server_futures.Protocol(
+        queues[1].append, Future, calculator.CalculatorFutures, codecs_b)
+    sent = []
+
+    def pump():
+        while any(queues):
+            for queue, protocol in zip(queues, (b, a)):
+                data = b''.join(queue)
+                queue.clear()
+                sent.append(data)
+                protocol.dispatch(protocol.data_received(data))
+
+    # b gets our hello and request in one read, so its hello and compressed
+    # response come back to us in one read too.
+    results = []
+    a.make_outbound_request(
+        {'method': 'digest', 'args': ['abc']}).add_callback(results.append)
+    pump()
+    assert results[0].startswith('ba7816bf')
+    frames = stream.VarintByteStream().receive(b''.join(sent))
+    assert any(f[0] == stream.COMPRESSED for f in frames) == compressed
+
+
+def test_build_dictionary():
+    frames = requests(50)
+    dictionary = compression.build_dictionary(frames, size=64)
+    assert 0 < len(dictionary) <= 64
+    assert b'"method": "add"' in dictionary
+    assert compression.build_dictionary(frames, size=64) == dictionary
+
+
+def test_build_dictionary_from_nothing():
+    assert compression.build_dictionary([]) == b''
+
+
+def test_interface_samples():
+    samples = compression.interface_samples(calculator.Calculator)
+    assert any(b'count_primes' in s and s[0] == ord('{') for s in samples)
+    assert any(b'count_primes' in s and s[0] == 0x01 for s in samples)
+
+
+def test_main(tmp_path, capsys):
+    bs = stream.VarintByteStream()
+    capture = tmp_path / 'capture.bin'
+    capture.write_bytes(b''.join(bs.pack(frame) for frame in requests(100)))
+    output = tmp_path / 'calculator.zdict'
+    compression.main([str(capture)], str(output), [calculator.Calculator],
+                     size=512)
+    dictionary = output.read_bytes()
+    assert 0 < len(dictionary) <= 512
+    assert compression.Deflate(dictionary).name in capsys.readouterr().out
@@ -1,22 +1,285 @@
 from abc import ABCMeta, abstractmethod
+import collections
+import functools
+import itertools
+import reprlib
+import sys
 
 
+import cappy.captable as captable
+import cappy.dispatch as dispatch
+from cappy.future import CancelledError
+from cappy.metrics import MeasuredStream
+import cappy.offload as offload
 import cappy.pool as pool
 import cappy.stream as stream
+import cappy.streams as streams
+
+
+DEFAULT_CODECS = ('binary', 'json')
+
+
+class _Repr(reprlib.Repr):
+    """Shortened reprs for our debug prints.
+
+    reprlib makes the whole repr of types it doesn't know, such as bytes,
+    before cutting it short; we only format the bytes we show.
+    """
+
+    def _repr_binary(self, x, level):
+        head = x[:self.maxstring]
+        if type(head) is memoryview:
+            head = head.tobytes()
+        return repr(head) + ('...' if len(x) > self.maxstring else '')
+
+    repr_bytes = repr_bytearray = repr_memoryview = _repr_binary
+
+
+_repr = _Repr().repr
+
+
+class RemoteError(Exception):
+    """The peer failed to handle one of our requests."""
+
+
+class RequestTimeout(TimeoutError):
+    """The peer didn't answer one of our requests before its deadline."""
+
+
+class FlowControl:
+    """Limits which keep a connection's memory use bounded.
+
+    Attributes:
+        write_high (int): When the transport has more than this many bytes
+            waiting to be sent, it stops reading from the connection...
+        write_low (int): ...until it is down to this many.
+        max_inbound_in_flight (int): Most inbound requests we work on at
+            once. Further messages wait, in order, and the transport stops
+            reading, until some requests have been answered. None for no
+            limit.
+        pending_high (int): Protocol.drain waits while we have at least
+            this many outbound requests pending...
+        pending_low (int): ...until we have at most this many. None for no
+            limit.
+        flush_bytes (int): Once this many bytes of coalesced messages are
+            waiting, we write them without waiting for the end of the tick;
+            see Protocol. None to write every message as it is made.
+    """
+
+    def __init__(self, write_high=1 << 20, write_low=None,
+                 max_inbound_in_flight=1024, pending_high=None,
+                 pending_low=None, flush_bytes=1 << 16):
+        if write_low is None:
+            write_low = write_high // 4
+        if pending_low is None and pending_high is not None:
+            pending_low = pending_high // 2
+        if write_low > write_high or (
+                pending_high is not None and pending_low > pending_high):
+            raise ValueError("Low water mark above high water mark")
+        self.write_high = write_high
+        self.write_low = write_low
+        self.max_inbound_in_flight = max_inbound_in_flight
+        self.pending_high = pending_high
+        self.pending_low = pending_low
+        self.flush_bytes = flush_bytes
 
 
 class Protocol(metaclass=ABCMeta):
+    """Symmetric request/response messaging.
+
+    Requests have a positive id, and the response to a request has the same id
+    negated. Messages with id 0 are control messages. Our ids come from
+    pending_requests, a pool.PendingTable, which drops responses to requests
+    no longer pending. Connections pass the
+    messages from data_received or buffer_updated to dispatch, which sends
+    each one to the right handler.
+
+    On creation we send a hello control message listing the codecs we can
+    use, in order of preference. Until the peer's hello arrives we send JSON;
+    after that we send with our most preferred codec which the peer also
+    supports. Every frame says which codec it uses, so either side may switch
+    whenever it likes.
+
+    The codecs may also name compression schemes from stream.COMPRESSORS;
+    once the hellos are exchanged, each side compresses its frames with its
+    most preferred scheme which the peer also offers (see cappy.compression).
+
+    Attributes:
+        codecs (tuple of str): Names of codecs from stream.PARSERS and
+            stream.COMPRESSORS, in order of preference.
+        codec (str): Name of the codec we are sending with.
+        future_class (type): Class of the futures future_factory makes, so
+            we can recognize them. Set by each backend.
+
+    Promise pipelining:
+
+    An outbound request made with promise=True returns a future which may
+    be passed as an argument to later requests before it resolves. Instead
+    of waiting for the result, we send the later request straight away with
+    an 'answers' entry [[arg_index, question_id], ...] naming the earlier
+    request whose result goes in that argument. The peer keeps the results
+    of requests marked 'promise' in its answers table and fills the
+    arguments in itself, so a chain of N dependent calls costs one round
+    trip instead of N. When the response to a promise request arrives we
+    send a finish control message so the peer can forget the answer.
+    Finishes for all responses in one dispatch go in one message.
+
+    Capabilities:
+
+    Top-level arguments and results which aren't plain data (see
+    captable.PLAIN_TYPES) are passed by reference. We export them and send
+    their capability id in a 'caps' entry [[arg_index, cap_id, yours], ...]
+    (or 'cap': [cap_id, yours] on a response), where yours says the id is in
+    the receiver's export table, i.e. a RemoteRef being passed back to its
+    owner. The receiver gets a captable.RemoteRef; requests made through it
+    carry a 'target' cap id and call that object instead of our
+    implementation. Released references are batched into one release control
+    message, sent at the end of dispatch or before our next request.
+
+    Errors:
+
+    If an inbound request names a method the target doesn't have, or the
+    method raises, we send {'id': -id, 'error': description} instead of a
+    result, and the caller's future fails with RemoteError.
+
+    Execution:
+
+    Methods marked to run in a thread or process pool (see cappy.offload)
+    are handed to executors, if we have them, and their results come back
+    through wrap_concurrent_future. Without executors everything runs
+    inline.
+
+    Metrics:
 
-    def __init__(self, writer, future_factory, implementation_class):
-        self.stream = stream.Stream(
-                stream.HeaderByteStream(2),
-                stream.JSONParser())
-        self.id_pool = pool.MessageIdPool()
-        self.pending_requests = {}  # (int) --> Future
+    Given a metrics.Metrics we count bytes, frames and calls, and time
+    codecs and calls, into it. Transports may set write_buffer_size to a
+    function giving the bytes they have waiting to send, for its gauges.
+
+    Flow control:
+
+    See FlowControl. Once max_inbound_in_flight requests are in progress,
+    dispatch queues the messages which follow in a backlog, and
+    wants_input turns False; we call input_changed, which the transport
+    sets, whenever that changes. The transport stops reading while we
+    don't want input, and also while its own write buffer is above
+    write_high, which it tells us with set_write_paused. Requesters can
+    wait for room to make more requests with drain.
+
+    Coalescing:
+
+    Transports may set schedule_flush to a function which calls its argument
+    at the end of the current event loop tick, e.g. loop.call_soon. Then
+    the messages we make are gathered, and written together by flush: when
+    dispatch has handled a batch of incoming messages, at the end of the
+    tick, or once FlowControl.flush_bytes are waiting, whichever comes
+    first. So responses to requests which arrived together, or requests
+    made together, cost one transport write rather than one each. If our
+    hello and the peer's both say 'batch', the messages are sent in batch
+    frames too (see stream.Stream), which the peer decodes in one go.
+
+    Transports which can write a list of buffers at once, e.g. with
+    sendmsg, may also set writelines to do so. Then large payloads go out
+    behind their frame headers without being copied into one bytes object
+    first; see stream.Stream.pack_batch.
+
+    Map calls:
+
+    A request with 'map': True applies its method to each row of its
+    arguments, which are columns, and gets the column of results; see
+    cappy.vector. It calls the method's vectorized form if the
+    implementation has one.
+
+    Streams:
+
+    Frames have varint length headers (see stream.VarintByteStream), so
+    small messages cost one byte of framing and large ones aren't limited
+    to 64 KiB. Values too large to hold in memory at once can be sent as
+    iterators: see cappy.streams. The receiver gets an
+    incoming_stream_class, which reads the items a window at a time.
+
+    Caching:
+
+    Results of methods marked cacheable are kept in the method's
+    memo.MethodCache. A request which hits is answered as soon as it
+    arrives, and one identical to a request still running waits for that
+    one's outcome. Only plain results are cached.
+
+    Deadlines:
+
+    An outbound request made with a timeout (or while request_timeout is
+    set) gets a timer from call_later. If it expires first, the request's
+    future fails with RequestTimeout and we send a cancel control message
+    with its id. The peer cancels the work if it is still in progress, which
+    answers it with an error, and forgets any promised answer. The id stays
+    taken until that response arrives (see pool.PendingTable.abandon), when
+    it is dropped, so it can't be taken for the answer to a newer request.
+    Transports call connection_lost, which fails every pending request.
+    """
+
+    incoming_stream_class = streams.IncomingStream
+    batch_frames = True  # Whether to offer batch frames in our hello
+
+    def __init__(self, writer, future_factory, implementation_class,
+                 codecs=DEFAULT_CODECS, executors=None, metrics=None,
+                 flow=None):
+        if metrics is None:
+            self.stream = stream.Stream(
+                    stream.VarintByteStream(),
+                    stream.JSONParser())
+        else:
+            self.stream = MeasuredStream(
+                    stream.VarintByteStream(),
+                    stream.JSONParser(),
+                    metrics)
+            metrics.attach(self)
+        self.metrics = metrics
+        self.stream.offer_compression(
+            [name for name in codecs if name in stream.COMPRESSORS])
+        self._calls_in = {}  # For metrics: request id -> (stats, start)
+        self._calls_out = {}
+        self.write_buffer_size = None
+        self.schedule_flush = None  # Set by the transport to coalesce writes
+        self.writelines = None  # Set by transports with gathering writes
+        self._out = []  # Flattened messages waiting for flush
+        self.unflushed_bytes = 0
+        self._flush_scheduled = False
+        self.peer_batches = False  # Whether the peer takes batch frames
+        self.pending_requests = pool.PendingTable()  # (int) --> Future
         self._writer = writer
         self.future_factory = future_factory
+        self.codecs = tuple(codecs)
+        self.codec = stream.JSONParser.name
+        self.answers = {}  # (int) inbound request id --> Future of result
+        self.promises = {}  # Future --> (int) outbound request id
+        self._finished = []  # Promise request ids to send finish for
+        self.inbound_in_flight = 0  # Inbound requests not yet responded to
+        self.executors = executors  # offload.Executors, or None
+        self.flow = flow if flow is not None else FlowControl()
+        self._max_inbound = self.flow.max_inbound_in_flight or sys.maxsize
+        self._backlog = collections.deque()  # Messages waiting for dispatch
+        self._dispatching = False
+        self.input_changed = None  # Function called when wants_input changes
+        self._wanted_input = True
+        self.write_paused = False
+        self._drain_waiters = []
+        self.request_timeout = None  # Default timeout in seconds, or None
+        self._deadlines = {}  # Outbound request id -> timer
+        self._working = {}  # Inbound request id -> future of work underway
+        self._stream_ids = itertools.count(1)
+        self._out_streams = {}  # Stream id -> streams.OutgoingStream
+        self._in_streams = {}  # Stream id -> incoming_stream_class
+        self._unstarted = []  # Ids of streams to start once announced
+        self._filling = {}  # Inbound request id -> (MethodCache, key)
+        self._waiting = {}  # Inbound request id -> (MethodCache, key, waiter)
+        self.exports = captable.ExportTable()
+        self.imports = captable.ImportTable(self.make_outbound_request)
 
         self.implementation = implementation_class(self.make_outbound_request)
+        self.dispatch_table = dispatch.table_for(type(self.implementation))
+        if self.batch_frames:
+            self.send_control('hello', codecs=list(self.codecs), batch=True)
+        else:
+            self.send_control('hello', codecs=list(self.codecs))
 
     def is_inbound_request(self, message):
         return message['id'] > 0
@@ -24,33 +287,752 @@ class Protocol(metaclass=ABCMeta):
     def is_response(self, message):
         return message['id'] < 0
 
+    def is_control(self, message):
+        return message['id'] == 0
+
+    def send_control(self, kind, **fields):
+        message = {'id': 0, 'type': kind}
+        message.update(fields)
+        self._send(self.stream.flatten(message))
+
+    def handle_control(self, message):
+        kind = message.get('type')
+        if kind == 'chunk':
+            incoming = self._in_streams.get(message['stream'])
+            if incoming is not None:
+                incoming.feed(message['data'])
+        elif kind == 'hello':
+            self.handle_hello(message)
+        elif kind == 'finish':
+            for question_id in message['ids']:
+                self.answers.pop(question_id, None)
+        elif kind == 'release':
+            for cap_id, count in message['caps']:
+                self.exports.release(cap_id, count)
+        elif kind == 'cancel':
+            for question_id in message['ids']:
+                self.answers.pop(question_id, None)
+                work = self._working.pop(question_id, None)
+                if work is not None:
+                    self.cancel_work(question_id, work)
+        elif kind == 'end':
+            incoming = self._in_streams.pop(message['stream'], None)
+            if incoming is not None:
+                error = message.get('error')
+                incoming.finish(EOFError("End of stream") if error is None
+                                else RemoteError(error))
+        elif kind == 'credit':
+            out = self._out_streams.get(message['stream'])
+            if out is not None:
+                out.credit += message['n']
+                self.pump_stream(message['stream'], out)
+        elif kind == 'stop':
+            out = self._out_streams.pop(message['stream'], None)
+            if out is not None:
+                self.close_stream(out)
+        else:
+            print("Ignoring unknown control message {}".format(kind))
+
+    def handle_hello(self, message):
+        self.peer_batches = self.batch_frames and bool(message.get('batch'))
+        peer_codecs = message.get('codecs', [])
+        # Make sure we read whichever codec the peer picks.
+        for name in reversed(peer_codecs):
+            if name in self.codecs and name in stream.PARSERS:
+                self.stream.add_parser(name)
+        for name in self.codecs:
+            if name in peer_codecs and name in stream.PARSERS:
+                self.codec = name
+                self.stream.select_parser(name)
+                break
+        # Likewise compress with our pick of scheme; the stream reads the
+        # peer's (see Stream.offer_compression). Our hello may not have been
+        # flushed yet, and the peer must get it uncompressed.
+        for name in self.codecs:
+            if name in peer_codecs and name in stream.COMPRESSORS:
+                self.flush()
+                self.stream.compress_with(name)
+                break
+
     def data_received(self, data):
         return self.stream.receive(data)
 
-    def make_outbound_request(self, message):
-        message_id = self.id_pool.get_id()
+    def get_buffer(self, sizehint):
+        """Get writable space to read incoming bytes into.
+
+        Use with buffer_updated as an alternative to data_received which
+        avoids allocating a new bytes object for each read.
+        """
+        return self.stream.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        """Produce messages after nbytes were written into get_buffer()."""
+        return self.stream.buffer_updated(nbytes)
+
+    def dispatch(self, messages):
+        """Handle incoming messages, in order.
+
+        If we reach max_inbound_in_flight, the rest go in the backlog.
+        """
+        if self._backlog or self._dispatching:
+            self._backlog.extend(messages)
+            self._run_backlog()
+            return
+        self._dispatching = True
+        try:
+            messages = iter(messages)
+            for m in messages:
+                message_id = m['id']
+                if message_id > 0:
+                    if self.inbound_in_flight >= self._max_inbound:
+                        self._backlog.append(m)
+                        self._backlog.extend(messages)
+                        break
+                    self.receive_request(m)
+                elif message_id < 0:
+                    self.handle_response(m)
+                else:
+                    self.handle_control(m)
+        finally:
+            self._dispatching = False
+        if self._backlog:
+            self._run_backlog()
+        else:
+            self._dispatched()
+
+    def wants_input(self):
+        """Whether the transport should read more for us to dispatch."""
+        return not self._backlog
+
+    def _run_backlog(self):
+        """Dispatch backlogged messages while we are below the limit."""
+        if self._dispatching:
+            return
+        backlog = self._backlog
+        self._dispatching = True
+        try:
+            while backlog:
+                m = backlog[0]
+                message_id = m['id']
+                if message_id > 0:
+                    if self.inbound_in_flight >= self._max_inbound:
+                        break
+                    backlog.popleft()
+                    self.receive_request(m)
+                elif message_id < 0:
+                    backlog.popleft()
+                    self.handle_response(m)
+                else:
+                    backlog.popleft()
+                    self.handle_control(m)
+        finally:
+            self._dispatching = False
+        self._dispatched()
+
+    def _dispatched(self):
+        wants_input = not self._backlog
+        if wants_input != self._wanted_input:
+            self._wanted_input = wants_input
+            if self.input_changed is not None:
+                self.input_changed()
+        if self._finished:
+            self.send_control('finish', ids=self._finished)
+            self._finished = []
+        if self.imports.releases:
+            self.flush_releases()
+        if self._out:
+            self.flush()
+
+    def flush_releases(self):
+        """Send a release message for references we have dropped, if any."""
+        releases = self.imports.take_releases()
+        if releases:
+            self.send_control('release', caps=releases)
+
+    def receive_request(self, message):
+        """Prepare an inbound request and pass it to handle_inbound_request.
+
+        We normalize the arguments to a list and look up any promised
+        answers they refer to, so this must happen in the order the requests
+        arrive: a finish for an answer may follow right behind.
+        """
+        self.inbound_in_flight += 1
+        args = message['args']
+        if type(args) is not list:
+            args = list(args) if type(args) is tuple else [args]
+            message['args'] = args
+        try:
+            call = self.lookup_method(message)
+        except LookupError as e:
+            if self.metrics is not None:
+                self.metrics.call_started(
+                    self._calls_in, message['id'], str(message['method']),
+                    False)
+            self._refuse_request(message, e)
+            return
+        if self.metrics is not None:
+            self.metrics.call_started(
+                self._calls_in, message['id'], call[0].name, False)
+        answers = message.get('answers')
+        if answers:
+            try:
+                promised = [(index, self.answers[question_id])
+                            for index, question_id in answers]
+            except KeyError as e:
+                self._refuse_request(
+                    message, LookupError("No answer {}".format(e)))
+                return
+        else:
+            promised = ()
+        if call[0].cache is not None and self._answer_from_cache(message, call):
+            return
+        caps = message.get('caps')
+        if caps:
+            for index, cap_id, yours in caps:
+                args[index] = self._receive_cap(cap_id, yours)
+        stream_args = message.get('streams')
+        if stream_args:
+            for index, stream_id in stream_args:
+                args[index] = self._receive_stream(stream_id)
+        answer = self.handle_inbound_request(message, call, promised)
+        if answer is not None and not answer.done():
+            self._working[message['id']] = answer
+        if message.get('promise'):
+            self.answers[message['id']] = answer
+
+    def _refuse_request(self, message, exception):
+        """Fail an inbound request we can't start, e.g. of an unknown
+        method, and any pipelined requests on its answer."""
+        self.send_error(message['id'], exception)
+        for _, cap_id, yours in message.get('caps', ()):
+            if not yours:
+                # The peer counted these references as ours; give them back.
+                self.imports.receive(cap_id).release()
+        for _, stream_id in message.get('streams', ()):
+            self.send_control('stop', stream=stream_id)
+        answer = self.future_factory()
+        answer.set_exception(RemoteError(str(exception)))
+        if message.get('promise'):
+            self.answers[message['id']] = answer
+
+    def _answer_from_cache(self, message, call):
+        """Answer an inbound request from cache, if we can.
+
+        Returns:
+            bool: True if we answered, or will when an identical call
+                finishes. False if the method must run; if the call can be
+                cached we pass its outcome to the cache when it responds.
+        """
+        if 'answers' in message or 'caps' in message or \
+                'streams' in message:
+            return False
+        cache = call[0].cache
+        key = cache.key(message['args'])
+        if key is None:
+            return False
+        message_id = message['id']
+        answer = self.future_factory() if message.get('promise') else None
+        waiter = functools.partial(self._send_cached, message_id, answer)
+        outcome, result = cache.lookup(key, waiter, functools.partial(
+            self._lead_cached, message, call, cache, key, answer))
+        if outcome == 'miss':
+            self._filling[message_id] = (cache, key)
+            return False
+        if outcome == 'hit':
+            self._send_cached(message_id, answer, result, None)
+        else:
+            self._waiting[message_id] = (cache, key, waiter)
+        if answer is not None:
+            self.answers[message_id] = answer
+        return True
+
+    def _lead_cached(self, message, call, cache, key, answer):
+        """Run a call which was waiting for an identical one, since that
+        one's connection closed, for itself and the calls still waiting."""
+        message_id = message['id']
+        del self._waiting[message_id]
+        self._filling[message_id] = (cache, key)
+        work = self.handle_inbound_request(message, call)
+        if work is not None and not work.done():
+            self._working[message_id] = work
+        if answer is not None:
+            self.chain_future(work, answer)
+
+    def _send_cached(self, message_id, answer, result, exception):
+        if self._waiting:
+            self._waiting.pop(message_id, None)
+        if exception is None:
+            self.send_response(message_id, result)
+            if answer is not None:
+                answer.set_result(result)
+        else:
+            self.send_error(message_id, exception)
+            if answer is not None:
+                answer.set_exception(exception)
+
+    def drain(self):
+        """Get a future which fires when there is room for more requests.
+
+        That is when the transport's write buffer is below its high water
+        mark, and, if FlowControl.pending_high is set, we have at most
+        pending_low requests pending. Requesters which await this between
+        requests keep both bounded.
+        """
+        f = self.future_factory()
+        if self._congested():
+            self._drain_waiters.append(f)
+        else:
+            f.set_result(None)
+        return f
+
+    def _congested(self):
+        pending_high = self.flow.pending_high
+        return self.write_paused or (
+            pending_high is not None and
+            len(self.pending_requests) >= pending_high)
+
+    def _wake_drain_waiters(self):
+        pending_low = self.flow.pending_low
+        if self.write_paused or (
+                pending_low is not None and
+                len(self.pending_requests) > pending_low):
+            return
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for f in waiters:
+            if not f.done():
+                f.set_result(None)
+
+    def set_write_paused(self, paused):
+        """Called by the transport when its write buffer passes
+        FlowControl.write_high (paused) or falls to write_low."""
+        self.write_paused = paused
+        if not paused and self._drain_waiters:
+            self._wake_drain_waiters()
+
+    def make_outbound_request(self, message, promise=False, timeout=None):
+        """Send a request.
+
+        Args:
+            message (dict): The request, with 'method' and 'args'. Futures
+                returned by earlier calls made with promise=True may be used
+                as arguments.
+            promise (bool): If True, the returned future may be used as an
+                argument to later requests before it resolves.
+            timeout (float): Seconds to wait for the response before failing
+                with RequestTimeout and cancelling the request; by default
+                request_timeout.
+
+        Returns:
+            A future which fires with the result.
+        """
+        self.flush_releases()
+        self._replace_promised_args(message)
+        self._replace_cap_args(message)
+        if promise:
+            message['promise'] = True
+        f = self.future_factory()
+        message_id = self.pending_requests.add(f)
         message['id'] = message_id
+        try:
+            payload = self.stream.flatten(message)
+        except:
+            self.pending_requests.pop(message_id)
+            raise
         print("Making outbound request on method {} with "
               "args {} and id {}".format(
-                  message['method'], message['args'], message['id']))
-        self.write(self.stream.pack_message(message))
-        f = self.future_factory()
-        self.pending_requests[message_id] = f
+                  message['method'], _repr(message['args']),
+                  message['id']))
+        if self.metrics is not None:
+            self.metrics.call_started(
+                self._calls_out, message_id, str(message['method']), True)
+        self._send(payload)
+        if self._unstarted:
+            self._start_streams()
+        if promise:
+            self.promises[f] = message_id
+        if timeout is None:
+            timeout = self.request_timeout
+        if timeout is not None:
+            self._deadlines[message_id] = self.call_later(
+                timeout, self._expire, message_id, timeout)
         return f
 
+    def _expire(self, message_id, timeout):
+        """Give up on outbound request message_id; see Deadlines above."""
+        del self._deadlines[message_id]
+        f = self.pending_requests.abandon(message_id)
+        self.promises.pop(f, None)  # The cancel stands in for the finish.
+        if self.metrics is not None:
+            self.metrics.call_finished(self._calls_out, message_id, True)
+        self.send_control('cancel', ids=[message_id])
+        if not f.done():  # The requester may have cancelled it.
+            f.set_exception(RequestTimeout(
+                "Request {} got no response within {}s".format(
+                    message_id, timeout)))
+        if self._drain_waiters:
+            self._wake_drain_waiters()
+
+    def connection_lost(self):
+        """Fail every pending request; the connection has closed."""
+        for timer in self._deadlines.values():
+            timer.cancel()
+        self._deadlines.clear()
+        self._out = []
+        self.unflushed_bytes = 0
+        pending = self.pending_requests.values()
+        self.pending_requests.clear()
+        self.promises.clear()
+        for f in pending:
+            if not f.done():
+                f.set_exception(ConnectionError("Connection lost"))
+        incoming, self._in_streams = self._in_streams, {}
+        for s in incoming.values():
+            s.finish(ConnectionError("Connection lost"))
+        outgoing, self._out_streams = self._out_streams, {}
+        for out in outgoing.values():
+            self.close_stream(out)
+        # Calls from other connections may be waiting for ones we were
+        # running; one of them takes each over.
+        waiting, self._waiting = self._waiting, {}
+        for cache, key, waiter in waiting.values():
+            cache.leave(key, waiter)
+        filling, self._filling = self._filling, {}
+        for cache, key in filling.values():
+            cache.abandon(key, ConnectionError("Connection lost"))
+
+    def _replace_promised_args(self, message):
+        args = message.get('args')
+        if isinstance(args, self.future_class):
+            args = [args]
+            message['args'] = args
+        elif not isinstance(args, (list, tuple)):
+            return
+        answers = None
+        for index, arg in enumerate(args):
+            if not isinstance(arg, self.future_class):
+                continue
+            if answers is None:
+                answers = []
+                args = list(args)
+                message['args'] = args
+            question_id = self.promises.get(arg)
+            if question_id is not None:
+                answers.append([index, question_id])
+                args[index] = None
+            else:
+                # The response already came back (or this future never
+                # was a promise, in which case future_result complains).
+                args[index] = self.future_result(arg)
+        if answers:
+            message['answers'] = answers
+
+    def _replace_cap_args(self, message):
+        args = message.get('args')
+        if not isinstance(args, (list, tuple)):
+            if captable.is_plain(args):
+                return
+            args = [args]
+            message['args'] = args
+        caps = None
+        stream_args = None
+        for index, arg in enumerate(args):
+            if captable.is_plain(arg):
+                continue
+            if caps is None:
+                caps = []
+                args = list(args)
+                message['args'] = args
+            if streams.is_stream(arg):
+                if stream_args is None:
+                    stream_args = []
+                stream_args.append([index, self._send_stream(arg)])
+            else:
+                caps.append([index] + self._send_cap(arg))
+            args[index] = None
+        if caps:
+            message['caps'] = caps
+        if stream_args:
+            message['streams'] = stream_args
+
+    def _send_cap(self, obj):
+        """Get the [cap_id, yours] pair to send obj by reference."""
+        if isinstance(obj, captable.RemoteRef) and obj._table is self.imports:
+            return [obj.cap_id, 1]
+        return [self.exports.export(obj), 0]
+
+    def _send_stream(self, iterator):
+        """Start sending iterator as a stream; see cappy.streams.
+
+        We only send chunks once _start_streams is called, after the
+        message with the stream's id has been written.
+
+        Returns:
+            int: The stream id.
+        """
+        stream_id = next(self._stream_ids)
+        self._out_streams[stream_id] = streams.OutgoingStream(iterator)
+        self._unstarted.append(stream_id)
+        return stream_id
+
+    def _start_streams(self):
+        unstarted, self._unstarted = self._unstarted, []
+        for stream_id in unstarted:
+            out = self._out_streams.get(stream_id)
+            if out is not None:
+                self.pump_stream(stream_id, out)
+
+    def pump_stream(self, stream_id, out):
+        """Send chunks of an outgoing stream while it has credit.
+
+        Backends which can wait for an async iterator override this.
+        """
+        iterator = out.iterator
+        try:
+            while out.credit > 0:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    self._end_stream(stream_id)
+                    return
+                out.credit -= 1
+                self.send_control('chunk', stream=stream_id, data=item)
+        except Exception as e:
+            self._end_stream(stream_id, e)
+
+    def _end_stream(self, stream_id, exception=None):
+        if self._out_streams.pop(stream_id, None) is None:
+            return  # The receiver stopped it.
+        if exception is None:
+            self.send_control('end', stream=stream_id)
+        else:
+            self.send_control('end', stream=stream_id, error="{}: {}".format(
+                type(exception).__name__, exception))
+
+    def close_stream(self, out):
+        """Stop an outgoing stream early, e.g. closing its generator."""
+        out.close()
+
+    def stop_stream(self, stream_id):
+        """Tell the peer to stop sending stream_id; see IncomingStream."""
+        if self._in_streams.pop(stream_id, None) is not None:
+            self.send_control('stop', stream=stream_id)
+
+    def _receive_stream(self, stream_id):
+        incoming = self.incoming_stream_class(self, stream_id)
+        self._in_streams[stream_id] = incoming
+        return incoming
+
+    def _receive_cap(self, cap_id, yours):
+        if yours:
+            return self.exports[cap_id]
+        return self.imports.receive(cap_id)
+
+    def lookup_method(self, message):
+        """Find the method an inbound request calls.
+
+        Returns:
+            (dispatch.MethodEntry, object): The method, and the object to
+                call it on.
+
+        Raises:
+            LookupError: The target or method doesn't exist.
+        """
+        target = message.get('target')
+        if target is None:
+            obj = self.implementation
+            table = self.dispatch_table
+        else:
+            obj = self.exports[target]
+            table = dispatch.table_for(type(obj))
+        if message.get('map'):
+            return table.lookup_vector(message['method']), obj
+        return table.lookup(message['method']), obj
+
+    def offload(self, entry, obj, args):
+        """Run a method whose policy isn't INLINE on our executors.
+
+        Returns:
+            A future_class future of the result.
+        """
+        if entry.policy is offload.PROCESS:
+            cf = self.executors.submit(
+                offload.PROCESS, offload.call_static, type(obj), entry.name,
+                args)
+        else:
+            cf = self.executors.submit(entry.policy, entry.function, obj, *args)
+        return self.wrap_concurrent_future(cf)
+
+    def send_response(self, message_id, result):
+        """Send the result of the inbound request message_id."""
+        self.inbound_in_flight -= 1
+        if self._working:
+            self._working.pop(message_id, None)
+        if self.metrics is not None:
+            self.metrics.call_finished(self._calls_in, message_id)
+        if type(result) in captable.PLAIN_TYPES:
+            response = {'id': -message_id, 'result': result}
+        elif streams.is_stream(result):
+            response = {'id': -message_id, 'result': None,
+                        'stream': self._send_stream(result)}
+        else:
+            response = {'id': -message_id, 'result': None,
+                        'cap': self._send_cap(result)}
+        self._send(self.stream.flatten(response))
+        if self._unstarted:
+            self._start_streams()
+        if self._filling:
+            filling = self._filling.pop(message_id, None)
+            if filling is not None:
+                cache, key = filling
+                if type(result) in captable.PLAIN_TYPES:
+                    cache.fill(key, result)
+                else:
+                    cache.fail(key, TypeError(
+                        "{} returned a {}, which can't be shared".format(
+                            cache.name, type(result).__name__)))
+        if self._backlog:
+            self._run_backlog()
+
+    def send_error(self, message_id, exception):
+        """Tell the peer its request message_id failed."""
+        self.inbound_in_flight -= 1
+        if self._working:
+            self._working.pop(message_id, None)
+        if self.metrics is not None:
+            self.metrics.call_finished(self._calls_in, message_id, True)
+        error = "{}: {}".format(type(exception).__name__, exception)
+        self._send(self.stream.flatten({'id': -message_id, 'error': error}))
+        if self._filling:
+            filling = self._filling.pop(message_id, None)
+            if filling is not None:
+                filling[0].fail(filling[1], exception)
+        if self._backlog:
+            self._run_backlog()
+
+    @abstractmethod
+    def future_result(self, future):
+        """Get the result of a resolved future, or raise ValueError."""
+
+    @abstractmethod
+    def call_later(self, delay, function, *args):
+        """Call function(*args) on our event loop after delay seconds.
+
+        Returns:
+            A handle with a cancel method.
+        """
+
+    def cancel_work(self, message_id, work):
+        """Abandon an inbound request the peer has cancelled.
+
+        Args:
+            message_id (int): The request.
+            work: The unfinished future handle_inbound_request returned for
+                it. Backends make sure that cancelling it sends exactly one
+                response, normally an error, since the peer holds the
+                request id until then.
+        """
+        work.cancel()
+
+    @abstractmethod
+    def chain_future(self, source, target):
+        """Resolve the future target like source, when source resolves."""
+
+    @abstractmethod
+    def wrap_concurrent_future(self, cf):
+        """Get a future_class future which fires, on our event loop, with the
+        result of the concurrent.futures.Future cf."""
+
     @abstractmethod
-    def handle_inbound_request(self, message):
-        pass
+    def handle_inbound_request(self, message, call, promised=()):
+        """Call the method an inbound request asks for, and respond.
+
+        If the method raises, send an error response with send_error rather
+        than letting the exception escape.
+
+        Args:
+            message (dict): The request. message['args'] is a list.
+            call (dispatch.MethodEntry, object): The method to call, and the
+                object to call it on, from lookup_method.
+            promised (sequence of (int, future)): Arguments which are the
+                results of earlier requests, as (argument index, future of
+                the result). The call must wait for these.
+
+        Returns:
+            A future which fires with the result. Unless message['promise']
+            is set nobody needs it, so implementations may return None
+            instead of making one, but only if they have responded already:
+            we keep unfinished futures so that a cancel can stop the work;
+            see cancel_work.
+        """
 
     def handle_response(self, message):
-        result = message['result']
         message_id = message['id']
+        f = self.pending_requests.pop(-message_id)
+        if f is None:
+            # The request timed out or this is a duplicate; either way
+            # nobody is waiting for it.
+            if 'stream' in message:
+                self.send_control('stop', stream=message['stream'])
+            return
+        if self._deadlines:
+            timer = self._deadlines.pop(-message_id, None)
+            if timer is not None:
+                timer.cancel()
+        if self._drain_waiters:
+            self._wake_drain_waiters()
+        if self.metrics is not None:
+            self.metrics.call_finished(
+                self._calls_out, -message_id, 'error' in message)
+        if self.promises.pop(f, None) is not None:
+            self._finished.append(-message_id)
+        if 'error' in message:
+            print('request {} failed: {}'.format(-message_id, message['error']))
+            f.set_exception(RemoteError(message['error']))
+            return
+        result = message['result']
+        cap = message.get('cap')
+        if cap is not None:
+            result = self._receive_cap(*cap)
+        elif 'stream' in message:
+            result = self._receive_stream(message['stream'])
         print('handling response to message {} with result {}'.format(
-            message_id, result))
-        self.pending_requests[-message_id].set_result(result)
-        self.id_pool.return_id(-message_id)
-        del self.pending_requests[-message_id]
+            message_id, _repr(result)))
+        f.set_result(result)
 
     def write(self, data):
         self._writer(data)
 
+    def _send(self, payload):
+        """Send a message from stream.flatten, now or when we flush."""
+        if self.schedule_flush is None:
+            if self.writelines is None:
+                self.write(self.stream.frame(payload))
+            else:
+                self.writelines(self.stream.pack_batch([payload], gather=True))
+            return
+        self._out.append(payload)
+        self.unflushed_bytes += len(payload)
+        if self.unflushed_bytes >= self.flow.flush_bytes:
+            self.flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.schedule_flush(self._scheduled_flush)
+
+    def _scheduled_flush(self):
+        self._flush_scheduled = False
+        self.flush()
+
+    def flush(self):
+        """Write the messages coalesced since the last flush, if any."""
+        out = self._out
+        if not out:
+            return
+        self._out = []
+        self.unflushed_bytes = 0
+        if self.writelines is not None:
+            self.writelines(
+                self.stream.pack_batch(out, self.peer_batches, gather=True))
+            return
+        frames = self.stream.pack_batch(out, self.peer_batches)
+        self.write(frames[0] if len(frames) == 1 else b''.join(frames))
+
@@ -0,0 +1,1150 @@
+import asyncio
+import gc
+import socket
+import threading
+
+
+import pytest
+
+
+from cappy.calculator import CalculatorFutures
+from cappy.future import CancelledError, Future
+import cappy.client_server_asyncio as client_server_asyncio
+import cappy.demo_protocol as demo_protocol
+import cappy.dispatch as dispatch
+import cappy.memo as memo
+import cappy.offload as offload
+import cappy.pool as pool
+import cappy.reactor as reactor
+import cappy.server_futures as server_futures
+import cappy.stream as stream
+import cappy.streams as streams
+
+
+class Adder:
+    """A pure implementation, so that calls don't make requests back."""
+
+    def __init__(self, outbound_requester):
+        self.calls = 0
+
+    def add(self, x, y):
+        self.calls += 1
+        return x + y
+
+    def identity(self, x):
+        self.seen = x
+        return x
+
+    def fail(self):
+        raise RuntimeError("broken")
+
+
+class Offloaded(Adder):
+    """Methods which run in pools, recording which thread they ran on."""
+
+    @offload.in_thread
+    def where(self):
+        return threading.current_thread().name
+
+    @offload.in_thread
+    def fail_in_thread(self):
+        raise RuntimeError("broken in thread")
+
+    @staticmethod
+    @offload.in_process
+    def square(x):
+        return x * x
+
+
+class Pipe:
+    """Connect two protocols back to back, delivering bytes on demand.
+
+    Options are passed on to b's Protocol.
+    """
+
+    def __init__(self, codecs_a=('binary', 'json'), codecs_b=('binary', 'json'),
+                 implementation_class=CalculatorFutures, **options):
+        self.queues = ([], [])
+        self.a = server_futures.Protocol(
+            self.queues[0].append, Future, implementation_class, codecs_a)
+        self.b = server_futures.Protocol(
+            self.queues[1].append, Future, implementation_class, codecs_b,
+            **options)
+        self.deliveries = 0
+
+    def _deliver(self, queue, protocol):
+        if not queue:
+            return
+        data = b''.join(queue)
+        queue.clear()
+        self.deliveries += 1
+        protocol.dispatch(protocol.data_received(data))
+
+    def a_to_b(self):
+        self._deliver(self.queues[0], self.b)
+
+    def b_to_a(self):
+        self._deliver(self.queues[1], self.a)
+
+    def pump(self):
+        while any(self.queues):
+            self.a_to_b()
+            self.b_to_a()
+
+
+@pytest.mark.parametrize('codecs_a, codecs_b, expected_a, expected_b', [
+    (('binary', 'json'), ('binary', 'json'), 'binary', 'binary'),
+    (('json',), ('binary', 'json'), 'json', 'json'),
+    (('json', 'binary'), ('binary', 'json'), 'json', 'binary'),
+])
+def test_codec_negotiation(codecs_a, codecs_b, expected_a, expected_b):
+    pipe = Pipe(codecs_a, codecs_b)
+    assert pipe.a.codec == pipe.b.codec == 'json'
+    pipe.pump()
+    assert pipe.a.codec == expected_a
+    assert pipe.b.codec == expected_b
+
+    result = []
+    f = pipe.a.make_outbound_request({'method': 'add', 'args': [1, 2]})
+    f.add_callback(result.append)
+    pipe.pump()
+    assert result == [3]
+    assert not pipe.a.pending_requests
+
+
+class TestPipelining:
+
+    def test_chain_costs_one_round_trip(self):
+        pipe = Pipe(implementation_class=Adder)
+        pipe.pump()  # Exchange hellos.
+
+        f = pipe.a.make_outbound_request(
+            {'method': 'add', 'args': [1, 2]}, promise=True)
+        for y in range(3, 10):
+            f = pipe.a.make_outbound_request(
+                {'method': 'add', 'args': [f, y]}, promise=True)
+        result = []
+        f.add_callback(result.append)
+
+        pipe.a_to_b()
+        pipe.b_to_a()
+        assert result == [sum(range(1, 10))]
+        assert pipe.b.implementation.calls == 8
+        assert len(pipe.b.answers) == 8
+
+        # The finish releases the peer's answers.
+        pipe.a_to_b()
+        assert pipe.b.answers == {}
+        assert pipe.a.promises == {}
+
+    def test_waits_for_unresolved_answer(self):
+        pipe = Pipe()  # CalculatorFutures.add needs an echo from a.
+        pipe.pump()
+        first = pipe.a.make_outbound_request(
+            {'method': 'add', 'args': [1, 2]}, promise=True)
+        second = pipe.a.make_outbound_request(
+            {'method': 'add', 'args': [first, 10]})
+        result = []
+        second.add_callback(result.append)
+        pipe.pump()
+        assert result == [13]
+        assert pipe.b.answers == {}
+
+    def test_resolved_promise_is_sent_by_value(self):
+        pipe = Pipe(implementation_class=Adder)
+        pipe.pump()
+        first = pipe.a.make_outbound_request(
+            {'method': 'add', 'args': [1, 2]}, promise=True)
+        pipe.pump()
+        second = pipe.a.make_outbound_request(
+            {'method': 'add', 'args': [first, 10]})
+        result = []
+        second.add_callback(result.append)
+        pipe.pump()
+        assert result == [13]
+
+    def test_asyncio_chain(self):
+
+        class AsyncAdder(Adder):
+            async def add(self, x, y):
+                await asyncio.sleep(0)
+                return x + y
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            a, b = socket.socketpair()
+            factory = client_server_asyncio.ConnectionFactory(
+                client_server_asyncio.Protocol,
+                asyncio.get_running_loop,
+                implementation_class=AsyncAdder)
+            _, client = await loop.create_connection(factory, sock=a)
+            _, server = await loop.connect_accepted_socket(factory, sock=b)
+
+            f = client.make_outbound_request(
+                {'method': 'add', 'args': [1, 2]}, promise=True)
+            for y in range(3, 10):
+                f = client.make_outbound_request(
+                    {'method': 'add', 'args': [f, y]}, promise=True)
+            result = await f
+            await asyncio.sleep(0.01)  # Let the finish arrive.
+            answers = dict(server.protocol.answers)
+            client.transport.close()
+            server.transport.close()
+            return result, answers
+
+        result, answers = asyncio.run(run())
+        assert result == sum(range(1, 10))
+        assert answers == {}
+
+
+    def test_unknown_answer_is_an_error(self):
+        pipe = Pipe(implementation_class=Adder)
+        pipe.pump()
+        pipe.b.receive_request({'id': 1, 'method': 'add', 'args': [0, 1],
+                                'answers': [[0, 99]], 'promise': True})
+        assert pipe.b.inbound_in_flight == 0
+        assert isinstance(pipe.b.answers[1].failed_with(),
+                          demo_protocol.RemoteError)
+        assert pipe.b.implementation.calls == 0
+
+
+class TestCapabilities:
+
+    @pytest.mark.parametrize('request_', [
+        {'method': 'no_such_method'},
+        {'method': 'add', 'answers': [[1, 99]]},
+    ])
+    def test_refused_request_releases_caps(self, request_):
+        pipe = Pipe(implementation_class=Adder)
+        pipe.pump()
+        result = []
+        pipe.a.make_outbound_request(
+            dict(request_, args=[object(), 0])).add_both(result.append)
+        assert len(pipe.a.exports) == 1
+        pipe.pump()
+        assert isinstance(result[0], demo_protocol.RemoteError)
+        assert len(pipe.a.exports) == 0
+
+    def test_result_by_reference(self):
+        pipe = Pipe()
+        pipe.pump()
+        result = []
+        pipe.a.make_outbound_request(
+            {'method': 'accumulator', 'args': [10]}).add_callback(result.append)
+        pipe.pump()
+        [accumulator] = result
+        assert len(pipe.b.exports) == 1
+
+        totals = []
+        accumulator.add(5).add_callback(totals.append)
+        accumulator.add(6).add_callback(totals.append)
+        pipe.pump()
+        assert totals == [15, 21]
+
+        del accumulator, result
+        pipe.a.flush_releases()
+        pipe.pump()
+        assert len(pipe.b.exports) == 0
+
+    def test_argument_by_reference_and_back(self):
+        pipe = Pipe(implementation_class=Adder)
+        pipe.pump()
+        token = object()
+        result = []
+        pipe.a.make_outbound_request(
+            {'method': 'identity', 'args': [token]}).add_callback(result.append)
+        pipe.pump()
+        # b saw a RemoteRef, and sending it back gave a its own object.
+        assert type(pipe.b.implementation.seen).__name__ == 'RemoteRef'
+        assert result == [token]
+
+
+class TestErrors:
+
+    def test_failed_promise_fails_dependents(self):
+        pipe = Pipe(implementation_class=Adder)
+        pipe.pump()
+        first = pipe.a.make_outbound_request(
+            {'method': 'fail', 'args': []}, promise=True)
+        second = pipe.a.make_outbound_request(
+            {'method': 'add', 'args': [first, 1]})
+        errors = []
+        second.add_errback(errors.append)
+        pipe.pump()
+        assert 'broken' in str(errors[0])
+        assert pipe.b.answers == {}
+
+    @pytest.mark.parametrize('method', ['missing', 'fail', 99, '_private'])
+    def test_error_response(self, method):
+        pipe = Pipe(implementation_class=Adder)
+        pipe.pump()
+        result = []
+        pipe.a.make_outbound_request(
+            {'method': method, 'args': []}).add_errback(result.append)
+        pipe.pump()
+        [error] = result
+        assert isinstance(error, demo_protocol.RemoteError)
+        assert not pipe.a.pending_requests
+
+    def test_asyncio_error_response(self):
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            a, b = socket.socketpair()
+            factory = client_server_asyncio.ConnectionFactory(
+                client_server_asyncio.Protocol,
+                asyncio.get_running_loop,
+                implementation_class=Adder)
+            _, client = await loop.create_connection(factory, sock=a)
+            _, server = await loop.connect_accepted_socket(factory, sock=b)
+            try:
+                for method in ('missing', 'fail'):
+                    with pytest.raises(demo_protocol.RemoteError):
+                        await client.make_outbound_request(
+                            {'method': method, 'args': []})
+                return await client.make_outbound_request(
+                    {'method': 'add', 'args': [1, 2]})
+            finally:
+                client.transport.close()
+                server.transport.close()
+
+        assert asyncio.run(run()) == 3
+
+    def test_asyncio_failures_are_not_unhandled(self):
+
+        class AsyncFailer(Adder):
+            async def afail(self):
+                raise RuntimeError("broken")
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            unhandled = []
+            loop.set_exception_handler(lambda loop, context:
+                                       unhandled.append(context))
+            a, b = socket.socketpair()
+            factory = client_server_asyncio.ConnectionFactory(
+                client_server_asyncio.Protocol,
+                asyncio.get_running_loop,
+                implementation_class=AsyncFailer)
+            _, client = await loop.create_connection(factory, sock=a)
+            _, server = await loop.connect_accepted_socket(factory, sock=b)
+            try:
+                for method in ('afail', 'fail'):
+                    with pytest.raises(demo_protocol.RemoteError):
+                        await client.make_outbound_request(
+                            {'method': method, 'args': []})
+                    # A later request promised the failed answer fails too.
+                    f = client.make_outbound_request(
+                        {'method': method, 'args': []}, promise=True)
+                    with pytest.raises(demo_protocol.RemoteError):
+                        await client.make_outbound_request(
+                            {'method': 'add', 'args': [f, 1]})
+                    with pytest.raises(demo_protocol.RemoteError):
+                        await f
+            finally:
+                client.transport.close()
+                server.transport.close()
+            await asyncio.sleep(0.01)
+            gc.collect()
+            return unhandled
+
+        assert asyncio.run(run()) == []
+
+
+@pytest.fixture
+def r():
+    r = reactor.Reactor()
+    yield r
+    r.close()
+
+
+@pytest.fixture
+def executors():
+    executors = offload.Executors(max_threads=2, max_processes=1)
+    yield executors
+    executors.shutdown()
+
+
+class TestOffload:
+
+    def test_runs_inline_without_executors(self):
+        pipe = Pipe(implementation_class=Offloaded)
+        pipe.pump()
+        result = []
+        pipe.a.make_outbound_request(
+            {'method': 'where', 'args': []}).add_callback(result.append)
+        pipe.pump()
+        assert result == [threading.current_thread().name]
+
+    def test_reactor(self, executors):
+        r = reactor.Reactor()
+        try:
+            pipe = Pipe(implementation_class=Offloaded, executors=executors,
+                        call_soon_threadsafe=r.call_soon_threadsafe)
+            pipe.pump()
+            results = []
+            for method, args in [('where', []), ('square', [7]),
+                                 ('fail_in_thread', [])]:
+                pipe.a.make_outbound_request(
+                    {'method': method, 'args': args}).add_both(results.append)
+            pipe.pump()
+            for _ in range(50):
+                if len(results) == 3:
+                    break
+                r.run_once(timeout=0.1)
+                pipe.pump()
+        finally:
+            r.close()
+        assert 49 in results  # square, from the process pool.
+        [where] = [x for x in results if isinstance(x, str)]
+        assert where.startswith('cappy')
+        [error] = [x for x in results if isinstance(x, Exception)]
+        assert isinstance(error, demo_protocol.RemoteError)
+        assert pipe.b.inbound_in_flight == 0
+
+    def test_asyncio(self, executors):
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            a, b = socket.socketpair()
+            factory = client_server_asyncio.ConnectionFactory(
+                client_server_asyncio.Protocol,
+                asyncio.get_running_loop,
+                implementation_class=Offloaded,
+                executors=executors)
+            _, client = await loop.create_connection(factory, sock=a)
+            _, server = await loop.connect_accepted_socket(factory, sock=b)
+            try:
+                with pytest.raises(demo_protocol.RemoteError):
+                    await client.make_outbound_request(
+                        {'method': 'fail_in_thread', 'args': []})
+                # Offloaded results can be pipelined like any other.
+                f = client.make_outbound_request(
+                    {'method': 'square', 'args': [3]}, promise=True)
+                square = await client.make_outbound_request(
+                    {'method': 'square', 'args': [f]})
+                where = await client.make_outbound_request(
+                    {'method': 'where', 'args': []})
+                return square, where
+            finally:
+                client.transport.close()
+                server.transport.close()
+
+        square, where = asyncio.run(run())
+        assert square == 81
+        assert where.startswith('cappy')
+
+
+class Holder(Adder):
+    """hold(x) answers x only when the test releases it."""
+
+    def __init__(self, outbound_requester):
+        super().__init__(outbound_requester)
+        self.held = []
+
+    def hold(self, x):
+        f = Future()
+        self.held.append((f, x))
+        return f
+
+    def release(self):
+        f, x = self.held.pop(0)
+        f.set_result(x)
+
+
+class TestFlowControl:
+
+    def test_low_above_high(self):
+        with pytest.raises(ValueError):
+            demo_protocol.FlowControl(write_high=10, write_low=20)
+        with pytest.raises(ValueError):
+            demo_protocol.FlowControl(pending_high=10, pending_low=20)
+
+    def test_inbound_limit_keeps_order(self):
+        pipe = Pipe(implementation_class=Holder,
+                    flow=demo_protocol.FlowControl(max_inbound_in_flight=2))
+        pipe.pump()
+        changes = []
+        pipe.b.input_changed = lambda: changes.append(pipe.b.wants_input())
+        results = []
+        for x in range(4):
+            pipe.a.make_outbound_request(
+                {'method': 'hold', 'args': [x]}).add_callback(results.append)
+        pipe.a.make_outbound_request(
+            {'method': 'add', 'args': [1, 2]}).add_callback(results.append)
+        pipe.a_to_b()
+        holder = pipe.b.implementation
+        assert [x for _, x in holder.held] == [0, 1]
+        assert pipe.b.inbound_in_flight == 2
+        assert not pipe.b.wants_input()
+        assert changes == [False]
+
+        holder.release()
+        assert [x for _, x in holder.held] == [1, 2]
+        assert not pipe.b.wants_input()
+        holder.release()
+        holder.release()
+        # The add behind the holds runs once there is room for it.
+        assert pipe.b.wants_input()
+        assert changes == [False, True]
+        assert holder.calls == 1
+        holder.release()
+        pipe.pump()
+        assert results == [0, 1, 2, 3, 3]
+        assert pipe.b.inbound_in_flight == 0
+
+    def test_drain_waits_for_pending_low(self):
+        pipe = Pipe(flow=demo_protocol.FlowControl(pending_high=2,
+                                                   pending_low=1))
+        pipe.pump()
+        assert pipe.b.drain().done()
+        for _ in range(2):
+            pipe.b.make_outbound_request({'method': 'echo', 'args': ['hi']})
+        waiter = pipe.b.drain()
+        assert not waiter.done()
+        pipe.pump()
+        assert waiter.done()
+
+    def test_drain_waits_for_writes(self):
+        pipe = Pipe()
+        pipe.b.set_write_paused(True)
+        waiter = pipe.b.drain()
+        assert not waiter.done()
+        pipe.b.set_write_paused(False)
+        assert waiter.done()
+
+    def test_asyncio_pauses_reading(self):
+
+        class FakeTransport(asyncio.Transport):
+
+            def __init__(self):
+                super().__init__()
+                self.reading = True
+                self.limits = None
+
+            def write(self, data):
+                pass
+
+            def set_write_buffer_limits(self, high=None, low=None):
+                self.limits = (high, low)
+
+            def get_write_buffer_size(self):
+                return 0
+
+            def is_closing(self):
+                return False
+
+            def pause_reading(self):
+                self.reading = False
+
+            def resume_reading(self):
+                self.reading = True
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            connection = client_server_asyncio.Connection(
+                loop, client_server_asyncio.Protocol,
+                flow=demo_protocol.FlowControl(write_high=100))
+            transport = FakeTransport()
+            connection.connection_made(transport)
+            assert transport.limits == (100, 25)
+            connection.pause_writing()
+            assert not transport.reading
+            drained = connection.drain()
+            assert not drained.done()
+            connection.resume_writing()
+            assert transport.reading
+            await drained
+
+        asyncio.run(run())
+
+
+class TestDeadlines:
+
+    def make_pipe(self, r):
+        pipe = Pipe(implementation_class=Holder, call_later=r.call_later)
+        pipe.pump()
+        return pipe
+
+    def expire(self, r):
+        while r.timers:
+            r.run_once(timeout=0.1)
+
+    def test_timeout_cancels_remote_work(self, r):
+        pipe = self.make_pipe(r)
+        results = []
+        pipe.b.make_outbound_request(
+            {'method': 'hold', 'args': [1]}, timeout=0).add_both(
+                results.append)
+        pipe.b_to_a()
+        assert pipe.a.inbound_in_flight == 1
+        self.expire(r)
+        [error] = results
+        assert isinstance(error, demo_protocol.RequestTimeout)
+        assert not pipe.b.pending_requests
+
+        pipe.b_to_a()
+        assert pipe.a.inbound_in_flight == 0
+        pipe.a_to_b()
+        assert not pipe.b.pending_requests
+
+        # What the method was waiting for was cancelled too.
+        [(held, _)] = pipe.a.implementation.held
+        assert isinstance(held.failed_with(), CancelledError)
+
+    def test_late_response_is_dropped(self, r):
+        pipe = self.make_pipe(r)
+        results = []
+        pipe.b.make_outbound_request(
+            {'method': 'hold', 'args': [1]}, timeout=0).add_both(
+                results.append)
+        pipe.b_to_a()
+        pipe.a.implementation.release()  # Answered before the cancel.
+        self.expire(r)
+        # A new request is made before the late response arrives. It
+        # mustn't get the timed out one's id, however often the slots are
+        # reused meanwhile.
+        for _ in range(1 << pool.GENERATION_BITS):
+            pipe.b.pending_requests.pop(pipe.b.pending_requests.add('x'))
+        pipe.b.make_outbound_request(
+            {'method': 'add', 'args': [1, 2]}).add_callback(results.append)
+        assert isinstance(results[0], demo_protocol.RequestTimeout)
+        pipe.pump()
+        assert results[1:] == [3]
+        assert len(pipe.b.pending_requests._free) == 2  # Both slots freed.
+
+    def test_response_cancels_timer(self, r):
+        pipe = self.make_pipe(r)
+        results = []
+        pipe.b.make_outbound_request(
+            {'method': 'add', 'args': [1, 2]}, timeout=60).add_callback(
+                results.append)
+        pipe.pump()
+        assert results == [3]
+        assert pipe.b._deadlines == {}
+        assert all(t.cancelled for t in r.timers)
+
+    def test_cancelled_promise_fails_dependents(self, r):
+        pipe = self.make_pipe(r)
+        f = pipe.b.make_outbound_request(
+            {'method': 'hold', 'args': [1]}, promise=True, timeout=0)
+        results = []
+        pipe.b.make_outbound_request(
+            {'method': 'add', 'args': [f, 2]}).add_both(results.append)
+        pipe.b_to_a()
+        self.expire(r)
+        pipe.pump()
+        assert isinstance(results[0], demo_protocol.RemoteError)
+        assert pipe.a.answers == {}
+        assert pipe.a.inbound_in_flight == 0
+
+    def test_connection_lost_fails_pending(self, r):
+        pipe = self.make_pipe(r)
+        results = []
+        pipe.b.make_outbound_request(
+            {'method': 'hold', 'args': [1]}, timeout=60).add_both(
+                results.append)
+        pipe.b.connection_lost()
+        assert isinstance(results[0], ConnectionError)
+        assert all(t.cancelled for t in r.timers)
+
+    def test_asyncio(self):
+
+        class Sleeper(Adder):
+            async def sleep(self, seconds):
+                await asyncio.sleep(seconds)
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            a, b = socket.socketpair()
+            factory = client_server_asyncio.ConnectionFactory(
+                client_server_asyncio.Protocol,
+                asyncio.get_running_loop,
+                implementation_class=Sleeper)
+            _, client = await loop.create_connection(factory, sock=a)
+            _, server = await loop.connect_accepted_socket(factory, sock=b)
+            try:
+                with pytest.raises(demo_protocol.RequestTimeout):
+                    await client.make_outbound_request(
+                        {'method': 'sleep', 'args': [60]}, timeout=0.01)
+                for _ in range(100):
+                    if not server.protocol.inbound_in_flight:
+                        break
+                    await asyncio.sleep(0.01)
+                assert server.protocol.inbound_in_flight == 0
+                assert await client.make_outbound_request(
+                    {'method': 'add', 'args': [1, 2]}, timeout=10) == 3
+            finally:
+                client.transport.close()
+                server.transport.close()
+
+        asyncio.run(run())
+
+
+class Streamer(Adder):
+    """Methods which send and receive streams."""
+
+    def __init__(self, outbound_requester):
+        super().__init__(outbound_requester)
+        self.closed = False
+
+    def numbers(self, n):
+        try:
+            for i in range(n):
+                yield i
+        finally:
+            self.closed = True
+
+    def broken(self):
+        yield 1
+        raise RuntimeError("broken stream")
+
+    def collect(self, chunks) -> Future:
+        """Read a whole stream into a list."""
+        result = Future()
+        items = []
+
+        def read_next():
+            chunks.read().add_callbacks(got, ended)
+
+        def got(item):
+            items.append(item)
+            read_next()
+
+        def ended(exception):
+            if isinstance(exception, EOFError):
+                result.set_result(items)
+            else:
+                result.set_exception(exception)
+
+        read_next()
+        return result
+
+
+def read_all(pipe, incoming):
+    """Read a stream from b on a to the end, pumping the pipe as needed."""
+    items = []
+    while 1:
+        f = incoming.read()
+        pipe.pump()
+        if f.failed_with() is not None:
+            return items, f.failed_with()
+        items.append(f.result)
+
+
+class TestStreams:
+
+    def test_large_message(self):
+        pipe = Pipe()
+        pipe.pump()
+        result = []
+        pipe.a.make_outbound_request(
+            {'method': 'echo', 'args': ['x' * 100000]}).add_callback(
+                result.append)
+        pipe.pump()
+        assert result == ['x' * 100000]
+
+    def test_result_stream_is_windowed(self):
+        pipe = Pipe(implementation_class=Streamer)
+        pipe.pump()
+        result = []
+        pipe.a.make_outbound_request(
+            {'method': 'numbers', 'args': [100]}).add_callback(result.append)
+        pipe.a_to_b()
+        pipe.b_to_a()
+        [incoming] = result
+        # b sends a window's worth, then waits for credit.
+        assert len(incoming._items) == streams.WINDOW
+        [out] = pipe.b._out_streams.values()
+        assert out.credit == 0
+
+        items, end = read_all(pipe, incoming)
+        assert items == list(range(100))
+        assert isinstance(end, EOFError)
+        assert pipe.b._out_streams == {}
+        assert pipe.a._in_streams == {}
+
+    def test_argument_stream(self):
+        pipe = Pipe(implementation_class=Streamer)
+        pipe.pump()
+        result = []
+        pipe.a.make_outbound_request(
+            {'method': 'collect', 'args': [iter(range(50))]}).add_callback(
+                result.append)
+        pipe.pump()
+        assert result == [list(range(50))]
+
+    def test_stream_error(self):
+        pipe = Pipe(implementation_class=Streamer)
+        pipe.pump()
+        result = []
+        pipe.a.make_outbound_request(
+            {'method': 'broken', 'args': []}).add_callback(result.append)
+        pipe.pump()
+        items, end = read_all(pipe, result[0])
+        assert items == [1]
+        assert isinstance(end, demo_protocol.RemoteError)
+        assert 'broken stream' in str(end)
+
+    def test_close_stops_sender(self):
+        pipe = Pipe(implementation_class=Streamer)
+        pipe.pump()
+        result = []
+        pipe.a.make_outbound_request(
+            {'method': 'numbers', 'args': [1000]}).add_callback(result.append)
+        pipe.pump()
+        result[0].close()
+        pipe.pump()
+        assert pipe.b.implementation.closed
+        assert pipe.b._out_streams == {}
+        assert isinstance(result[0].read().failed_with(), EOFError)
+
+    def test_asyncio(self):
+
+        class AsyncStreamer(Adder):
+            async def double(self, chunks):
+                async def doubled():
+                    async for chunk in chunks:
+                        yield chunk * 2
+                return doubled()
+
+        async def numbers(n):
+            for i in range(n):
+                yield i
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            a, b = socket.socketpair()
+            factory = client_server_asyncio.ConnectionFactory(
+                client_server_asyncio.Protocol,
+                asyncio.get_running_loop,
+                implementation_class=AsyncStreamer)
+            _, client = await loop.create_connection(factory, sock=a)
+            _, server = await loop.connect_accepted_socket(factory, sock=b)
+            try:
+                doubled = await client.make_outbound_request(
+                    {'method': 'double', 'args': [numbers(100)]})
+                return [x async for x in doubled]
+            finally:
+                client.transport.close()
+                server.transport.close()
+
+        assert asyncio.run(run()) == [2 * i for i in range(100)]
+
+    def test_calculator_zeros(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            a, b = socket.socketpair()
+            factory = client_server_asyncio.ConnectionFactory(
+                client_server_asyncio.Protocol, asyncio.get_running_loop)
+            _, client = await loop.create_connection(factory, sock=a)
+            _, server = await loop.connect_accepted_socket(factory, sock=b)
+            try:
+                zeros = await client.make_outbound_request(
+                    {'method': 'zeros', 'args': [300000, 65536]})
+                sizes = [len(chunk) async for chunk in zeros]
+                # And back again, as an argument.
+                zeros = await client.make_outbound_request(
+                    {'method': 'zeros', 'args': [300000]})
+                total = await client.make_outbound_request(
+                    {'method': 'count_bytes', 'args': [zeros]})
+                return sizes, total
+            finally:
+                client.transport.close()
+                server.transport.close()
+
+        sizes, total = asyncio.run(run())
+        assert sizes == [65536] * 4 + [300000 - 4 * 65536]
+        assert total == 300000
+
+
+class Memoized(Holder):
+    """Cacheable methods, counting how often they run."""
+
+    def __init__(self, outbound_requester):
+        super().__init__(outbound_requester)
+        self.runs = 0
+
+    @memo.cacheable()
+    def slow_square(self, x) -> Future:
+        self.runs += 1
+        return self.hold(x * x)
+
+    @memo.cacheable()
+    def fail_once(self, x):
+        self.runs += 1
+        if self.runs == 1:
+            raise RuntimeError("first call fails")
+        return x
+
+    @memo.cacheable()
+    def numbers(self, n):
+        return iter(range(n))
+
+
+class TestCaching:
+
+    @pytest.fixture(autouse=True)
+    def clear_caches(self):
+        memo.clear_all()
+
+    def call(self, pipe, method, *args, **kwargs):
+        results = []
+        pipe.a.make_outbound_request(
+            {'method': method, 'args': list(args)}, **kwargs).add_both(
+                results.append)
+        return results
+
+    def test_hit_skips_method(self):
+        pipe = Pipe(implementation_class=Memoized)
+        pipe.pump()
+        first = self.call(pipe, 'slow_square', 3)
+        pipe.pump()
+        pipe.b.implementation.release()
+        pipe.pump()
+        second = self.call(pipe, 'slow_square', 3)
+        pipe.pump()
+        assert first == second == [9]
+        assert pipe.b.implementation.runs == 1
+        assert pipe.b.inbound_in_flight == 0
+
+    def test_concurrent_calls_run_once(self):
+        pipe = Pipe(implementation_class=Memoized)
+        other = Pipe(implementation_class=Memoized)  # Another connection.
+        pipe.pump()
+        other.pump()
+        cache = dispatch.table_for(Memoized).lookup('slow_square').cache
+        before = cache.misses, cache.coalesced
+        results = [self.call(pipe, 'slow_square', 4) for _ in range(3)]
+        results.append(self.call(other, 'slow_square', 4))
+        pipe.pump()
+        other.pump()
+        assert pipe.b.implementation.runs == 1
+        assert other.b.implementation.runs == 0
+        pipe.b.implementation.release()
+        pipe.pump()
+        other.pump()
+        assert results == [[16]] * 4
+        assert (cache.misses - before[0], cache.coalesced - before[1]) == (
+            1, 3)
+
+    def test_waiter_takes_over_when_leader_disconnects(self):
+        pipes = [Pipe(implementation_class=Memoized) for _ in range(3)]
+        for pipe in pipes:
+            pipe.pump()
+        leader, other, third = pipes
+        self.call(leader, 'slow_square', 5)
+        self.call(leader, 'slow_square', 5)  # Waits on the dead connection.
+        leader.pump()
+        f = other.a.make_outbound_request(
+            {'method': 'slow_square', 'args': [5]}, promise=True)
+        results = [self.call(other, 'add', f, 1),
+                   self.call(third, 'slow_square', 5)]
+        other.pump()
+        third.pump()
+        leader.b.connection_lost()
+        assert [p.b.implementation.runs for p in pipes] == [1, 1, 0]
+        other.b.implementation.release()
+        other.pump()
+        third.pump()
+        assert results == [[26], [25]]
+        assert other.b.inbound_in_flight == third.b.inbound_in_flight == 0
+        assert not leader.b._waiting and not other.b._filling
+
+    def test_promised_hit(self):
+        pipe = Pipe(implementation_class=Memoized)
+        pipe.pump()
+        f = pipe.a.make_outbound_request(
+            {'method': 'fail_once', 'args': [0]})
+        pipe.pump()
+        assert isinstance(f.failed_with(), demo_protocol.RemoteError)
+        self.call(pipe, 'fail_once', 5)
+        pipe.pump()
+        f = pipe.a.make_outbound_request(
+            {'method': 'fail_once', 'args': [5]}, promise=True)
+        result = self.call(pipe, 'add', f, 1)
+        pipe.pump()
+        assert result == [6]
+        assert pipe.b.implementation.runs == 2  # The error wasn't cached.
+
+    def test_streams_are_not_cached(self):
+        pipe = Pipe(implementation_class=Memoized)
+        pipe.pump()
+        for _ in range(2):
+            result = self.call(pipe, 'numbers', 3)
+            pipe.pump()
+            [incoming] = result
+            assert read_all(pipe, incoming)[0] == [0, 1, 2]
+
+
+class TestCoalescing:
+
+    def make_pipe(self, **options):
+        pipe = Pipe(implementation_class=Adder, **options)
+        pipe.soon = []
+        for protocol in (pipe.a, pipe.b):
+            protocol.schedule_flush = pipe.soon.append
+        pipe.pump()  # Hellos
+        return pipe
+
+    def end_tick(self, pipe):
+        soon, pipe.soon[:] = list(pipe.soon), []
+        for function in soon:
+            function()
+
+    def test_responses_flush_together(self):
+        pipe = self.make_pipe()
+        results = []
+        for i in range(5):
+            pipe.a.make_outbound_request(
+                {'method': 'add', 'args': [i, 1]}).add_callback(results.append)
+        assert not pipe.queues[0]  # Nothing written until the tick ends.
+        assert pipe.a.unflushed_bytes
+        self.end_tick(pipe)
+        assert len(pipe.queues[0]) == 1
+        assert not pipe.a.unflushed_bytes
+        pipe.a_to_b()
+        # b answered the whole batch as it dispatched it, in one write.
+        assert len(pipe.queues[1]) == 1
+        pipe.b_to_a()
+        assert results == [1, 2, 3, 4, 5]
+
+    @pytest.mark.parametrize('batch_a, batch_b, frames', [
+        (True, True, 1),
+        (True, False, 5),
+        (False, True, 5),
+    ])
+    def test_batch_frames(self, monkeypatch, batch_a, batch_b, frames):
+        pipe = Pipe(implementation_class=Adder)
+        pipe.a.batch_frames = batch_a
+        pipe.b.batch_frames = batch_b
+        # Replace the hellos, as if the protocols had been made this way.
+        pipe.queues[0].clear()
+        pipe.queues[1].clear()
+        for protocol in (pipe.a, pipe.b):
+            protocol.send_control(
+                'hello', codecs=list(protocol.codecs),
+                batch=protocol.batch_frames)
+        pipe.pump()
+        pipe.a.schedule_flush = lambda function: None
+        parsed = []
+        parse = pipe.b.stream.parse
+        monkeypatch.setattr(pipe.b.stream, 'parse',
+                            lambda frame: parsed.append(1) or parse(frame))
+        results = []
+        for i in range(5):
+            pipe.a.make_outbound_request(
+                {'method': 'add', 'args': [i, 1]}).add_callback(results.append)
+        pipe.a.flush()
+        pipe.pump()
+        assert len(parsed) == frames
+        assert results == [1, 2, 3, 4, 5]
+
+    def test_flushes_at_threshold(self):
+        pipe = self.make_pipe(flow=demo_protocol.FlowControl(flush_bytes=80))
+        pipe.b.send_control('chunk', stream=1, data='x' * 20)
+        assert not pipe.queues[1]
+        pipe.b.send_control('chunk', stream=1, data='x' * 20)
+        assert len(pipe.queues[1]) == 1
+        assert not pipe.b.unflushed_bytes
+        self.end_tick(pipe)  # Nothing left to flush.
+        assert len(pipe.queues[1]) == 1
+
+    def test_connection_lost_drops_unflushed(self):
+        pipe = self.make_pipe()
+        f = pipe.a.make_outbound_request({'method': 'add', 'args': [1, 2]})
+        pipe.a.connection_lost()
+        assert not pipe.a.unflushed_bytes
+        self.end_tick(pipe)
+        assert not pipe.queues[0]
+        assert isinstance(f.failed_with(), ConnectionError)
+
+    def test_asyncio_writes_once_per_tick(self):
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            a, b = socket.socketpair()
+            factory = client_server_asyncio.ConnectionFactory(
+                client_server_asyncio.Protocol, asyncio.get_running_loop,
+                implementation_class=Adder)
+            _, client = await loop.create_connection(factory, sock=a)
+            _, server = await loop.connect_accepted_socket(factory, sock=b)
+            writes = []
+            write = client.protocol._writer
+            client.protocol._writer = \
+                lambda data: writes.append(data) or write(data)
+            writelines = client.protocol.writelines
+            client.protocol.writelines = \
+                lambda data: writes.append(data) or writelines(data)
+            try:
+                results = await asyncio.gather(*(
+                    client.make_outbound_request(
+                        {'method': 'add', 'args': [i, 1]})
+                    for i in range(10)))
+                return results, len(writes)
+            finally:
+                client.transport.close()
+                server.transport.close()
+
+        results, writes = asyncio.run(run())
+        assert results == list(range(1, 11))
+        assert writes == 1
+
+    def test_asyncio_frames_across_reads(self):
+        payload = bytes(range(256)) * 1024
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            a, b = socket.socketpair()
+            factory = client_server_asyncio.ConnectionFactory(
+                client_server_asyncio.Protocol, asyncio.get_running_loop,
+                codecs=('binary',), implementation_class=Adder)
+            _, client = await loop.create_connection(factory, sock=a)
+            _, server = await loop.connect_accepted_socket(factory, sock=b)
+            written = []
+            writelines = server.protocol.writelines
+            server.protocol.writelines = \
+                lambda data: written.extend(data) or writelines(data)
+            try:
+                # Wait for the hellos, so we send bytes in binary.
+                await client.make_outbound_request(
+                    {'method': 'add', 'args': [1, 2]})
+                results = await asyncio.gather(*(
+                    client.make_outbound_request(
+                        {'method': 'identity', 'args': [x]})
+                    for x in (payload, 1, payload[:1000], 2)))
+                return results, written
+            finally:
+                client.transport.close()
+                server.transport.close()
+
+        results, written = asyncio.run(run())
+        assert results == \
+            [payload, 1, payload[:1000], 2]
+        # The large response went out behind its header, uncopied.
+        assert any(len(data) > len(payload) for data in written)
+        assert any(len(data) == 3 for data in written)
+
+    def test_asyncio_closes_on_bad_input(self):
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            a, b = socket.socketpair()
+            a.setblocking(False)
+            factory = client_server_asyncio.ConnectionFactory(
+                client_server_asyncio.Protocol, asyncio.get_running_loop,
+                implementation_class=Adder)
+            _, server = await loop.connect_accepted_socket(factory, sock=b)
+            await loop.sock_sendall(a, stream.encode_varint(1 << 30))
+            received = b''
+            while True:
+                data = await asyncio.wait_for(loop.sock_recv(a, 4096), 5)
+                if not data:
+                    break
+                received += data
+            a.close()
+            return received, factory.connections
+
+        received, connections = asyncio.run(run())
+        assert received[1:2] == b'{'  # Only the server's hello.
+        assert not connections
@@ -0,0 +1,184 @@
+"""Method dispatch tables for implementation classes.
+
+Rather than looking methods up with getattr on every call, we inspect each
+implementation class once and build a DispatchTable of its public methods.
+A table maps method names, and compact integer ordinals, to MethodEntry
+objects which also record how the method delivers its result, so the
+protocol doesn't have to find out on every call.
+
+Ordinals are the positions of the method names in sorted order, so both
+ends of a connection agree on them as long as they use the same interface.
+
+Entries also record each method's execution policy (see cappy.offload),
+and hold the result cache of methods marked cacheable (see cappy.memo) and
+the vectorized form map calls use (see cappy.vector).
+"""
+import asyncio
+import inspect
+
+
+import cappy.future as future
+import cappy.memo as memo
+import cappy.offload as offload
+import cappy.vector as vector
+
+
+SYNC = 'sync'
+"""The method returns its result directly."""
+
+FUTURE = 'future'
+"""The method returns a future (cappy.future.Future or asyncio.Future)."""
+
+COROUTINE = 'coroutine'
+"""The method is a coroutine function and must be awaited."""
+
+
+class MethodEntry:
+    """One remotely callable method.
+
+    Attributes:
+        name (str): Method name.
+        ordinal (int): Position of name among the class's sorted methods.
+        function (function): The function, to be called with the target
+            object as its first argument.
+        kind (str): One of SYNC, FUTURE or COROUTINE.
+        policy (str): Where the method runs: offload.INLINE, THREAD or
+            PROCESS.
+        cache (memo.MethodCache): Results of earlier calls, if the method
+            is cacheable, otherwise None.
+        vector (MethodEntry): What map calls to the method call: its
+            vectorized form, or one calling it once per row, or None if
+            it can't be mapped.
+    """
+
+    __slots__ = ('name', 'ordinal', 'function', 'kind', 'policy', 'cache',
+                 'vector')
+
+    def __init__(self, name, ordinal, function, kind, policy=offload.INLINE,
+                 cache=None):
+        self.name = name
+        self.ordinal = ordinal
+        self.function = function
+        self.kind = kind
+        self.policy = policy
+        self.cache = cache
+        self.vector = None
+
+    def __repr__(self):
+        return "<MethodEntry {} #{} {} {}>".format(
+            self.name, self.ordinal, self.kind, self.policy)
+
+
+def method_kind(function):
+    """Work out whether function is sync, returns a future or is a coroutine.
+
+    A function returns a future if its return annotation is a future class.
+    """
+    if inspect.iscoroutinefunction(function):
+        return COROUTINE
+    annotation = inspect.signature(function).return_annotation
+    if isinstance(annotation, type) and \
+            issubclass(annotation, (future.Future, asyncio.Future)):
+        return FUTURE
+    return SYNC
+
+
+class DispatchTable:
+    """The remotely callable methods of one class.
+
+    Attributes:
+        cls (type): The class.
+        entries (list of MethodEntry): Entries indexed by ordinal.
+        by_name (dict): Method name -> MethodEntry.
+    """
+
+    def __init__(self, cls):
+        self.cls = cls
+        names = sorted(
+            name for name, value in inspect.getmembers(cls)
+            if not name.startswith('_') and inspect.isfunction(value))
+        self.entries = [self._make_entry(name, ordinal)
+                        for ordinal, name in enumerate(names)]
+        self.by_name = {entry.name: entry for entry in self.entries}
+        for entry in self.entries:
+            if entry.kind is SYNC and entry.policy is not offload.PROCESS:
+                entry.vector = MethodEntry(
+                    entry.name, entry.ordinal, vector.rowwise(entry.function),
+                    SYNC, entry.policy)
+        for name in names:
+            target = vector.vectorizes(getattr(cls, name))
+            if target is not None:
+                if target not in self.by_name:
+                    raise TypeError("{}.{} vectorizes {}, which isn't a method"
+                                    .format(cls.__name__, name, target))
+                self.by_name[target].vector = self.by_name[name]
+
+    def _make_entry(self, name, ordinal):
+        function = getattr(self.cls, name)
+        kind = method_kind(function)
+        policy = offload.policy_of(function)
+        static = isinstance(inspect.getattr_static(self.cls, name),
+                            staticmethod)
+        if policy is not offload.INLINE and kind is not SYNC:
+            raise TypeError("{}.{} returns a future so can't be offloaded"
+                            .format(self.cls.__name__, name))
+        if policy is offload.PROCESS and not static:
+            raise TypeError("{}.{} runs in a process pool so must be a "
+                            "staticmethod".format(self.cls.__name__, name))
+        cache = None
+        spec = memo.cache_spec(function)
+        if spec is not None:
+            cache = memo.MethodCache(
+                '{}.{}'.format(self.cls.__name__, name), *spec)
+        if static:
+            # Entries are called with the target object first.
+            function = _drop_target(function)
+        return MethodEntry(name, ordinal, function, kind, policy, cache)
+
+    def lookup_vector(self, method):
+        """Get the entry map calls to a method name or ordinal call.
+
+        Raises:
+            LookupError: There is no such method, or it can't be mapped.
+        """
+        entry = self.lookup(method).vector
+        if entry is None:
+            raise LookupError("{}.{} has no vectorized form".format(
+                self.cls.__name__, method))
+        return entry
+
+    def lookup(self, method):
+        """Get the entry for a method name or ordinal.
+
+        Raises:
+            LookupError: There is no such method.
+        """
+        try:
+            if type(method) is int:
+                if method < 0:
+                    raise IndexError(method)
+                return self.entries[method]
+            return self.by_name[method]
+        except (KeyError, IndexError, TypeError):
+            raise LookupError("{} has no method {!r}".format(
+                self.cls.__name__, method))
+
+    def ordinal(self, name):
+        return self.by_name[name].ordinal
+
+
+def _drop_target(function):
+    def call(obj, *args):
+        return function(*args)
+    return call
+
+
+_tables = {}
+
+
+def table_for(cls):
+    """Get the DispatchTable for cls, building it the first time."""
+    table = _tables.get(cls)
+    if table is None:
+        table = _tables[cls] = DispatchTable(cls)
+    return table
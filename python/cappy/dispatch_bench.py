@@ -0,0 +1,126 @@
+"""Measure per-call overhead of inbound request dispatch.
+
+Compares the original getattr-based method lookup and
+handle_inbound_request with dispatch through the compiled DispatchTable.
+Responses are encoded but thrown away, so the numbers are protocol overhead
+only. The original asyncio handler used asyncio.coroutine, which no longer
+exists, so only the new asyncio path is timed.
+
+Run from the python directory:
+```
+python -m cappy.dispatch_bench
+```
+"""
+import argparse
+import asyncio
+import time
+
+
+import cappy.client_server_asyncio as client_server_asyncio
+import cappy.dispatch as dispatch
+from cappy.future import Future, call_as_future
+import cappy.server_futures as server_futures
+
+
+class Adder:
+
+    def __init__(self, outbound_requester):
+        pass
+
+    def add(self, x, y):
+        return x + y
+
+
+class AsyncAdder(Adder):
+
+    async def add(self, x, y):
+        return x + y
+
+
+def original_handle_inbound_request(protocol, message):
+    """server_futures.Protocol.handle_inbound_request as it used to be."""
+    message_id = message['id']
+    method_name = message['method']
+    args = message['args']
+    if not isinstance(args, (tuple, list)):
+        args = (args,)
+    method = getattr(protocol.implementation, method_name)
+    future = call_as_future(method, *args)
+    def callback(result):
+        response = {'id': -message_id, 'result': result}
+        protocol.write(protocol.stream.pack_message(response))
+    future.add_callback(callback)
+
+
+def time_calls(func, n):
+    t0 = time.perf_counter()
+    for i in range(n):
+        func({'id': i + 1, 'method': 'add', 'args': [i, 1]})
+    return (time.perf_counter() - t0) / n
+
+
+async def time_asyncio_calls(protocol, n):
+    t0 = time.perf_counter()
+    for i in range(n):
+        protocol.dispatch([{'id': i + 1, 'method': 'add', 'args': [i, 1]}])
+    # Let any tasks run to completion.
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    return (time.perf_counter() - t0) / n
+
+
+def time_lookup_getattr(implementation, n):
+    message = {'method': 'add', 'args': [1, 2]}
+    t0 = time.perf_counter()
+    for _ in range(n):
+        args = message['args']
+        if not isinstance(args, (tuple, list)):
+            args = (args,)
+        getattr(implementation, message['method'])(*args)
+    return (time.perf_counter() - t0) / n
+
+
+def time_lookup_table(implementation, n):
+    message = {'method': 'add', 'args': [1, 2]}
+    table = dispatch.table_for(type(implementation))
+    t0 = time.perf_counter()
+    for _ in range(n):
+        args = message['args']
+        if type(args) is not list:
+            args = [args]
+        table.lookup(message['method']).function(implementation, *args)
+    return (time.perf_counter() - t0) / n
+
+
+def report(label, seconds):
+    print("{:<40} {:>8.2f} us/call".format(label, 1e6 * seconds))
+
+
+def main(n):
+    report("lookup and call: getattr + isinstance",
+           time_lookup_getattr(Adder(None), n))
+    report("lookup and call: dispatch table",
+           time_lookup_table(Adder(None), n))
+    protocol = server_futures.Protocol(lambda data: None, Future, Adder)
+    report("futures: getattr (original)",
+           time_calls(lambda m: original_handle_inbound_request(protocol, m), n))
+    report("futures: dispatch table",
+           time_calls(lambda m: protocol.dispatch([m]), n))
+
+    async def run_asyncio(implementation_class):
+        protocol = client_server_asyncio.Protocol(
+            lambda data: None, asyncio.Future, implementation_class)
+        return await time_asyncio_calls(protocol, n)
+
+    report("asyncio: dispatch table, sync method",
+           asyncio.run(run_asyncio(Adder)))
+    report("asyncio: dispatch table, coroutine",
+           asyncio.run(run_asyncio(AsyncAdder)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Dispatch benchmark')
+    parser.add_argument('--calls', type=int, default=100000,
+                        help="Number of calls to time")
+    args = parser.parse_args()
+    main(args.calls)
@@ -0,0 +1,114 @@
+import asyncio
+
+
+import pytest
+
+
+import cappy.dispatch as dispatch
+from cappy.future import Future
+import cappy.offload as offload
+
+
+class Service:
+
+    def plain(self, x):
+        return x
+
+    def deferred(self) -> Future:
+        return Future()
+
+    def deferred_asyncio(self) -> asyncio.Future:
+        pass
+
+    async def coroutine(self):
+        pass
+
+    def _private(self):
+        pass
+
+    attribute = 3
+
+
+def test_kinds():
+    table = dispatch.DispatchTable(Service)
+    kinds = {entry.name: entry.kind for entry in table.entries}
+    assert kinds == {
+        'coroutine': dispatch.COROUTINE,
+        'deferred': dispatch.FUTURE,
+        'deferred_asyncio': dispatch.FUTURE,
+        'plain': dispatch.SYNC,
+    }
+
+
+def test_lookup_by_name_and_ordinal():
+    table = dispatch.DispatchTable(Service)
+    entry = table.lookup('plain')
+    assert table.lookup(entry.ordinal) is entry
+    assert entry.function(Service(), 5) == 5
+
+
+@pytest.mark.parametrize('method', ['missing', '_private', 'attribute', -1, 4])
+def test_unknown_method(method):
+    with pytest.raises(LookupError):
+        dispatch.DispatchTable(Service).lookup(method)
+
+
+def test_table_is_cached():
+    assert dispatch.table_for(Service) is dispatch.table_for(Service)
+
+
+class Offloaded:
+
+    @offload.in_thread
+    def blocking(self, x):
+        return x
+
+    @staticmethod
+    @offload.in_process
+    def crunch(x):
+        return x * 2
+
+    @staticmethod
+    def helper(x):
+        return x + 1
+
+
+def test_policies():
+    table = dispatch.DispatchTable(Offloaded)
+    policies = {entry.name: entry.policy for entry in table.entries}
+    assert policies == {
+        'blocking': offload.THREAD,
+        'crunch': offload.PROCESS,
+        'helper': offload.INLINE,
+    }
+    assert dispatch.DispatchTable(Service).lookup('plain').policy is \
+        offload.INLINE
+
+
+def test_staticmethods_are_called_without_target():
+    table = dispatch.DispatchTable(Offloaded)
+    obj = Offloaded()
+    assert table.lookup('helper').function(obj, 1) == 2
+    assert table.lookup('crunch').function(obj, 3) == 6
+
+
+def test_process_methods_must_be_static():
+
+    class Bad:
+        @offload.in_process
+        def crunch(self, x):
+            return x
+
+    with pytest.raises(TypeError):
+        dispatch.DispatchTable(Bad)
+
+
+def test_future_methods_cannot_be_offloaded():
+
+    class Bad:
+        @offload.in_thread
+        def deferred(self) -> Future:
+            return Future()
+
+    with pytest.raises(TypeError):
+        dispatch.DispatchTable(Bad)
@@ -0,0 +1,132 @@
+"""Where servers listen and clients connect, given as URLs.
+
+- tcp://host:port: TCP. host may be a name, an IPv4 address, or an IPv6
+  address in brackets.
+- unix:///path/to/socket: A unix domain socket. For peers on the same
+  host this skips the TCP/IP stack, so costs less per message than TCP
+  loopback.
+- shm:///path/to/socket: Shared memory, meeting peers on a unix socket at
+  the path; see cappy.shm.
+- socketpair://: A connected pair of unix sockets in one process, for tests
+  and colocated services. There is nothing to listen on, so use
+  connect_pair rather than listen.
+
+Servers listen before they fork workers, so the workers share each
+listening socket:
+
+```
+listeners = []
+for url in urls:
+    endpoint = endpoints.parse(url)
+    listeners.append((endpoint, endpoints.listen(endpoint)))
+```
+"""
+import asyncio
+import collections
+import os
+import socket
+import urllib.parse
+
+
+import cappy.shm as shm
+from cappy.workers import get_listen_socket, get_unix_listen_socket
+
+
+Endpoint = collections.namedtuple('Endpoint', ['scheme', 'host', 'port',
+                                               'path'])
+Endpoint.__doc__ = """A parsed URL; fields a scheme doesn't use are None."""
+
+SCHEMES = ('tcp', 'unix', 'shm', 'socketpair')
+
+
+def parse(url):
+    """Parse a URL in one of the forms above.
+
+    Raises:
+        ValueError: If url isn't one of them.
+    """
+    scheme, sep, rest = url.partition('://')
+    if not sep or scheme not in SCHEMES:
+        raise ValueError("Expected {}://..., not {!r}".format(
+            '|'.join(SCHEMES), url))
+    if scheme == 'tcp':
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port  # Raises ValueError if it isn't a number.
+        if not parts.hostname or port is None or parts.path:
+            raise ValueError("Expected tcp://host:port, not {!r}".format(url))
+        return Endpoint(scheme, parts.hostname, port, None)
+    if scheme == 'socketpair':
+        if rest:
+            raise ValueError("Expected socketpair://, not {!r}".format(url))
+        return Endpoint(scheme, None, None, None)
+    if not rest:
+        raise ValueError("Expected {}://path, not {!r}".format(scheme, url))
+    return Endpoint(scheme, None, None, rest)
+
+
+def listen(endpoint, backlog=128, reuse_port=False):
+    """Get a socket listening at endpoint."""
+    if endpoint.scheme == 'tcp':
+        return get_listen_socket(
+            endpoint.host, endpoint.port, backlog, reuse_port)
+    if endpoint.scheme in ('unix', 'shm'):
+        return get_unix_listen_socket(endpoint.path, backlog)
+    raise ValueError("Can't listen on {}://".format(endpoint.scheme))
+
+
+def close_listener(endpoint, sock):
+    """Close a socket from listen, removing its socket file if it has one."""
+    sock.close()
+    if endpoint.path is not None:
+        try:
+            os.unlink(endpoint.path)
+        except FileNotFoundError:
+            pass
+
+
+async def start_server(protocol_factory, endpoint, sock):
+    """Serve connections on sock, which listen made for endpoint.
+
+    Returns:
+        An object with a close method, which stops accepting connections.
+    """
+    if endpoint.scheme == 'shm':
+        return await shm.start_server(protocol_factory, sock=sock)
+    return await asyncio.get_running_loop().create_server(
+        protocol_factory, sock=sock)
+
+
+async def open_connection(protocol_factory, endpoint):
+    """Connect to a server at endpoint.
+
+    Returns:
+        (transport, protocol)
+    """
+    loop = asyncio.get_running_loop()
+    if endpoint.scheme == 'tcp':
+        return await loop.create_connection(
+            protocol_factory, endpoint.host, endpoint.port)
+    if endpoint.scheme == 'unix':
+        return await loop.create_unix_connection(
+            protocol_factory, endpoint.path)
+    if endpoint.scheme == 'shm':
+        return await shm.connect(protocol_factory, endpoint.path)
+    raise ValueError("Can't connect to {}://; use connect_pair".format(
+        endpoint.scheme))
+
+
+async def connect_pair(server_factory, client_factory):
+    """Connect a client to a server in this process through a socketpair.
+
+    Returns:
+        (transport, protocol): The client's.
+    """
+    loop = asyncio.get_running_loop()
+    server_sock, client_sock = socket.socketpair()
+    try:
+        await loop.connect_accepted_socket(server_factory, sock=server_sock)
+    except:
+        server_sock.close()
+        client_sock.close()
+        raise
+    return await loop.connect_accepted_socket(client_factory, sock=client_sock)
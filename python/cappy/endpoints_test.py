@@ -0,0 +1,107 @@
+import asyncio
+import os
+
+
+import pytest
+
+
+import cappy.client_server_asyncio as client_server_asyncio
+import cappy.endpoints as endpoints
+
+
+@pytest.mark.parametrize('url, expected', [
+    ('tcp://localhost:12344', ('tcp', 'localhost', 12344, None)),
+    ('tcp://[::1]:80', ('tcp', '::1', 80, None)),
+    ('unix:///tmp/cappy.sock', ('unix', None, None, '/tmp/cappy.sock')),
+    ('shm://cappy.shm', ('shm', None, None, 'cappy.shm')),
+    ('socketpair://', ('socketpair', None, None, None)),
+])
+def test_parse(url, expected):
+    assert endpoints.parse(url) == expected
+
+
+@pytest.mark.parametrize('url', [
+    'localhost:12344', 'udp://localhost:1', 'tcp://localhost',
+    'tcp://localhost:http', 'tcp://:1', 'tcp://localhost:1/x', 'unix://',
+    'socketpair://x',
+])
+def test_parse_rejects(url):
+    with pytest.raises(ValueError):
+        endpoints.parse(url)
+
+
+def test_cant_listen_on_socketpair():
+    with pytest.raises(ValueError):
+        endpoints.listen(endpoints.parse('socketpair://'))
+
+
+def test_listen_replaces_stale_socket(tmp_path):
+    endpoint = endpoints.parse('unix://{}'.format(tmp_path / 'cappy.sock'))
+    first = endpoints.listen(endpoint)
+    first.close()  # Leaves the socket file behind.
+    sock = endpoints.listen(endpoint)
+    assert os.path.exists(endpoint.path)
+    endpoints.close_listener(endpoint, sock)
+    assert not os.path.exists(endpoint.path)
+
+
+def test_listen_keeps_other_files(tmp_path):
+    path = tmp_path / 'not-a-socket'
+    path.write_text('data')
+    with pytest.raises(OSError):
+        endpoints.listen(endpoints.parse('unix://{}'.format(path)))
+    assert path.read_text() == 'data'
+
+
+def echo_twice(connect):
+    """Connect with connect(server_factory, client_factory) and echo."""
+
+    async def run():
+        server_factory = client_server_asyncio.ConnectionFactory(
+            client_server_asyncio.Protocol, asyncio.get_running_loop)
+        client_factory = client_server_asyncio.ConnectionFactory(
+            client_server_asyncio.Protocol, asyncio.get_running_loop)
+        closers = []
+        try:
+            transport, connection = await connect(
+                server_factory, client_factory, closers)
+            try:
+                return [await connection.make_outbound_request(
+                    {'method': 'echo', 'args': [x]}) for x in ('a', 'b')]
+            finally:
+                transport.close()
+        finally:
+            for close in reversed(closers):
+                close()
+            await server_factory.drain(1)
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize('scheme', ['tcp', 'unix', 'shm'])
+def test_round_trip(tmp_path, scheme):
+    if scheme == 'tcp':
+        endpoint = endpoints.parse('tcp://127.0.0.1:0')
+    else:
+        endpoint = endpoints.parse('{}://{}'.format(
+            scheme, tmp_path / 'cappy.sock'))
+
+    async def connect(server_factory, client_factory, closers):
+        nonlocal endpoint
+        sock = endpoints.listen(endpoint)
+        closers.append(lambda: endpoints.close_listener(endpoint, sock))
+        server = await endpoints.start_server(server_factory, endpoint, sock)
+        closers.append(server.close)
+        if scheme == 'tcp':
+            endpoint = endpoint._replace(port=sock.getsockname()[1])
+        return await endpoints.open_connection(client_factory, endpoint)
+
+    assert echo_twice(connect) == ['a', 'b']
+
+
+def test_connect_pair():
+
+    async def connect(server_factory, client_factory, closers):
+        return await endpoints.connect_pair(server_factory, client_factory)
+
+    assert echo_twice(connect) == ['a', 'b']
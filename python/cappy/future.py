@@ -1,36 +1,199 @@
+import collections
+
+
+class CancelledError(Exception):
+    """The Future was cancelled."""
+
+
+class _Resume:
+    """Callback entry which hands a Future's result to a waiting Future.
+
+    When a callback returns a Future which hasn't fired yet, the Future whose
+    callback it was (the parent) stops running callbacks and puts one of these
+    on the returned Future. _run_callbacks recognizes it and switches to the
+    parent's callbacks in the same loop, rather than calling into the parent,
+    so chains of any depth run without recursion.
+    """
+
+    __slots__ = ('parent',)
+
+    def __init__(self, parent):
+        self.parent = parent
+
+
 class Future:
-    def __init__(self):
-        self.callbacks = []
-        self._fired = False
+    """A result which may not be available yet.
+
+    Callbacks form a chain: each callback is called with the current result,
+    and what it returns becomes the result passed to the next one. If a
+    callback returns a Future, the chain waits for that Future and carries on
+    with its result.
+
+    A Future can also fail, with set_exception. A failed chain skips
+    callbacks and calls errbacks instead, with the exception. A callback or
+    errback which raises (or returns an exception) fails the chain; an
+    errback which returns anything else recovers it.
+
+    Attributes:
+        callbacks (deque): Pending (callback, errback) pairs.
+        result: The current result, or the exception if we failed.
+    """
+
+    __slots__ = ('callbacks', 'result', '_fired', '_failed', '_paused',
+                 '_running', '_scheduler', '_canceller')
+
+    def __init__(self, scheduler=None, canceller=None):
+        """Make a Future.
+
+        Args:
+            scheduler (function): If given, callbacks don't run inline when
+                we fire. Instead we call scheduler(f) with a function f which
+                runs them, e.g. Reactor.call_soon.
+            canceller (function): Called with this Future if it is cancelled
+                before it fires.
+        """
+        self.callbacks = collections.deque()
         self.result = None
+        self._fired = False
+        self._failed = False
+        self._paused = False
+        self._running = False
+        self._scheduler = scheduler
+        self._canceller = canceller
 
-    def add_callback(self, callback):
-        self.callbacks.append(callback)
+    @classmethod
+    def succeeded(cls, result=None):
+        """Get a Future which has already fired with result."""
+        f = cls()
+        f._fired = True
+        f.result = result
+        return f
+
+    @classmethod
+    def failed(cls, exception):
+        """Get a Future which has already failed with exception."""
+        f = cls()
+        f._fired = True
+        f._failed = True
+        f.result = exception
+        return f
+
+    def done(self):
+        return self._fired
+
+    def failed_with(self):
+        """Get our exception if we have failed, otherwise None."""
+        return self.result if self._failed else None
+
+    def add_callbacks(self, callback, errback=None):
+        self.callbacks.append((callback, errback))
         if self._fired:
-            self._execute_callbacks(self.result)
+            self._kick()
+
+    def add_callback(self, callback):
+        self.add_callbacks(callback, None)
+
+    def add_errback(self, errback):
+        self.add_callbacks(None, errback)
+
+    def add_both(self, callback):
+        self.add_callbacks(callback, callback)
 
     def set_result(self, result=None):
-        if self._fired == True:
+        self._fire(result, False)
+
+    def set_exception(self, exception):
+        self._fire(exception, True)
+
+    def cancel(self):
+        """Cancel the Future if it hasn't fired yet.
+
+        Returns:
+            bool: True if we were cancelled.
+        """
+        if self._fired:
+            return False
+        if self._canceller is not None:
+            self._canceller(self)
+        if not self._fired:
+            self.set_exception(CancelledError())
+        return True
+
+    def _fire(self, result, failed):
+        if self._fired:
             raise RuntimeError("Cannot fire Future twice")
         self._fired = True
-        self._execute_callbacks(result)
-
-    def _execute_callbacks(self, result):
         self.result = result
-        while len(self.callbacks):
-            cb = self.callbacks.pop(0)
-            self.result = cb(self.result)
-            if isinstance(self.result, Future):
-                self.result.add_callback(self._execute_callbacks)
-                break
+        self._failed = failed
+        self._kick()
+
+    def _kick(self):
+        if self._running or self._paused:
+            return
+        if self._scheduler is not None:
+            self._scheduler(self._run_callbacks)
+        else:
+            self._run_callbacks()
+
+    def _run_callbacks(self):
+        if self._running or self._paused:
+            return
+        stack = [self]
+        self._running = True
+        while stack:
+            current = stack[-1]
+            callbacks = current.callbacks
+            while callbacks and not current._paused:
+                callback, errback = callbacks.popleft()
+                if type(callback) is _Resume:
+                    parent = callback.parent
+                    parent.result = current.result
+                    parent._failed = current._failed
+                    parent._paused = False
+                    if not callbacks:
+                        # Nothing more to do here, so don't let the stack
+                        # grow with the depth of the chain.
+                        current._running = False
+                        stack.pop()
+                    parent._running = True
+                    stack.append(parent)
+                    break
+                func = errback if current._failed else callback
+                if func is None:
+                    continue
+                try:
+                    result = func(current.result)
+                except Exception as e:
+                    result = e
+                current._failed = isinstance(result, Exception)
+                if type(result) is Future or isinstance(result, Future):
+                    if result is current:
+                        current.result = RuntimeError(
+                            "Callback returned its own Future")
+                        current._failed = True
+                    elif result._fired and not result._paused and \
+                            not result._running:
+                        current.result = result.result
+                        current._failed = result._failed
+                    else:
+                        current._paused = True
+                        result.callbacks.append((_Resume(current), None))
+                else:
+                    current.result = result
+            else:
+                current._running = False
+                stack.pop()
 
 
 def call_as_future(func, *args):
-    result = func(*args)
+    """Call func and get its result as a Future.
+
+    If func raises, the Future has failed with the exception.
+    """
+    try:
+        result = func(*args)
+    except Exception as e:
+        return Future.failed(e)
     if isinstance(result, Future):
         return result
-    else:
-        f = Future()
-        f.set_result(result)
-        return f
-
+    return Future.succeeded(result)
@@ -52,3 +52,78 @@ def test_late_callback():
     f.add_callback(callback)
     assert f.result == 9
 
+
+
+def test_errback():
+    f = future.Future()
+    seen = []
+    f.add_callback(lambda x: seen.append('callback'))
+    f.add_errback(lambda e: seen.append(e) or 'recovered')
+    f.add_callback(lambda x: seen.append(x))
+    error = ValueError()
+    f.set_exception(error)
+    assert seen == [error, 'recovered']
+
+
+def test_raising_callback_fails_chain():
+    f = future.Future()
+    def boom(x):
+        raise KeyError(x)
+    f.add_callback(boom)
+    seen = []
+    f.add_errback(lambda e: seen.append(e) or e)
+    f.set_result(1)
+    assert isinstance(seen[0], KeyError)
+    assert f.failed_with() is seen[0]
+
+
+def test_cancel():
+    cancelled = []
+    f = future.Future(canceller=cancelled.append)
+    seen = []
+    f.add_errback(seen.append)
+    assert f.cancel()
+    assert cancelled == [f]
+    assert isinstance(seen[0], future.CancelledError)
+    assert not f.cancel()
+
+
+def test_deep_chain_does_not_recurse():
+    # Each Future's callback returns the next one, and each fires (and so
+    # waits on the next) before the last one fires.
+    n = 100000
+    futures = [future.Future() for _ in range(n + 1)]
+    for f, nxt in zip(futures, futures[1:]):
+        f.add_callback(lambda x, nxt=nxt: nxt)
+    futures[-1].add_callback(lambda x: x + 1)
+    for f in futures[:-1]:
+        f.set_result(None)
+    futures[-1].set_result(41)
+    assert futures[0].result == 42
+
+
+def test_deep_chain_of_fired_futures():
+    f = future.Future()
+    for i in range(100000):
+        f.add_callback(lambda x: future.Future.succeeded(x + 1))
+    f.set_result(0)
+    assert f.result == 100000
+
+
+def test_scheduler():
+    scheduled = []
+    f = future.Future(scheduler=scheduled.append)
+    seen = []
+    f.add_callback(seen.append)
+    f.set_result(3)
+    assert seen == []
+    scheduled.pop()()
+    assert seen == [3]
+
+
+def test_call_as_future_fast_path():
+    f = future.call_as_future(lambda x: x * 2, 4)
+    assert f.done()
+    assert f.result == 8
+    f = future.call_as_future(lambda: 1 / 0)
+    assert isinstance(f.failed_with(), ZeroDivisionError)
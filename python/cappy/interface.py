@@ -0,0 +1,303 @@
+"""Codecs compiled from interfaces.
+
+register reads the public methods of an interface class, typically an ABC
+like calculator.Calculator, and makes a message parser specialized for it
+(see cappy.stream), which both ends of a connection offer in their hellos
+like any other codec:
+
+```
+codecs = (interface.register(Calculator),) + demo_protocol.DEFAULT_CODECS
+```
+
+Argument types come from the methods' annotations, or from a schema
+mapping method names to (argument types, result type). Methods whose
+arguments are all int, float, bool, str or bytes are compiled: a request
+to one is sent as the method's ordinal, the request id and the arguments,
+packed by a struct.Struct made for that method, with the contents of
+strings and bytes after the fixed fields. Decoding unpacks those fields
+straight into the message, with no tags to read or names to compare.
+
+When we send a response we don't know which method it answers, so plain
+results use one of a few fixed layouts, picked by the result's type.
+
+Everything else (control messages, errors, requests to other methods or
+with arguments of other types, promises and capabilities) is flattened by
+stream.BinaryParser as usual. Its frames have their own marker, so the
+peer decodes them as it would anyway.
+
+Both ends must register the same interface. The codec's name includes a
+fingerprint of the methods and their types, so a peer with a different
+version of the interface doesn't offer the same codec, and the connection
+falls back to a generic one. Interface codecs share a marker byte, so a
+connection can only use one.
+"""
+import hashlib
+import inspect
+import struct
+import typing
+
+
+import cappy.stream as stream
+
+
+MARKER = 0x02
+BATCH_MARKER = 0x03
+
+_REQUEST = 0x00
+_INT = 0x01
+_FLOAT = 0x02
+_BOOL = 0x03
+_NONE = 0x04
+_STR = 0x05
+_BYTES = 0x06
+
+# Struct format of each argument type. str and bytes are variable length;
+# the fixed fields hold their lengths.
+_FORMATS = {int: 'q', float: 'd', bool: '?', str: 'I', bytes: 'I'}
+
+_REQUEST_HEAD = '>BHq'  # Kind, method ordinal, id
+_RESPONSE_HEAD = '>Bq'  # Kind (the result's type), id
+
+_RESULT_KINDS = {int: _INT, float: _FLOAT, bool: _BOOL, type(None): _NONE,
+                 str: _STR, bytes: _BYTES}
+_RESULT_FORMATS = {_INT: 'q', _FLOAT: 'd', _BOOL: '?', _NONE: '',
+                   _STR: 'I', _BYTES: 'I'}
+
+
+class CompiledMethod:
+    """How requests to one method are packed.
+
+    Attributes:
+        name (str): Method name.
+        ordinal (int): Position of name among the interface's sorted
+            methods.
+        types (list of type): Argument types.
+        pack (struct.Struct): Packs the marker, request head and fixed
+            argument fields.
+        unpack (struct.Struct): The same fields without the marker.
+        variable (tuple of (int, type)): Indices and types of the str and
+            bytes arguments.
+    """
+
+    __slots__ = ('name', 'ordinal', 'types', 'pack', 'unpack', 'variable')
+
+    def __init__(self, name, ordinal, types):
+        self.name = name
+        self.ordinal = ordinal
+        self.types = list(types)
+        fields = ''.join(_FORMATS[t] for t in types)
+        self.pack = struct.Struct('>B' + _REQUEST_HEAD[1:] + fields)
+        self.unpack = struct.Struct(_REQUEST_HEAD + fields)
+        self.variable = tuple((i, t) for i, t in enumerate(types)
+                              if t is str or t is bytes)
+
+
+_RESULT_PACK = {kind: struct.Struct('>B' + _RESPONSE_HEAD[1:] + fmt)
+                for kind, fmt in _RESULT_FORMATS.items()}
+_RESULT_UNPACK = {kind: struct.Struct(_RESPONSE_HEAD + fmt)
+                  for kind, fmt in _RESULT_FORMATS.items()}
+_KIND = struct.Struct('>B')
+
+
+class InterfaceParser:
+    """Base class of the parsers register makes; see the module docstring.
+
+    Attributes:
+        methods (dict): Method name -> CompiledMethod, for the compiled ones.
+        by_ordinal (list): CompiledMethod, or None, by method ordinal.
+    """
+
+    name = None
+    marker = MARKER
+    batch_marker = BATCH_MARKER
+    methods = {}
+    by_ordinal = []
+
+    def __init__(self):
+        self.fallback = stream.BinaryParser()
+
+    def flatten(self, message):
+        message_id = message['id']
+        try:
+            if message_id > 0:
+                if len(message) == 3:
+                    method = self.methods.get(message['method'])
+                    args = message['args']
+                    if method is not None and type(args) is list and \
+                            list(map(type, args)) == method.types:
+                        return self._pack_request(method, message_id, args)
+            elif message_id < 0 and len(message) == 2 and 'result' in message:
+                result = message['result']
+                kind = _RESULT_KINDS.get(type(result))
+                if kind is not None:
+                    return self._pack_result(kind, message_id, result)
+        except (struct.error, TypeError):
+            pass  # Out of range for its field, or an unhashable method.
+        return self.fallback.flatten(message)
+
+    @staticmethod
+    def _pack_request(method, message_id, args):
+        if not method.variable:
+            return method.pack.pack(MARKER, _REQUEST, method.ordinal,
+                                    message_id, *args)
+        fields = list(args)
+        tail = []
+        for index, t in method.variable:
+            data = fields[index]
+            if t is str:
+                data = data.encode('utf-8')
+            fields[index] = len(data)
+            tail.append(data)
+        return method.pack.pack(MARKER, _REQUEST, method.ordinal, message_id,
+                                *fields) + b''.join(tail)
+
+    @staticmethod
+    def _pack_result(kind, message_id, result):
+        packer = _RESULT_PACK[kind]
+        if kind == _NONE:
+            return packer.pack(MARKER, kind, message_id)
+        if kind == _STR or kind == _BYTES:
+            data = result.encode('utf-8') if kind == _STR else result
+            return packer.pack(MARKER, kind, message_id, len(data)) + data
+        return packer.pack(MARKER, kind, message_id, result)
+
+    def join(self, payloads):
+        """Make a batch frame: the payloads back to back, without their
+        markers, since each says how long it is."""
+        out = bytearray(_KIND.pack(BATCH_MARKER))
+        for payload in payloads:
+            out += memoryview(payload)[1:]
+        return bytes(out)
+
+    def parse(self, data):
+        data = bytes(data)
+        if data[0] == BATCH_MARKER:
+            messages = []
+            offset = 1
+            while offset < len(data):
+                message, offset = self._decode(data, offset)
+                messages.append(message)
+            return messages
+        message, offset = self._decode(data, 1)
+        if offset != len(data):
+            raise ValueError(
+                "{} trailing bytes after message".format(len(data) - offset))
+        return message
+
+    def _decode(self, data, offset):
+        """Decode the message at data[offset:], just past a marker.
+
+        Returns:
+            (dict, int): The message, and the offset just past it.
+        """
+        kind = data[offset]
+        if kind == _REQUEST:
+            ordinal = (data[offset + 1] << 8) | data[offset + 2]
+            try:
+                method = self.by_ordinal[ordinal]
+            except IndexError:
+                method = None
+            if method is None:
+                raise ValueError("No compiled method #{}".format(ordinal))
+            fields = method.unpack.unpack_from(data, offset)
+            offset += method.unpack.size
+            args = list(fields[3:])
+            for index, t in method.variable:
+                end = offset + args[index]
+                if end > len(data):
+                    raise ValueError("Truncated argument")
+                args[index] = data[offset:end].decode('utf-8') \
+                    if t is str else data[offset:end]
+                offset = end
+            return {'id': fields[2], 'method': method.name,
+                    'args': args}, offset
+        unpacker = _RESULT_UNPACK.get(kind)
+        if unpacker is None:
+            raise ValueError("Unknown interface message kind 0x{:02x}".format(
+                kind))
+        fields = unpacker.unpack_from(data, offset)
+        offset += unpacker.size
+        if kind == _NONE:
+            result = None
+        elif kind == _STR or kind == _BYTES:
+            end = offset + fields[2]
+            if end > len(data):
+                raise ValueError("Truncated result")
+            result = data[offset:end]
+            if kind == _STR:
+                result = result.decode('utf-8')
+            offset = end
+        else:
+            result = fields[2]
+        return {'id': fields[1], 'result': result}, offset
+
+
+def _signature_types(cls, name, schema):
+    """Get (argument types, result type) of method name, or None if it
+    can't be compiled."""
+    if name in schema:
+        arg_types, result_type = schema[name]
+        return tuple(arg_types), result_type
+    function = getattr(cls, name)
+    try:
+        hints = typing.get_type_hints(function)
+    except (NameError, TypeError):
+        return None
+    params = list(inspect.signature(function).parameters.values())
+    if not isinstance(inspect.getattr_static(cls, name), staticmethod):
+        params = params[1:]  # self
+    arg_types = []
+    for param in params:
+        if param.kind not in (param.POSITIONAL_ONLY,
+                              param.POSITIONAL_OR_KEYWORD):
+            return None
+        arg_types.append(hints.get(param.name))
+    return tuple(arg_types), hints.get('return')
+
+
+def compile_interface(cls, schema=None):
+    """Make a parser class for the interface cls; see the module docstring.
+
+    Args:
+        cls (type): The interface. Its public methods, sorted by name, get
+            ordinals.
+        schema (dict): Method name -> (argument types, result type), for
+            methods to compile without reading their annotations.
+
+    Returns:
+        A subclass of InterfaceParser.
+    """
+    schema = schema or {}
+    names = sorted(
+        name for name, value in inspect.getmembers(cls)
+        if not name.startswith('_') and inspect.isfunction(value))
+    methods = {}
+    by_ordinal = []
+    description = []
+    for ordinal, name in enumerate(names):
+        types = _signature_types(cls, name, schema)
+        method = None
+        if types is not None and all(t in _FORMATS for t in types[0]):
+            method = CompiledMethod(name, ordinal, types[0])
+            methods[name] = method
+            description.append((name, [t.__name__ for t in types[0]]))
+        else:
+            description.append((name, None))
+        by_ordinal.append(method)
+    fingerprint = hashlib.sha256(repr(description).encode()).hexdigest()
+    return type(cls.__name__ + 'Parser', (InterfaceParser,), {
+        'name': '{}-{}'.format(cls.__name__.lower(), fingerprint[:8]),
+        'methods': methods,
+        'by_ordinal': by_ordinal,
+    })
+
+
+def register(cls, schema=None):
+    """Compile the interface cls and add its parser to stream.PARSERS.
+
+    Returns:
+        (str) The codec's name, to offer in a connection's codecs.
+    """
+    parser_class = compile_interface(cls, schema)
+    stream.PARSERS.setdefault(parser_class.name, parser_class)
+    return parser_class.name
@@ -0,0 +1,148 @@
+from abc import ABCMeta, abstractmethod
+
+
+import pytest
+
+
+from cappy.future import Future
+import cappy.calculator as calculator
+import cappy.interface as interface
+import cappy.server_futures as server_futures
+import cappy.stream as stream
+
+
+CODEC, _ = calculator.register_codecs()
+
+
+class Shapes(metaclass=ABCMeta):
+
+    def __init__(self, outbound_requester):
+        pass
+
+    @abstractmethod
+    def area(self, width: float, height: float) -> float:
+        pass
+
+    def label(self, name: str, data: bytes, flag: bool) -> str:
+        return '{}:{}:{}'.format(name, len(data), flag)
+
+    def anything(self, x):
+        return x
+
+
+Parser = interface.compile_interface(Shapes)
+
+
+@pytest.fixture
+def parser():
+    return Parser()
+
+
+def test_compiles_annotated_methods():
+    assert Parser.name.startswith('shapes-')
+    assert [m and m.name for m in Parser.by_ordinal] == [
+        None, 'area', 'label']
+    assert Parser.methods['label'].types == [str, bytes, bool]
+
+
+def test_fingerprint_follows_types():
+    schema = {'area': ((int, int), int)}
+    assert interface.compile_interface(Shapes, schema).name != Parser.name
+    assert interface.compile_interface(Shapes).name == Parser.name
+
+
+@pytest.mark.parametrize('message', [
+    {'id': 1, 'method': 'area', 'args': [2.5, 4.0]},
+    {'id': 1 << 40, 'method': 'label', 'args': ['né', b'\x00\x01', True]},
+    {'id': -3, 'result': 10.0},
+    {'id': -3, 'result': -(1 << 62)},
+    {'id': -3, 'result': False},
+    {'id': -3, 'result': None},
+    {'id': -3, 'result': 'café'},
+    {'id': -3, 'result': b'raw'},
+])
+def test_compiled_round_trip(parser, message):
+    data = parser.flatten(message)
+    assert data[0] == interface.MARKER
+    assert parser.parse(memoryview(data)) == message
+
+
+@pytest.mark.parametrize('message', [
+    {'id': 1, 'method': 'anything', 'args': [1]},  # Not annotated
+    {'id': 1, 'method': 'area', 'args': [2, 4.0]},  # An int for a float
+    {'id': 1, 'method': 'area', 'args': [2.5]},
+    {'id': 1, 'method': 'area', 'args': [2.5, 4.0], 'promise': True},
+    {'id': 1, 'method': 1, 'args': [2.5, 4.0]},
+    {'id': -3, 'result': 1 << 64},  # Too big for its field
+    {'id': -3, 'result': [1, 2]},
+    {'id': -3, 'error': 'RuntimeError: broken'},
+    {'id': 0, 'type': 'hello', 'codecs': ['binary']},
+])
+def test_falls_back_to_binary(parser, message):
+    data = parser.flatten(message)
+    assert data[0] == stream.BinaryParser.marker
+    s = stream.Stream(stream.VarintByteStream(), parser)
+    assert s.parse(memoryview(data)) == message
+
+
+def test_batch_frames(parser):
+    stream.PARSERS[Parser.name] = Parser
+    try:
+        s = stream.Stream(stream.VarintByteStream(), parser)
+        messages = [{'id': i, 'method': 'label', 'args': ['x' * i, b'', False]}
+                    for i in range(1, 4)]
+        messages.append({'id': 0, 'type': 'finish', 'ids': [1]})
+        frames = s.pack_batch([s.flatten(m) for m in messages], combine=True)
+        assert [f[1] for f in frames] == [
+            interface.BATCH_MARKER, stream.BinaryParser.marker]
+        assert s.receive(b''.join(frames)) == messages
+    finally:
+        del stream.PARSERS[Parser.name]
+
+
+@pytest.mark.parametrize('data', [
+    bytes([interface.MARKER, 0x00, 0x00, 0x07]) + bytes(8),  # Ordinal 7
+    bytes([interface.MARKER, 0x00, 0x00, 0x00]) + bytes(8),  # Not compiled
+    bytes([interface.MARKER, 0x7f]),
+    bytes([interface.MARKER, 0x05]) + bytes(8) + b'\x00\x00\x00\x09ab',
+])
+def test_bad_frames(parser, data):
+    with pytest.raises(ValueError):
+        parser.parse(data)
+
+
+def test_trailing_bytes(parser):
+    data = parser.flatten({'id': -1, 'result': 1})
+    with pytest.raises(ValueError):
+        parser.parse(data + b'\x00')
+
+
+@pytest.mark.parametrize('codecs_b, expected', [
+    ((CODEC, 'binary'), CODEC),
+    (('binary',), 'binary'),
+])
+def test_negotiated(codecs_b, expected):
+    queues = ([], [])
+    a = server_futures.Protocol(
+        queues[0].append, Future, calculator.CalculatorFutures,
+        (CODEC, 'binary'))
+    b = server_futures.Protocol(
+        queues[1].append, Future, calculator.CalculatorFutures, codecs_b)
+
+    def pump():
+        while any(queues):
+            for queue, protocol in zip(queues, (b, a)):
+                data = b''.join(queue)
+                queue.clear()
+                protocol.dispatch(protocol.data_received(data))
+
+    pump()
+    assert a.codec == expected
+    results = []
+    a.make_outbound_request(
+        {'method': 'count_primes', 'args': [30]}).add_callback(results.append)
+    a.make_outbound_request(
+        {'method': 'digest', 'args': [b'abc']}).add_callback(results.append)
+    pump()
+    assert results[0] == 10
+    assert results[1].startswith('ba7816bf')
@@ -0,0 +1,391 @@
+"""Throughput and latency of both server stacks over loopback.
+
+We start each server (server_futures and client_server_asyncio) in a
+subprocess on a free loopback port and drive it from an asyncio client in
+this process. For every combination of the options below we run for a fixed
+time and report requests/s and latency percentiles:
+
+- concurrency: number of connections, each driven by its own task.
+- depth: requests kept in flight on each connection (pipelining depth).
+  With --pooled the connections form one cappy.client_pool.ClientPool
+  instead, and concurrency * depth tasks share it, each request going to
+  the connection with the fewest in flight.
+- payload: size in bytes of the string argument for the echo pattern,
+  and rows in each map call for the map pattern.
+- pattern: what each request does.
+    - echo: echo(payload); one round trip.
+    - add: add(i, 1) with a new i each time, which the server answers by
+      calling echo back on the client, so each request is a re-entrant
+      pair of round trips.
+    - cached: add(1, 2) every time. add is cacheable (see cappy.memo), so
+      after the first call the server answers from its cache, without the
+      echo.
+    - chain: a pipelined add(add(i, 1), 2), sent as two promise requests
+      without waiting for the first; latency is for the whole chain.
+    - map: a map call of add over two columns of payload int64s, sent as
+      typed arrays (see cappy.vector); rows/s is requests/s times payload.
+
+- transport: how the client reaches the server; see cappy.endpoints.
+    - tcp: TCP loopback.
+    - unix: a unix domain socket.
+    - shm: shared memory (see cappy.shm).
+    - socketpair: an asyncio server in this process, on the client's event
+      loop, reached through a socketpair. This measures the protocol's
+      overhead alone, without another process or the network stack. Only
+      the asyncio server can run this way.
+
+--codec picks the codecs both ends offer, most preferred first; interface
+is the codec calculator.register_codecs compiles from the Calculator
+interface (see cappy.interface), and deflate the compression scheme it
+makes, which compresses frames with a dictionary made from the same
+interface (see cappy.compression).
+
+Results also go, with the configuration of each run, to a JSON file which
+can be diffed between versions:
+```
+python -m cappy.loopback_bench --output before.json
+...
+python -m cappy.loopback_bench --output after.json
+```
+
+The client is a single process, so with enough concurrency it, rather than
+the server, can be the bottleneck; --server-workers runs the servers with
+several worker processes for comparison, and --server-metrics has them
+collect metrics (see cappy.metrics), to measure what that costs. Both stacks print a line for
+each message, and that cost is part of what we measure. We discard the
+output.
+"""
+import argparse
+import array
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+
+import cappy.calculator as calculator
+import cappy.client_pool as client_pool
+import cappy.client_server_asyncio as client_server_asyncio
+import cappy.endpoints as endpoints
+
+
+SERVERS = {
+    'futures': ['-m', 'cappy.server_futures'],
+    'asyncio': ['-m', 'cappy.client_server_asyncio', '--server'],
+}
+
+TRANSPORTS = ('tcp', 'unix', 'shm', 'socketpair')
+
+CODECS = ('binary', 'json', 'interface', 'deflate')
+
+PATTERNS = ('echo', 'add', 'cached', 'chain', 'map')
+
+_unique = itertools.count()
+_columns = {}  # Rows -> a column for the map pattern
+
+
+def free_port(host):
+    with socket.socket() as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+def server_url(transport, host, directory):
+    """Get a URL for a server to listen at."""
+    if transport == 'tcp':
+        return 'tcp://{}:{}'.format(host, free_port(host))
+    if transport == 'socketpair':
+        return 'socketpair://'
+    return '{}://{}'.format(transport,
+                             os.path.join(directory, 'cappy.' + transport))
+
+
+def try_connect(endpoint):
+    if endpoint.scheme == 'tcp':
+        socket.create_connection((endpoint.host, endpoint.port),
+                                 timeout=1).close()
+    else:
+        with socket.socket(socket.AF_UNIX) as s:
+            s.connect(endpoint.path)
+
+
+@contextlib.contextmanager
+def running_server(kind, url, workers, metrics_file=None, codecs=()):
+    """Run a server listening at url in a subprocess, and stop it with
+    SIGTERM afterwards."""
+    endpoint = endpoints.parse(url)
+    if endpoint.scheme == 'socketpair':
+        yield None  # run_load serves in-process.
+        return
+    args = [sys.executable] + SERVERS[kind] + ['--listen', url]
+    if workers > 1:
+        args += ['--workers', str(workers)]
+    if metrics_file:
+        args += ['--metrics-file', metrics_file]
+    for codec in codecs:
+        args += ['--codec', codec]
+    env = dict(os.environ,
+               PYTHONPATH=os.path.dirname(os.path.dirname(
+                   os.path.abspath(__file__))))
+    proc = subprocess.Popen(args, env=env, stdout=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 10
+        while 1:
+            try:
+                try_connect(endpoint)
+                break
+            except OSError:
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("{} server didn't start".format(kind))
+                time.sleep(0.05)
+        yield proc
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+def make_request(connection, pattern, payload):
+    """Start one request of the given pattern and get an awaitable result."""
+    if pattern == 'echo':
+        return connection.make_outbound_request(
+            {'method': 'echo', 'args': [payload]})
+    if pattern == 'add':
+        return connection.make_outbound_request(
+            {'method': 'add', 'args': [next(_unique), 1]})
+    if pattern == 'cached':
+        return connection.make_outbound_request(
+            {'method': 'add', 'args': [1, 2]})
+    if pattern == 'map':
+        column = _columns.get(len(payload))
+        if column is None:
+            column = _columns[len(payload)] = array.array(
+                'q', range(len(payload)))
+        return connection.make_outbound_request(
+            {'method': 'add', 'args': [column, column], 'map': True})
+    if pattern == 'chain':
+        f = connection.make_outbound_request(
+            {'method': 'add', 'args': [next(_unique), 1]}, promise=True)
+        return connection.make_outbound_request(
+            {'method': 'add', 'args': [f, 2]})
+    raise ValueError("Unknown pattern {!r}".format(pattern))
+
+
+async def drive(connection, pattern, payload, depth, stop_at, latencies):
+    """Keep depth requests in flight on connection until stop_at."""
+
+    async def one_lane():
+        while time.perf_counter() < stop_at:
+            t0 = time.perf_counter()
+            await make_request(connection, pattern, payload)
+            latencies.append(time.perf_counter() - t0)
+
+    await asyncio.gather(*(one_lane() for _ in range(depth)))
+
+
+async def drive_pool(pool, pattern, payload, lanes, stop_at, latencies):
+    """Keep lanes requests in flight on pool until stop_at."""
+
+    async def one_lane():
+        while time.perf_counter() < stop_at:
+            t0 = time.perf_counter()
+            connection = await pool.connection()
+            await make_request(connection, pattern, payload)
+            latencies.append(time.perf_counter() - t0)
+
+    await asyncio.gather(*(one_lane() for _ in range(lanes)))
+
+
+async def run_pooled(url, factory, concurrency, depth, payload, pattern,
+                     seconds, warmup):
+    data = 'x' * payload
+    async with client_pool.ClientPool([url], concurrency, factory) as pool:
+        lanes = concurrency * depth
+        if warmup:
+            await drive_pool(pool, pattern, data, lanes,
+                             time.perf_counter() + warmup, [])
+        latencies = []
+        t0 = time.perf_counter()
+        await drive_pool(pool, pattern, data, lanes, t0 + seconds, latencies)
+        elapsed = time.perf_counter() - t0
+    return len(latencies), elapsed, latencies
+
+
+async def run_load(url, codecs, concurrency, depth, payload, pattern,
+                   seconds, warmup, pooled=False):
+    factory = client_server_asyncio.ConnectionFactory(
+        client_server_asyncio.Protocol, asyncio.get_running_loop, codecs)
+    if pooled:
+        return await run_pooled(url, factory, concurrency, depth, payload,
+                                pattern, seconds, warmup)
+    endpoint = endpoints.parse(url)
+    server_factory = client_server_asyncio.ConnectionFactory(
+        client_server_asyncio.Protocol, asyncio.get_running_loop, codecs)
+    connections = []
+    try:
+        for _ in range(concurrency):
+            if endpoint.scheme == 'socketpair':
+                _, connection = await endpoints.connect_pair(
+                    server_factory, factory)
+            else:
+                _, connection = await endpoints.open_connection(
+                    factory, endpoint)
+            connections.append(connection)
+        data = 'x' * payload
+        if warmup:
+            await asyncio.gather(*(
+                drive(c, pattern, data, depth,
+                      time.perf_counter() + warmup, [])
+                for c in connections))
+        latencies = []
+        t0 = time.perf_counter()
+        await asyncio.gather(*(
+            drive(c, pattern, data, depth, t0 + seconds, latencies)
+            for c in connections))
+        elapsed = time.perf_counter() - t0
+    finally:
+        for connection in connections:
+            connection.transport.close()
+        await server_factory.drain(1)
+    return len(latencies), elapsed, latencies
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(requests, elapsed, latencies):
+    ordered = sorted(latencies)
+    ms = lambda x: None if x is None else round(1000 * x, 4)
+    return {
+        'requests': requests,
+        'seconds': round(elapsed, 4),
+        'requests_per_second': round(requests / elapsed, 1),
+        'p50_ms': ms(percentile(ordered, 0.5)),
+        'p99_ms': ms(percentile(ordered, 0.99)),
+        'p999_ms': ms(percentile(ordered, 0.999)),
+    }
+
+
+def main(servers, concurrencies, depths, payloads, patterns, codecs,
+         seconds, warmup, server_workers, host, output, server_metrics=None,
+         pooled=False, transports=('tcp',)):
+    results = []
+    header = ("{:<8} {:<10} {:<6} {:>5} {:>5} {:>8} {:>10} {:>9} {:>9} "
+              "{:>9}".format(
+                  "server", "transport", "pattern", "conns", "depth",
+                  "payload", "req/s", "p50 ms", "p99 ms", "p999 ms"))
+    print(header)
+    directory = tempfile.mkdtemp()
+    for kind, transport in itertools.product(servers, transports):
+        if transport == 'socketpair' and kind != 'asyncio':
+            print("{:<8} {:<10} skipped: can't run in-process".format(
+                kind, transport))
+            continue
+        url = server_url(transport, host, directory)
+        with running_server(kind, url, server_workers, server_metrics,
+                            codecs):
+            for pattern, concurrency, depth, payload in itertools.product(
+                    patterns, concurrencies, depths, payloads):
+                if pattern not in ('echo', 'map') and \
+                        payload != payloads[0]:
+                    continue  # Payload only affects echo and map.
+                # The protocol prints for every message; keep that out of
+                # our report.
+                with open(os.devnull, 'w') as devnull, \
+                        contextlib.redirect_stdout(devnull):
+                    summary = summarize(*asyncio.run(run_load(
+                        url, codecs, concurrency, depth, payload, pattern,
+                        seconds, warmup, pooled)))
+                config = {
+                    'server': kind,
+                    'server_workers': server_workers,
+                    'server_metrics': bool(server_metrics),
+                    'pooled': pooled,
+                    'transport': transport,
+                    'pattern': pattern,
+                    'concurrency': concurrency,
+                    'depth': depth,
+                    'payload': payload,
+                    'codecs': list(codecs),
+                }
+                results.append(dict(config, **summary))
+                print("{:<8} {:<10} {:<6} {:>5} {:>5} {:>8} {:>10.0f} {:>9} "
+                      "{:>9} {:>9}".format(
+                          kind, transport, pattern, concurrency, depth,
+                          payload,
+                          summary['requests_per_second'], summary['p50_ms'],
+                          summary['p99_ms'], summary['p999_ms']))
+    if output:
+        report = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'seconds_per_run': seconds,
+            'results': results,
+        }
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+            f.write('\n')
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Loopback server benchmark')
+    parser.add_argument('--server', choices=sorted(SERVERS), action='append',
+                        help="Server stack to measure; may be repeated "
+                             "(default: both)")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16],
+                        help="Numbers of connections to try")
+    parser.add_argument('--depth', type=int, nargs='+', default=[1, 8],
+                        help="Requests in flight per connection")
+    parser.add_argument('--payload', type=int, nargs='+', default=[16, 4096],
+                        help="Echo payload sizes in bytes, and map call "
+                             "rows")
+    parser.add_argument('--pattern', choices=PATTERNS, action='append',
+                        help="Call pattern; may be repeated (default: all)")
+    parser.add_argument('--codec', choices=CODECS, action='append',
+                        help="Codec to offer; may be repeated")
+    parser.add_argument('--seconds', type=float, default=2.0,
+                        help="Measured time for each run")
+    parser.add_argument('--warmup', type=float, default=0.5,
+                        help="Unmeasured time before each run")
+    parser.add_argument('--server-workers', type=int, default=1,
+                        help="Worker processes for each server")
+    parser.add_argument('--server-metrics', metavar='FILE',
+                        help="Have servers collect metrics and write them "
+                             "to FILE")
+    parser.add_argument('--pooled', action='store_true',
+                        help="Share the connections through a ClientPool")
+    parser.add_argument('--transport', choices=TRANSPORTS, action='append',
+                        help="How to reach the servers; may be repeated "
+                             "(default: tcp)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--output', '-o',
+                        help="Write results to this JSON file")
+    args = parser.parse_args()
+    transports = args.transport or ['tcp']
+    if args.pooled and 'socketpair' in transports:
+        parser.error("--pooled can't be used with socketpair")
+    interface, deflate = calculator.register_codecs()
+    names = {'interface': interface, 'deflate': deflate}
+    main(args.server or sorted(SERVERS), args.concurrency, args.depth,
+         args.payload, args.pattern or list(PATTERNS),
+         tuple(names.get(name, name)
+               for name in args.codec or ('binary', 'json')),
+         args.seconds, args.warmup,
+         args.server_workers, args.host, args.output, args.server_metrics,
+         args.pooled, transports)
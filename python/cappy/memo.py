@@ -0,0 +1,210 @@
+"""Server-side memoization of pure methods.
+
+A method whose result depends only on its arguments can be marked
+cacheable:
+
+```
+class Calculator:
+
+    @memo.cacheable(maxsize=4096, ttl=60)
+    def add(self, x, y):
+        ...
+```
+
+The protocol then answers a repeated call straight from the method's
+MethodCache, without calling the method at all, and so without any
+outbound requests the method would make. Identical calls which arrive while
+the first is still running don't run the method again either: they wait
+for the first call's outcome and share it (singleflight), errors included.
+Errors aren't cached.
+
+Each implementation class has one MethodCache per cacheable method, shared
+by every connection in the process. Keys are the method's arguments in a
+canonical form which distinguishes types that compare equal, such as 1,
+1.0 and True; calls with arguments which can't be keyed (capabilities,
+streams, promised results) bypass the cache.
+"""
+import collections
+import time
+import weakref
+
+
+def cacheable(maxsize=1024, ttl=None):
+    """Decorator marking a method as pure, so its results may be cached.
+
+    Args:
+        maxsize (int): Most results to keep; the least recently used is
+            evicted first.
+        ttl (float): Seconds a result may be used for, or None for no limit.
+    """
+    if maxsize < 1:
+        raise ValueError("maxsize must be at least 1")
+
+    def decorate(function):
+        function._cappy_cache = (maxsize, ttl)
+        return function
+    return decorate
+
+
+def cache_spec(function):
+    """Get the (maxsize, ttl) a method was marked with, or None."""
+    return getattr(function, '_cappy_cache', None)
+
+
+class _Uncacheable(Exception):
+    pass
+
+
+_SCALARS = frozenset([type(None), bool, int, float, str, bytes])
+
+
+def _canonical(value):
+    t = type(value)
+    if t in _SCALARS:
+        return (t, value)
+    if t is list or t is tuple:
+        # Lists and tuples arrive as the same thing.
+        return (list, tuple([_canonical(v) for v in value]))
+    if t is dict:
+        # Keys are tagged like any other value, so {1: x} and {True: x}
+        # differ, and ordered by repr since the tags don't compare.
+        items = [(_canonical(k), _canonical(v)) for k, v in value.items()]
+        items.sort(key=lambda item: repr(item[0]))
+        return (dict, tuple(items))
+    if t is bytearray:
+        return (bytes, bytes(value))
+    raise _Uncacheable()
+
+
+class MethodCache:
+    """Cached results of one method, and the calls of it in flight.
+
+    Attributes:
+        name (str): 'Class.method', for stats.
+        maxsize (int): Most results we keep.
+        ttl (float): Seconds a result is good for, or None.
+        hits, misses, coalesced, evictions (int): Counts of calls answered
+            from the cache, calls which ran the method, calls which waited
+            for an identical call in flight, and results evicted to make
+            room.
+    """
+
+    def __init__(self, name, maxsize=1024, ttl=None, clock=time.monotonic):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._results = collections.OrderedDict()  # key -> (value, expires)
+        self._flights = {}  # key -> list of (waiter, lead)
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        _caches.add(self)
+
+    @staticmethod
+    def key(args):
+        """Get the cache key for a call with args, or None if it has none."""
+        try:
+            return tuple([_canonical(a) for a in args])
+        except _Uncacheable:
+            return None
+
+    def lookup(self, key, waiter, lead=None):
+        """Look for the result of a call, or join an identical call.
+
+        Args:
+            key: From key().
+            waiter (function): Called as waiter(result, exception), with
+                exception None on success, when the identical call in flight
+                finishes.
+            lead (function): Called with no arguments, instead of waiter, if
+                the call in flight is abandoned and this one is to take it
+                over; it must run the method and call fill or fail. None if
+                this call can't.
+
+        Returns:
+            (str, value): ('hit', result), ('wait', None) if waiter was
+                added to a call in flight, or ('miss', None), in which case
+                the caller must run the method and call fill or fail with
+                the key.
+        """
+        entry = self._results.get(key)
+        if entry is not None:
+            value, expires = entry
+            if expires is None or self.clock() < expires:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return 'hit', value
+            del self._results[key]
+        waiters = self._flights.get(key)
+        if waiters is not None:
+            waiters.append((waiter, lead))
+            self.coalesced += 1
+            return 'wait', None
+        self._flights[key] = []
+        self.misses += 1
+        return 'miss', None
+
+    def fill(self, key, value):
+        """Store the result of a call which missed, and pass it to waiters."""
+        results = self._results
+        results[key] = (value, None if self.ttl is None
+                        else self.clock() + self.ttl)
+        if len(results) > self.maxsize:
+            results.popitem(last=False)
+            self.evictions += 1
+        for waiter, _ in self._flights.pop(key, ()):
+            waiter(value, None)
+
+    def fail(self, key, exception):
+        """Pass the failure of a call which missed to its waiters."""
+        for waiter, _ in self._flights.pop(key, ()):
+            waiter(None, exception)
+
+    def abandon(self, key, exception):
+        """Give up on a call which missed, since its caller has gone.
+
+        The first waiter which can lead takes the call over and the rest
+        keep waiting for it. If none can, they all get exception.
+        """
+        waiters = self._flights.pop(key, None)
+        if not waiters:
+            return
+        for i, (waiter, lead) in enumerate(waiters):
+            if lead is not None:
+                del waiters[i]
+                self._flights[key] = waiters
+                lead()
+                return
+        for waiter, _ in waiters:
+            waiter(None, exception)
+
+    def leave(self, key, waiter):
+        """Stop waiting for a call in flight, since our caller has gone."""
+        waiters = self._flights.get(key)
+        if waiters:
+            waiters[:] = [w for w in waiters if w[0] is not waiter]
+
+    def clear(self):
+        """Drop every cached result; calls in flight carry on."""
+        self._results.clear()
+
+    def stats(self):
+        return {'size': len(self._results), 'hits': self.hits,
+                'misses': self.misses, 'coalesced': self.coalesced,
+                'evictions': self.evictions}
+
+
+_caches = weakref.WeakSet()
+
+
+def stats():
+    """Get the stats of every MethodCache, by 'Class.method'."""
+    return {c.name: c.stats()
+            for c in sorted(_caches, key=lambda c: c.name)}
+
+
+def clear_all():
+    for c in list(_caches):
+        c.clear()
@@ -0,0 +1,144 @@
+import pytest
+
+
+import cappy.dispatch as dispatch
+import cappy.memo as memo
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def waiter(outcomes):
+    return lambda result, exception: outcomes.append((result, exception))
+
+
+def test_keys_distinguish_types():
+    key = memo.MethodCache.key
+    assert key([1, 'a']) == key([1, 'a'])
+    assert len({key([1]), key([1.0]), key([True])}) == 3
+    assert key([[1, 2]]) == key([(1, 2)])
+    assert key([{'b': 1, 'a': [2]}]) == key([{'a': [2], 'b': 1}])
+    assert key([object()]) is None
+    assert key([{1: 'x', 'a': 'y'}]) == key([{'a': 'y', 1: 'x'}])
+    assert len({key([{1: 'x'}]), key([{1.0: 'x'}]), key([{True: 'x'}])}) == 3
+
+
+def test_hit_and_miss():
+    cache = memo.MethodCache('C.m')
+    k = cache.key([1, 2])
+    assert cache.lookup(k, None) == ('miss', None)
+    cache.fill(k, 3)
+    assert cache.lookup(k, None) == ('hit', 3)
+    assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 1,
+                             'coalesced': 0, 'evictions': 0}
+
+
+def test_lru_eviction():
+    cache = memo.MethodCache('C.m', maxsize=2)
+    for n in (1, 2):
+        cache.lookup((n,), None)
+        cache.fill((n,), n)
+    cache.lookup((1,), None)  # 2 is now least recently used.
+    cache.lookup((3,), None)
+    cache.fill((3,), 3)
+    assert cache.lookup((2,), None) == ('miss', None)
+    assert cache.lookup((1,), None) == ('hit', 1)
+    assert cache.evictions == 1
+
+
+def test_ttl():
+    clock = Clock()
+    cache = memo.MethodCache('C.m', ttl=10, clock=clock)
+    cache.lookup((1,), None)
+    cache.fill((1,), 'one')
+    clock.now = 9.9
+    assert cache.lookup((1,), None) == ('hit', 'one')
+    clock.now = 10
+    assert cache.lookup((1,), None) == ('miss', None)
+
+
+def test_singleflight():
+    cache = memo.MethodCache('C.m')
+    outcomes = []
+    assert cache.lookup((1,), None) == ('miss', None)
+    assert cache.lookup((1,), waiter(outcomes)) == ('wait', None)
+    assert cache.lookup((1,), waiter(outcomes)) == ('wait', None)
+    cache.fill((1,), 'one')
+    assert outcomes == [('one', None)] * 2
+    assert cache.coalesced == 2
+
+
+def test_errors_are_shared_but_not_cached():
+    cache = memo.MethodCache('C.m')
+    outcomes = []
+    error = RuntimeError()
+    cache.lookup((1,), None)
+    cache.lookup((1,), waiter(outcomes))
+    cache.fail((1,), error)
+    assert outcomes == [(None, error)]
+    assert cache.lookup((1,), None) == ('miss', None)
+
+
+def test_abandoned_call_is_led_by_a_waiter():
+    cache = memo.MethodCache('C.m')
+    outcomes, led = [], []
+    cache.lookup((1,), None)
+    cache.lookup((1,), waiter(outcomes))
+    cache.lookup((1,), waiter(outcomes), lambda: led.append(2))
+    cache.lookup((1,), waiter(outcomes), lambda: led.append(3))
+    cache.abandon((1,), ConnectionError())
+    assert led == [2] and outcomes == []
+    cache.fill((1,), 'one')
+    assert outcomes == [('one', None)] * 2
+    assert led == [2]
+
+
+def test_abandoned_call_without_leader_fails():
+    cache = memo.MethodCache('C.m')
+    outcomes = []
+    error = ConnectionError()
+    cache.lookup((1,), None)
+    cache.lookup((1,), waiter(outcomes))
+    cache.abandon((1,), error)
+    assert outcomes == [(None, error)]
+    assert cache.lookup((1,), None) == ('miss', None)
+
+
+def test_leave():
+    cache = memo.MethodCache('C.m')
+    outcomes, led = [], []
+    left = waiter(outcomes)
+    cache.lookup((1,), None)
+    cache.lookup((1,), left, lambda: led.append(1))
+    cache.lookup((1,), waiter(outcomes), lambda: led.append(2))
+    cache.leave((1,), left)
+    cache.abandon((1,), ConnectionError())
+    assert led == [2]
+
+
+def test_dispatch_entries_get_caches():
+
+    class Pure:
+        @memo.cacheable(maxsize=10, ttl=5)
+        def square(self, x):
+            return x * x
+
+        def impure(self):
+            pass
+
+    table = dispatch.table_for(Pure)
+    cache = table.lookup('square').cache
+    assert (cache.name, cache.maxsize, cache.ttl) == ('Pure.square', 10, 5)
+    assert table.lookup('impure').cache is None
+    assert 'Pure.square' in memo.stats()
+
+
+def test_maxsize_must_be_positive():
+    with pytest.raises(ValueError):
+        memo.cacheable(maxsize=0)
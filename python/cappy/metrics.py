@@ -0,0 +1,296 @@
+"""Counters and latency histograms for protocols and transports.
+
+Collection is off unless a Protocol is given a Metrics, and then costs a
+few dict updates per message. Counts are exact, but reading the clock and
+recording a latency cost about as much as a call's whole protocol overhead,
+so by default we only time one call, one message encode and one read's
+decode in eight.
+
+One Metrics may be shared by every connection of a server; gauges such as
+the number of pending requests are summed over the attached protocols when
+a snapshot is taken, so they cost nothing in between.
+
+```
+m = metrics.Metrics()
+protocol = Protocol(..., metrics=m)
+...
+m.snapshot()  # A dict of plain values, e.g. for json.dump.
+```
+"""
+import bisect
+import json
+import time
+import weakref
+
+
+import cappy.memo as memo
+import cappy.stream as stream
+
+
+def _bucket_bounds():
+    # Four buckets per power of two, from 1us to about 70 minutes.
+    return [1e-6 * 2 ** (i / 4) for i in range(4 * 32)]
+
+
+class Histogram:
+    """Counts of values in log-spaced buckets, e.g. latencies in seconds.
+
+    Percentiles are estimated as the upper bound of the bucket they fall in,
+    so they are accurate to within about 19%.
+
+    Attributes:
+        bounds (list of float): Bucket upper bounds, shared by all
+            histograms.
+        counts (list of int): Number of values in each bucket; the last
+            counts values above every bound.
+    """
+
+    bounds = _bucket_bounds()
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """Estimate the value below which a fraction q of values fall."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'p999': self.percentile(0.999),
+            'max': self.max,
+        }
+
+
+class MethodStats:
+    """Calls of one method, in one direction."""
+
+    __slots__ = ('calls', 'errors', 'latency')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+    def snapshot(self):
+        return {'calls': self.calls, 'errors': self.errors,
+                'latency': self.latency.snapshot()}
+
+
+class Metrics:
+    """Metrics for one or more connections.
+
+    Attributes:
+        counters (dict): Name -> count, e.g. 'bytes_in'.
+        codec_time (dict): 'encode' and 'decode' -> Histogram of seconds
+            spent turning one message into a frame (sampled), or one read's
+            worth of bytes into messages.
+        inbound (dict): Method name -> MethodStats for requests we served;
+            latency is from receiving the request to sending the response.
+        outbound (dict): Method name -> MethodStats for requests we made;
+            latency is from sending the request to receiving the response.
+            Latencies are sampled.
+        sample (int): We time one in this many calls and encodes; a power
+            of two.
+    """
+
+    def __init__(self, clock=time.perf_counter, sample=8):
+        if sample < 1 or sample & (sample - 1):
+            raise ValueError("sample must be a power of two")
+        self.clock = clock
+        self.sample = sample
+        self._sample_mask = sample - 1
+        self.counters = dict.fromkeys(
+            ['bytes_in', 'bytes_out', 'frames_in', 'frames_out'], 0)
+        self.codec_time = {'encode': Histogram(), 'decode': Histogram()}
+        self.inbound = {}
+        self.outbound = {}
+        self._protocols = weakref.WeakSet()
+
+    def attach(self, protocol):
+        """Include protocol's pending requests etc. in our gauges."""
+        self._protocols.add(protocol)
+
+    def call_started(self, started, key, method, outbound):
+        """Note the start of a call.
+
+        Args:
+            started (dict): Where the caller keeps calls in progress, e.g.
+                one dict per connection and direction.
+            key: Identifies the call in started, e.g. its message id.
+            method (str): Name of the method called.
+            outbound (bool): Whether we made the call, rather than serve it.
+        """
+        table = self.outbound if outbound else self.inbound
+        stats = table.get(method)
+        if stats is None:
+            stats = table[method] = MethodStats()
+        stats.calls += 1
+        if stats.calls & self._sample_mask:
+            started[key] = stats
+        else:
+            started[key] = (stats, self.clock())
+
+    def call_finished(self, started, key, error=False):
+        """Note the end of a call passed to call_started."""
+        entry = started.pop(key, None)
+        if entry is None:
+            return
+        if type(entry) is tuple:
+            stats, t0 = entry
+            stats.latency.record(self.clock() - t0)
+        else:
+            stats = entry
+        if error:
+            stats.errors += 1
+
+    def gauges(self):
+        """Current values summed over the attached protocols."""
+        gauges = dict.fromkeys(
+            ['connections', 'pending_requests', 'inbound_in_flight',
+             'answers', 'exports', 'write_buffer_bytes'], 0)
+        for p in list(self._protocols):
+            gauges['connections'] += 1
+            gauges['pending_requests'] += len(p.pending_requests)
+            gauges['inbound_in_flight'] += p.inbound_in_flight
+            gauges['answers'] += len(p.answers)
+            gauges['exports'] += len(p.exports)
+            if p.write_buffer_size is not None:
+                gauges['write_buffer_bytes'] += p.write_buffer_size()
+        return gauges
+
+    def snapshot(self):
+        """Get all our metrics as a dict of plain values."""
+        return {
+            'time': time.time(),
+            'counters': dict(self.counters),
+            'gauges': self.gauges(),
+            'codec_time': {name: h.snapshot()
+                           for name, h in self.codec_time.items()},
+            'inbound': {name: s.snapshot()
+                        for name, s in sorted(self.inbound.items())},
+            'outbound': {name: s.snapshot()
+                         for name, s in sorted(self.outbound.items())},
+            'caches': memo.stats(),
+        }
+
+    def dump(self, path):
+        """Write a snapshot to path as JSON."""
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=1, sort_keys=True)
+            f.write('\n')
+
+
+class MeasuredStream(stream.Stream):
+    """A Stream which counts and times the frames passing through it.
+
+    Inbound frames are counted once per read rather than one at a time, and
+    reads are timed one in Metrics.sample, like encodes. Measured against a
+    plain Stream, decoding costs about 0.1-0.3us more per frame with four
+    to sixteen frames a read, and 0.6-0.9us more with one; the per-call
+    bookkeeping in Metrics costs about 0.55us more.
+    """
+
+    def __init__(self, binary_stream, message_parser, metrics):
+        super().__init__(binary_stream, message_parser)
+        self.metrics = metrics
+        self._packed = 0
+        self._reads = 0
+
+    def _parse_all(self, frames):
+        if self._awaiting_hello:
+            messages = super()._parse_all(frames)
+            if messages:
+                # The hello; this method counted the rest.
+                self.metrics.counters['frames_in'] += 1
+            return messages
+        parse = self.parse
+        messages = []
+        n = 0
+        for frame in frames:
+            n += 1
+            message = parse(frame)
+            if type(message) is list:  # A batch frame
+                messages.extend(message)
+            else:
+                messages.append(message)
+        if n:
+            self.metrics.counters['frames_in'] += n
+        return messages
+
+    def _timed(self, nbytes):
+        """Count a read of nbytes; get whether to time decoding it."""
+        m = self.metrics
+        m.counters['bytes_in'] += nbytes
+        self._reads += 1
+        return not self._reads & m._sample_mask
+
+    def receive(self, data):
+        if not self._timed(len(data)):
+            return super().receive(data)
+        m = self.metrics
+        t0 = m.clock()
+        messages = super().receive(data)
+        m.codec_time['decode'].record(m.clock() - t0)
+        return messages
+
+    def buffer_updated(self, nbytes):
+        if not self._timed(nbytes):
+            return super().buffer_updated(nbytes)
+        m = self.metrics
+        t0 = m.clock()
+        messages = super().buffer_updated(nbytes)
+        m.codec_time['decode'].record(m.clock() - t0)
+        return messages
+
+    def flatten(self, message):
+        m = self.metrics
+        self._packed += 1
+        if self._packed & m._sample_mask:
+            return self.mp.flatten(message)
+        t0 = m.clock()
+        data = self.mp.flatten(message)
+        m.codec_time['encode'].record(m.clock() - t0)
+        return data
+
+    def frame(self, payload):
+        data = super().frame(payload)
+        counters = self.metrics.counters
+        counters['bytes_out'] += len(data)
+        counters['frames_out'] += 1
+        return data
+
+    def pack_batch(self, payloads, combine=False, gather=False):
+        frames = super().pack_batch(payloads, combine, gather)
+        counters = self.metrics.counters
+        counters['bytes_out'] += sum(map(len, frames))
+        if not gather:
+            counters['frames_out'] += len(frames)
+        return frames
+
+    def _frame_parts(self, payload):
+        self.metrics.counters['frames_out'] += 1
+        return super()._frame_parts(payload)
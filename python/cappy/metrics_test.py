@@ -0,0 +1,171 @@
+import json
+import socket
+
+
+import pytest
+
+
+from cappy.future import Future
+import cappy.metrics as metrics
+import cappy.server_futures as server_futures
+import cappy.stream as stream
+
+
+class Adder:
+
+    def __init__(self, outbound_requester):
+        pass
+
+    def add(self, x, y):
+        return x + y
+
+    def fail(self):
+        raise RuntimeError("broken")
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += 0.001
+        return self.now
+
+
+def test_histogram_percentiles():
+    h = metrics.Histogram()
+    for i in range(1, 1001):
+        h.record(i * 1e-6)
+    snapshot = h.snapshot()
+    assert snapshot['count'] == 1000
+    assert snapshot['max'] == pytest.approx(1e-3)
+    assert snapshot['mean'] == pytest.approx(500.5e-6)
+    # Estimates are bucket upper bounds, within a bucket's width.
+    assert 500e-6 <= snapshot['p50'] <= 500e-6 * 2 ** 0.25
+    assert 990e-6 <= snapshot['p99'] <= 990e-6 * 2 ** 0.25
+
+
+def test_histogram_beyond_last_bucket():
+    h = metrics.Histogram()
+    h.record(1e9)
+    assert h.percentile(0.5) == 1e9
+
+
+@pytest.fixture
+def connected():
+    """Two protocols back to back, each with its own Metrics."""
+    queues = ([], [])
+    a_metrics = metrics.Metrics(FakeClock(), sample=1)
+    b_metrics = metrics.Metrics(FakeClock(), sample=1)
+    a = server_futures.Protocol(queues[0].append, Future, Adder,
+                                metrics=a_metrics)
+    b = server_futures.Protocol(queues[1].append, Future, Adder,
+                                metrics=b_metrics)
+
+    def pump():
+        while any(queues):
+            for queue, protocol in ((queues[0], b), (queues[1], a)):
+                data = b''.join(queue)
+                queue.clear()
+                if data:
+                    protocol.dispatch(protocol.data_received(data))
+
+    pump()
+    return a, b, a_metrics, b_metrics, pump
+
+
+def test_call_metrics(connected):
+    a, b, a_metrics, b_metrics, pump = connected
+    a.make_outbound_request({'method': 'add', 'args': [1, 2]})
+    a.make_outbound_request({'method': 'add', 'args': [3, 4]})
+    a.make_outbound_request({'method': 'fail', 'args': []})
+    a.make_outbound_request({'method': 'missing', 'args': []})
+    assert a_metrics.gauges()['pending_requests'] == 4
+    pump()
+
+    served = b_metrics.snapshot()['inbound']
+    assert served['add']['calls'] == 2
+    assert served['add']['errors'] == 0
+    assert served['add']['latency']['count'] == 2
+    assert served['fail']['errors'] == 1
+    assert served['missing']['errors'] == 1
+
+    made = a_metrics.snapshot()['outbound']
+    assert {name: (s['calls'], s['errors']) for name, s in made.items()} == {
+        'add': (2, 0), 'fail': (1, 1), 'missing': (1, 1)}
+    assert a_metrics.gauges()['pending_requests'] == 0
+
+
+def test_frame_and_byte_counters(connected):
+    a, b, a_metrics, b_metrics, pump = connected
+    for x in range(3):  # Read as one.
+        a.make_outbound_request({'method': 'add', 'args': [1, x]})
+    pump()
+    a_counters = a_metrics.counters
+    b_counters = b_metrics.counters
+    assert a_counters['frames_out'] == b_counters['frames_in']
+    assert a_counters['bytes_out'] == b_counters['bytes_in']
+    assert b_counters['frames_out'] == a_counters['frames_in']
+    assert a_counters['frames_out'] == 4  # hello and the requests.
+    assert a_metrics.codec_time['encode'].count == 4
+    assert a_metrics.codec_time['decode'].count >= 1
+
+
+def test_sampling():
+    m = metrics.Metrics(FakeClock(), sample=4)
+    started = {}
+    for key in range(8):
+        m.call_started(started, key, 'add', False)
+    for key in range(8):
+        m.call_finished(started, key, error=key == 0)
+    stats = m.inbound['add']
+    assert (stats.calls, stats.errors) == (8, 1)
+    assert stats.latency.count == 2
+    with pytest.raises(ValueError):
+        metrics.Metrics(sample=3)
+
+
+def test_decode_sampling():
+    m = metrics.Metrics(FakeClock(), sample=4)
+    s = metrics.MeasuredStream(
+        stream.VarintByteStream(), stream.JSONParser(), m)
+    data = s.pack_message({'id': 1})
+    for _ in range(8):
+        s.receive(data)
+    assert m.counters['frames_in'] == 8
+    assert m.counters['bytes_in'] == 8 * len(data)
+    assert m.codec_time['decode'].count == 2
+
+
+def test_gauges_sum_over_connections():
+    m = metrics.Metrics()
+    pairs = [socket.socketpair() for _ in range(2)]
+    try:
+        handlers = [server_futures.ClientHandler(a, None, None, metrics=m)
+                    for a, _ in pairs]
+        gauges = m.gauges()
+        assert gauges['connections'] == 2
+        # Each handler has queued a hello message.
+        assert gauges['write_buffer_bytes'] == sum(
+            h.out_bytes for h in handlers) > 0
+    finally:
+        for pair in pairs:
+            for sock in pair:
+                sock.close()
+
+
+def test_dump(tmp_path, connected):
+    a, b, a_metrics, b_metrics, pump = connected
+    a.make_outbound_request({'method': 'add', 'args': [1, 2]})
+    pump()
+    path = tmp_path / 'metrics.json'
+    b_metrics.dump(str(path))
+    with open(str(path)) as f:
+        assert json.load(f)['inbound']['add']['calls'] == 1
+
+
+def test_off_by_default():
+    p = server_futures.Protocol(lambda data: None, Future, Adder)
+    assert p.metrics is None
+    assert type(p.stream).__name__ == 'Stream'
@@ -0,0 +1,107 @@
+"""Execution policies for implementation methods.
+
+By default a method runs inline on the event loop, which is right for cheap
+calls but means one slow call stalls every connection. A method which
+blocks, or releases the GIL while it works (e.g. hashing or I/O), can be
+marked to run in a thread pool instead, and a CPU-bound method to run in a
+process pool:
+
+```
+class Calculator:
+
+    @offload.in_thread
+    def digest(self, data):
+        ...
+
+    @staticmethod
+    @offload.in_process
+    def count_primes(limit):
+        ...
+```
+
+Methods run in a process pool must be staticmethods, since the
+implementation object lives in the server process; their arguments and
+results are pickled.
+
+The protocol only offloads methods if it is given Executors, which owns the
+pools and sets their sizes. The result comes back as the protocol's own
+future type, fired on its event loop.
+"""
+import concurrent.futures
+
+
+INLINE = 'inline'
+"""Run on the event loop."""
+
+THREAD = 'thread'
+"""Run in a thread pool."""
+
+PROCESS = 'process'
+"""Run in a process pool."""
+
+
+def execution_policy(policy):
+    """Decorator setting the policy a method runs with."""
+    if policy not in (INLINE, THREAD, PROCESS):
+        raise ValueError("Unknown execution policy {!r}".format(policy))
+
+    def decorate(function):
+        function._cappy_policy = policy
+        return function
+    return decorate
+
+
+in_thread = execution_policy(THREAD)
+in_process = execution_policy(PROCESS)
+
+
+def policy_of(function):
+    return getattr(function, '_cappy_policy', INLINE)
+
+
+def call_static(cls, name, args):
+    """Call the staticmethod cls.name(*args); run in the process pool."""
+    return getattr(cls, name)(*args)
+
+
+class Executors:
+    """The thread and process pools offloaded methods run in.
+
+    Pools are started the first time they are needed.
+
+    Attributes:
+        max_threads (int): Size of the thread pool, or None for the
+            concurrent.futures default.
+        max_processes (int): Size of the process pool, or None for one
+            process per core.
+    """
+
+    def __init__(self, max_threads=None, max_processes=None):
+        self.max_threads = max_threads
+        self.max_processes = max_processes
+        self._threads = None
+        self._processes = None
+
+    def submit(self, policy, function, *args):
+        """Run function(*args) with policy THREAD or PROCESS.
+
+        Returns:
+            concurrent.futures.Future
+        """
+        if policy is THREAD:
+            if self._threads is None:
+                self._threads = concurrent.futures.ThreadPoolExecutor(
+                    self.max_threads, thread_name_prefix='cappy')
+            return self._threads.submit(function, *args)
+        if policy is PROCESS:
+            if self._processes is None:
+                self._processes = concurrent.futures.ProcessPoolExecutor(
+                    self.max_processes)
+            return self._processes.submit(function, *args)
+        raise ValueError("Cannot submit with policy {!r}".format(policy))
+
+    def shutdown(self, wait=True):
+        for pool in (self._threads, self._processes):
+            if pool is not None:
+                pool.shutdown(wait)
+        self._threads = self._processes = None
@@ -1,17 +1,134 @@
-class MessageIdPool:
+GENERATION_BITS = 8
+GENERATION_MASK = (1 << GENERATION_BITS) - 1
+
+_ABANDONED = object()  # Holds the slot of a request we gave up on
+
+
+class PendingTable:
+    """Outbound requests waiting for responses, by message id.
+
+    Requests live in the slots of a list, which grows to the most requests
+    ever in flight at once. A message id encodes the request's slot and the
+    slot's generation, which goes up each time the slot is freed, so
+    add, get and pop index the list rather than hash, and a response to a
+    request we have given up on (or a duplicate response) finds a newer
+    generation in the slot and is ignored rather than answering the
+    request now using the slot.
+
+    A request we give up on, e.g. because it timed out, is abandoned rather
+    than popped: its slot stays taken until the response to it arrives and
+    is popped, so no newer request can be given its id meanwhile. The peer
+    answers every request exactly once, even cancelled ones, so abandoned
+    slots are freed in the end; clear frees them too, for when the
+    connection is lost. Freed slots are reused most recent first to keep
+    ids small. Generations wrap after 2 ** GENERATION_BITS uses of a slot,
+    so only a duplicate response that many uses late would be taken for a
+    newer request's.
+
+    Ids are positive: ((slot << GENERATION_BITS) | generation) + 1.
+    """
+
     def __init__(self):
-        self.next_id = 1
-        self.pool = set()
+        self._values = []  # Indexed by slot; None when free
+        self._ids = []  # The id of each slot's current generation
+        self._free = []  # Free slots, most recently freed last
+        self._size = 0
+
+    def add(self, value):
+        """Put value, which mustn't be None, in a free slot.
+
+        Returns:
+            (int) The message id to find it by.
+        """
+        self._size += 1
+        if self._free:
+            slot = self._free.pop()
+            self._values[slot] = value
+            return self._ids[slot]
+        slot = len(self._values)
+        self._values.append(value)
+        message_id = (slot << GENERATION_BITS) + 1
+        self._ids.append(message_id)
+        return message_id
+
+    def _slot(self, message_id):
+        # The slot holding message_id's request, or -1 if it has gone.
+        slot = (message_id - 1) >> GENERATION_BITS
+        if (0 <= slot < len(self._ids) and self._ids[slot] == message_id and
+                self._values[slot] is not None and
+                self._values[slot] is not _ABANDONED):
+            return slot
+        return -1
 
-    def get_id(self):
-        if len(self.pool) > 0:
-            return self.pool.pop()
+    def get(self, message_id, default=None):
+        """Get message_id's value, or default if it has been popped."""
+        slot = self._slot(message_id)
+        return default if slot < 0 else self._values[slot]
+
+    def pop(self, message_id, default=None):
+        """Remove message_id's value and free its slot.
+
+        Returns:
+            The value, or default if message_id was popped already.
+        """
+        slot = (message_id - 1) >> GENERATION_BITS
+        try:
+            # Ids are positive, so one which isn't matches no slot, even
+            # indexing from the end.
+            if self._ids[slot] != message_id:
+                return default
+        except IndexError:
+            return default
+        value = self._values[slot]
+        if value is None:
+            return default
+        if value is _ABANDONED:
+            value = default
         else:
-            to_return = self.next_id
-            self.next_id += 1
-            return to_return
-
-    def return_id(self, n):
-        if n in self.pool:
-            raise ValueError("Pool already has id {}".format(n))
-        self.pool.add(n)
+            self._size -= 1
+        self._values[slot] = None
+        if message_id & GENERATION_MASK:
+            self._ids[slot] = message_id + 1
+        else:  # Wrap around to generation 0.
+            self._ids[slot] = message_id - GENERATION_MASK
+        self._free.append(slot)
+        return value
+
+    def abandon(self, message_id):
+        """Remove message_id's value, but keep its slot until message_id is
+        popped, when its response arrives.
+
+        Returns:
+            The value, or None if message_id was popped or abandoned
+                already.
+        """
+        slot = self._slot(message_id)
+        if slot < 0:
+            return None
+        value = self._values[slot]
+        self._values[slot] = _ABANDONED
+        self._size -= 1
+        return value
+
+    def __contains__(self, message_id):
+        return self._slot(message_id) >= 0
+
+    def __len__(self):
+        return self._size
+
+    def items(self):
+        """Get (message id, value) for every request in the table."""
+        return [(message_id, value)
+                for message_id, value in zip(self._ids, self._values)
+                if value is not None and value is not _ABANDONED]
+
+    def values(self):
+        return [value for value in self._values
+                if value is not None and value is not _ABANDONED]
+
+    def clear(self):
+        """Pop everything, abandoned slots included, keeping the slots'
+        generations."""
+        for message_id, value in zip(list(self._ids), self._values):
+            if value is not None:
+                self.pop(message_id)
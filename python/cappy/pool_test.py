@@ -0,0 +1,87 @@
+import pytest
+
+
+import cappy.pool as pool
+
+
+def test_add_get_pop():
+    table = pool.PendingTable()
+    ids = [table.add(x) for x in 'abc']
+    assert len(set(ids)) == 3 and all(i > 0 for i in ids)
+    assert len(table) == 3
+    assert [table.get(i) for i in ids] == ['a', 'b', 'c']
+    assert table.pop(ids[1]) == 'b'
+    assert ids[1] not in table
+    assert table.get(ids[1]) is None
+    assert sorted(table.items()) == [(ids[0], 'a'), (ids[2], 'c')]
+    assert len(table) == 2
+
+
+def test_reused_slot_gets_new_id():
+    table = pool.PendingTable()
+    old = table.add('old')
+    table.pop(old)
+    new = table.add('new')
+    assert new != old
+    assert (new - 1) >> pool.GENERATION_BITS == 0  # Same slot
+    # A late or repeated response for the old id finds nothing.
+    assert table.pop(old, 'stale') == 'stale'
+    assert table.pop(new) == 'new'
+    assert table.pop(new) is None
+
+
+@pytest.mark.parametrize('message_id', [0, -1, 1 << 40])
+def test_unknown_ids(message_id):
+    table = pool.PendingTable()
+    table.add('x')
+    assert table.get(message_id) is None
+    assert message_id not in table
+
+
+def test_generations_wrap():
+    table = pool.PendingTable()
+    ids = set()
+    for _ in range(1 << pool.GENERATION_BITS):
+        message_id = table.add('x')
+        ids.add(message_id)
+        table.pop(message_id)
+    assert len(ids) == 1 << pool.GENERATION_BITS
+    assert table.add('x') in ids
+
+
+def test_many_in_flight():
+    table = pool.PendingTable()
+    ids = [table.add(n) for n in range(100000)]
+    assert len(table) == 100000
+    assert all(table.pop(ids[n]) == n for n in range(0, 100000, 2))
+    again = [table.add(n) for n in range(50000)]
+    assert not set(again) & set(ids)
+    assert len(table._values) == 100000  # Reused the freed slots.
+    table.clear()
+    assert len(table) == 0 and table.values() == []
+    assert all(i not in table for i in again)
+
+
+def test_abandoned_slot_is_kept_until_popped():
+    table = pool.PendingTable()
+    old = table.add('old')
+    assert table.abandon(old) == 'old'
+    assert table.abandon(old) is None
+    assert len(table) == 0 and old not in table and table.values() == []
+    # However many requests come and go, none gets the abandoned id.
+    for _ in range(2 << pool.GENERATION_BITS):
+        message_id = table.add('x')
+        assert message_id != old
+        table.pop(message_id)
+    assert table.pop(old, 'late') == 'late'
+    assert table.add('new') != old
+    assert len(table._values) == 2
+
+
+def test_clear_frees_abandoned_slots():
+    table = pool.PendingTable()
+    table.abandon(table.add('old'))
+    live = table.add('live')
+    table.clear()
+    assert len(table) == 0 and live not in table
+    assert sorted(table._free) == [0, 1]
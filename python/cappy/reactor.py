@@ -1,5 +1,13 @@
 from abc import ABCMeta, abstractmethod
-import select
+import collections
+import heapq
+import logging
+import selectors
+import signal
+import socket
+import time
+
+logger = logging.getLogger(__name__)
 
 
 class Reactor:
@@ -7,50 +15,237 @@ class Reactor:
 
     The Reactor (so called because it reacts to network activity), is an event
     loop which notifies handlers when they have data ready to be read. Each
-    handler must have the interface described by the Handler class above.
+    handler must have the interface described by the Handler class below.
+
+    The magic bit of the Reactor is the selectors module, which uses the best
+    readiness API the platform has (epoll on Linux, kqueue on BSD/macOS). Each
+    handler is registered with the selector once, along with the events it is
+    interested in. Waiting for I/O then costs time proportional to the number
+    of handlers which are actually ready, not the number registered.
+
+    A handler's interest is re-checked after each time it is dispatched. If a
+    handler's interest changes for some other reason (e.g. another connection
+    queued data for it to write), call update_handler so the selector finds
+    out.
+
+    Functions passed to call_soon run after the I/O handlers on the next
+    time around the loop. This is how Futures created with
+    scheduler=reactor.call_soon run their callbacks. Functions passed to
+    call_later are kept in a heap ordered by deadline, and the time until
+    the earliest one is how long we let the selector block. Cancelled timers
+    stay in the heap until they reach the top, unless they come to make up
+    most of it, when we rebuild it without them; so scheduling and
+    cancelling each cost O(log n), even when most timers are cancelled, as
+    request deadlines are.
 
-    The magic bit of the Reactor is the system call 'select'. Select takes two
-    arguments, a list of readers and a list of writers. The call returns when
-    at least one of the readers or writers can read or write without blocking.
-    See the documentation for select for details.
+    An Exception from a handler, callback or timer is logged, and the loop
+    carries on. A handler which raised is passed to its handle_error method,
+    which by default removes and closes it, so one bad connection doesn't
+    take the others down with it. Anything else, like KeyboardInterrupt,
+    propagates out of run.
     """
-    def __init__(self):
+    def __init__(self, selector=None):
         self.fileno_map = {}  # fileno -> Handler
+        self.interest_map = {}  # fileno -> selector event mask
+        self.ready = collections.deque()  # (function, args) to call soon
+        self.timers = []  # heap of Timer
+        self._cancelled_timers = 0  # Number of cancelled Timers in the heap
+        self.signal_handlers = {}  # signal number -> function
+        self._stopping = False
+        if selector is None:
+            selector = selectors.DefaultSelector()
+        self.selector = selector
+        self._wakeup = _WakeupHandler(self)
+        self.add_handler(self._wakeup)
+
+    @staticmethod
+    def _interest(handler):
+        events = 0
+        if handler.register_as_reader():
+            events |= selectors.EVENT_READ
+        if handler.register_as_writer():
+            events |= selectors.EVENT_WRITE
+        return events
 
     def add_handler(self, handler):
-        self.fileno_map[handler.fileno()] = handler
+        fileno = handler.fileno()
+        self.fileno_map[fileno] = handler
+        self.interest_map[fileno] = 0
+        self.update_handler(handler)
 
     def remove_handler(self, handler):
-        del self.fileno_map[handler.fileno()]
+        fileno = handler.fileno()
+        del self.fileno_map[fileno]
+        if self.interest_map.pop(fileno):
+            self.selector.unregister(fileno)
+
+    def update_handler(self, handler):
+        """Tell the selector about a change in a handler's interest.
+
+        This is cheap when nothing changed, so handlers may call it whenever
+        their interest might have changed.
+        """
+        fileno = handler.fileno()
+        old = self.interest_map.get(fileno)
+        if old is None:  # Handler has been removed.
+            return
+        new = self._interest(handler)
+        if new == old:
+            return
+        if not old:
+            self.selector.register(fileno, new, handler)
+        elif not new:
+            self.selector.unregister(fileno)
+        else:
+            self.selector.modify(fileno, new, handler)
+        self.interest_map[fileno] = new
+
+    def call_soon(self, function, *args):
+        """Call function(*args) on the next time around the loop."""
+        self.ready.append((function, args))
+
+    def call_soon_threadsafe(self, function, *args):
+        """Like call_soon, but may be called from any thread.
+
+        We also wake the reactor up, in case it is blocked in select.
+        """
+        self.ready.append((function, args))
+        self._wakeup.wake()
+
+    def call_later(self, delay, function, *args):
+        """Call function(*args) after delay seconds.
+
+        Returns:
+            Timer: Call its cancel method to stop the call happening.
+        """
+        timer = Timer(time.monotonic() + delay, function, args, self)
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def _timer_cancelled(self):
+        self._cancelled_timers += 1
+        timers = self.timers
+        if self._cancelled_timers > 64 and \
+                2 * self._cancelled_timers > len(timers):
+            timers[:] = [t for t in timers if not t.cancelled]
+            heapq.heapify(timers)
+            self._cancelled_timers = 0
+
+    def add_signal_handler(self, signum, function):
+        """Call function() from the loop when we receive signal signum.
+
+        Like asyncio, we have the signal module write signal numbers to a
+        socket the loop watches, so a signal wakes up a blocked select and
+        function runs as an ordinary callback rather than in a signal
+        handler. Only works in the main thread.
+        """
+        signal.set_wakeup_fd(self._wakeup._write_socket.fileno())
+        self.signal_handlers[signum] = function
+        signal.signal(signum, _ignore_signal)
+
+    def stop(self):
+        """Make run return after the current time around the loop."""
+        self._stopping = True
+
+    def close(self):
+        """Close every handler, and the selector."""
+        for handler in list(self.fileno_map.values()):
+            handler.close()
+        self.fileno_map.clear()
+        self.interest_map.clear()
+        self.selector.close()
+
+    def _is_registered(self, fileno, handler):
+        return self.fileno_map.get(fileno) is handler
+
+    def run_once(self, timeout=None):
+        """Wait for I/O once, dispatch ready handlers and run callbacks."""
+        timers = self.timers
+        if self.ready:
+            timeout = 0
+        elif timers:
+            while timers and timers[0].cancelled:
+                heapq.heappop(timers)
+                self._cancelled_timers -= 1
+            if timers:
+                delay = max(0, timers[0].when - time.monotonic())
+                timeout = delay if timeout is None else min(timeout, delay)
+        for key, events in self.selector.select(timeout):
+            handler = key.data
+            fileno = key.fd
+            try:
+                if events & selectors.EVENT_READ:
+                    handler.read()
+                if events & selectors.EVENT_WRITE and \
+                        self._is_registered(fileno, handler):
+                    handler.write()
+            except Exception:
+                logger.exception("Error in handler %r", handler)
+                if self._is_registered(fileno, handler):
+                    handler.handle_error(self)
+                continue
+            if self._is_registered(fileno, handler):
+                self.update_handler(handler)
+        # Only run what is ready now; anything these schedule waits for the
+        # next time around, so I/O isn't starved.
+        ready = self.ready
+        for _ in range(len(ready)):
+            function, args = ready.popleft()
+            try:
+                function(*args)
+            except Exception:
+                logger.exception("Error in callback %r", function)
+        if timers:
+            now = time.monotonic()
+            while timers and timers[0].when <= now:
+                timer = heapq.heappop(timers)
+                if timer.cancelled:
+                    self._cancelled_timers -= 1
+                else:
+                    timer.reactor = None  # Fired; cancel is a no-op now.
+                    try:
+                        timer.function(*timer.args)
+                    except Exception:
+                        logger.exception("Error in timer %r", timer.function)
 
     def run(self):
         """Run the reactor (i.e. event loop).
 
-        Each time around the loop, we find out which of our handlers wants to
-        register as a reader or writer. When then pass the readers and writers
-        to select, and block until one or more of them is ready for I/O. Then,
-        we call their read() or write() methods as appropriate.
+        Each time around the loop, we block until one or more handlers is
+        ready for I/O. Then, we call their read() or write() methods as
+        appropriate.
         """
-        try:
-            while 1:
-                readers = []
-                writers = []
-                for fileno, elem in self.fileno_map.items():
-                    if elem.register_as_reader():
-                        readers.append(fileno)
-                    if elem.register_as_writer():
-                        writers.append(fileno)
-
-                readers_ready, writers_ready, _ = select.select(
-                        readers, writers, [])
-                for reader in readers_ready:
-                    self.fileno_map[reader].read()
-                for writer in writers_ready:
-                    self.fileno_map[writer].write()
-        except:
-            for handler in self.fileno_map.values():
-                handler.close()
-                raise
+        self._stopping = False
+        while not self._stopping:
+            self.run_once()
+
+
+class Timer:
+    """A call scheduled with Reactor.call_later."""
+
+    __slots__ = ('when', 'function', 'args', 'cancelled', 'reactor')
+
+    def __init__(self, when, function, args, reactor=None):
+        self.when = when
+        self.function = function
+        self.args = args
+        self.cancelled = False
+        self.reactor = reactor  # Until we fire
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.reactor is not None:
+            self.reactor._timer_cancelled()
+
+
+def _ignore_signal(signum, frame):
+    # The signal module still writes signum to the wakeup fd.
+    pass
 
 
 class Handler(metaclass=ABCMeta):
@@ -81,3 +276,63 @@ class Handler(metaclass=ABCMeta):
         Usually, return the fileno of a socket I represent.
         """
 
+    def handle_error(self, reactor):
+        """Called by reactor when my read or write raised an Exception.
+
+        The reactor has logged it already. By default I am removed from the
+        reactor and closed.
+        """
+        reactor.remove_handler(self)
+        self.close()
+
+
+
+class _WakeupHandler(Handler):
+    """Wakes the reactor up from other threads or signal handlers.
+
+    The signal module writes signal numbers to our socket (see
+    Reactor.add_signal_handler), and call_soon_threadsafe writes a 0 byte,
+    which is not a signal number.
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.socket, self._write_socket = socket.socketpair()
+        self.socket.setblocking(False)
+        self._write_socket.setblocking(False)
+
+    def wake(self):
+        try:
+            self._write_socket.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass  # Full, so a wakeup is pending anyway.
+
+    def register_as_reader(self):
+        return True
+
+    def register_as_writer(self):
+        return False
+
+    def read(self):
+        try:
+            data = self.socket.recv(4096)
+        except BlockingIOError:
+            return
+        for signum in data:
+            if not signum:
+                continue
+            function = self.reactor.signal_handlers.get(signum)
+            if function is not None:
+                function()
+
+    def write(self):
+        raise RuntimeError("Unreachable")
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def close(self):
+        if self.reactor.signal_handlers:
+            signal.set_wakeup_fd(-1)
+        self.socket.close()
+        self._write_socket.close()
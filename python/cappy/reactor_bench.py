@@ -0,0 +1,148 @@
+"""Benchmark Reactor wakeup cost against the number of idle handlers.
+
+One handler is woken up over and over while N other handlers sit idle. With
+the selectors-based Reactor the cost of a wakeup should not depend on N. For
+comparison, we also time a bare select() call over the same descriptors,
+which is what the original Reactor did every time around the loop (it also
+asked every handler for its interest first). select() can't be used once a
+descriptor number reaches FD_SETSIZE (1024), so it is skipped beyond that.
+
+Idle handlers use eventfds where available (one descriptor each), otherwise
+socket pairs. 10k idle handlers therefore need a descriptor limit above 10k
+(20k without eventfd); see `ulimit -n`.
+
+Run from the python directory:
+```
+python -m cappy.reactor_bench --idle 0 100 1000 10000
+```
+"""
+import argparse
+import os
+import select
+import socket
+import time
+
+
+import cappy.reactor as reactor
+
+
+class IdleHandler(reactor.Handler):
+
+    def __init__(self):
+        if hasattr(os, 'eventfd'):
+            self.fd = os.eventfd(0)
+            self.other = None
+        else:
+            self.sock, self.other = socket.socketpair()
+            self.fd = self.sock.fileno()
+
+    def register_as_reader(self):
+        return True
+
+    def register_as_writer(self):
+        return False
+
+    def read(self):
+        raise RuntimeError("Idle handler should never be read")
+
+    def write(self):
+        raise RuntimeError("Unreachable")
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.other is None:
+            os.close(self.fd)
+        else:
+            self.sock.close()
+            self.other.close()
+
+
+class PingHandler(reactor.Handler):
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.reads = 0
+
+    def register_as_reader(self):
+        return True
+
+    def register_as_writer(self):
+        return False
+
+    def read(self):
+        self.socket.recv(1)
+        self.reads += 1
+
+    def write(self):
+        raise RuntimeError("Unreachable")
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def close(self):
+        self.socket.close()
+
+
+def time_reactor(r, ping, peer, wakeups):
+    t0 = time.perf_counter()
+    for _ in range(wakeups):
+        peer.send(b'x')
+        r.run_once()
+    elapsed = time.perf_counter() - t0
+    assert ping.reads == wakeups
+    ping.reads = 0
+    return elapsed / wakeups
+
+
+def time_select(handlers, ping, peer, wakeups):
+    t0 = time.perf_counter()
+    for _ in range(wakeups):
+        peer.send(b'x')
+        readers = [h.fileno() for h in handlers if h.register_as_reader()]
+        ready, _, _ = select.select(readers, [], [])
+        for fd in ready:
+            if fd == ping.fileno():
+                ping.read()
+    elapsed = time.perf_counter() - t0
+    assert ping.reads == wakeups
+    ping.reads = 0
+    return elapsed / wakeups
+
+
+def main(idle_counts, wakeups):
+    print("{:>8} {:>16} {:>16}".format(
+        "idle", "selectors (us)", "select (us)"))
+    for n in idle_counts:
+        r = reactor.Reactor()
+        idle = []
+        a, b = socket.socketpair()
+        ping = PingHandler(a)
+        try:
+            for _ in range(n):
+                idle.append(IdleHandler())
+                r.add_handler(idle[-1])
+            r.add_handler(ping)
+            per_wakeup = time_reactor(r, ping, b, wakeups)
+            handlers = idle + [ping]
+            if max(h.fileno() for h in handlers) < 1024:
+                select_time = "{:16.1f}".format(
+                    1e6 * time_select(handlers, ping, b, wakeups))
+            else:
+                select_time = "{:>16}".format("n/a")
+            print("{:>8} {:16.1f} {}".format(n, 1e6 * per_wakeup, select_time))
+        finally:
+            r.close()  # Closes the idle handlers and a.
+            b.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Reactor wakeup benchmark')
+    parser.add_argument('--idle', type=int, nargs='+',
+                        default=[0, 100, 1000, 10000],
+                        help="Numbers of idle handlers to try")
+    parser.add_argument('--wakeups', type=int, default=2000,
+                        help="Number of wakeups to time for each count")
+    args = parser.parse_args()
+    main(args.idle, args.wakeups)
@@ -0,0 +1,334 @@
+import os
+import signal
+import socket
+import threading
+import time
+
+
+import pytest
+
+
+import cappy.demo_protocol as demo_protocol
+import cappy.memo as memo
+import cappy.reactor as reactor
+import cappy.server_futures as server_futures
+import cappy.stream as stream
+
+
+class RecordingHandler(reactor.Handler):
+
+    def __init__(self, sock, want_write=False):
+        self.socket = sock
+        self.want_write = want_write
+        self.reads = 0
+        self.writes = 0
+
+    def register_as_reader(self):
+        return True
+
+    def register_as_writer(self):
+        return self.want_write
+
+    def read(self):
+        self.reads += 1
+        self.socket.recv(1024)
+
+    def write(self):
+        self.writes += 1
+        self.want_write = False
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def close(self):
+        self.socket.close()
+
+
+@pytest.fixture
+def r():
+    r = reactor.Reactor()
+    yield r
+    r.close()
+
+
+@pytest.fixture
+def socket_pair():
+    a, b = socket.socketpair()
+    yield a, b
+    a.close()
+    b.close()
+
+
+@pytest.fixture
+def idle_socket_pairs():
+    # 600 pairs is 1200 descriptors, so some of them are above select()'s
+    # FD_SETSIZE of 1024.
+    pairs = []
+    try:
+        for _ in range(600):
+            pairs.append(socket.socketpair())
+        yield pairs
+    finally:
+        for a, b in pairs:
+            a.close()
+            b.close()
+
+
+def test_only_ready_handlers_are_dispatched(
+        r, socket_pair, idle_socket_pairs):
+    idle = [RecordingHandler(x) for x, _ in idle_socket_pairs]
+    for h in idle:
+        r.add_handler(h)
+    a, b = socket_pair
+    active = RecordingHandler(a)
+    r.add_handler(active)
+    assert max(r.fileno_map) > 1024
+    b.send(b'x')
+    r.run_once(timeout=1)
+    assert active.reads == 1
+    assert all(h.reads == 0 for h in idle)
+
+
+def test_writer_interest_is_updated(r, socket_pair):
+    a, _ = socket_pair
+    h = RecordingHandler(a)
+    r.add_handler(h)
+    assert r.interest_map[h.fileno()] == reactor.selectors.EVENT_READ
+    h.want_write = True
+    r.update_handler(h)
+    r.run_once(timeout=1)
+    assert h.writes == 1
+    # Interest is re-checked after dispatch.
+    assert r.interest_map[h.fileno()] == reactor.selectors.EVENT_READ
+
+
+def test_call_soon(r):
+    calls = []
+    def again():
+        calls.append('again')
+    def first(x):
+        calls.append(x)
+        r.call_soon(again)
+    r.call_soon(first, 1)
+    r.run_once(timeout=None)  # Must not block: a callback is ready.
+    assert calls == [1]
+    r.run_once(timeout=None)
+    assert calls == [1, 'again']
+
+
+def test_call_later(r):
+    calls = []
+    r.call_later(0.02, calls.append, 'second')
+    r.call_later(0.01, calls.append, 'first')
+    r.call_later(0.01, calls.append, 'cancelled').cancel()
+    t0 = time.monotonic()
+    while len(calls) < 2:
+        r.run_once(timeout=None)  # Blocks only until the next timer.
+    assert calls == ['first', 'second']
+    assert time.monotonic() - t0 < 1
+    assert not r.timers
+
+
+def test_cancelled_timers_are_compacted(r):
+    timers = [r.call_later(60 + i, print) for i in range(1000)]
+    for timer in timers[:900]:
+        timer.cancel()
+        timer.cancel()  # Counted once.
+    assert len(r.timers) < 300
+    assert sorted(t.when for t in r.timers if not t.cancelled) == \
+        [t.when for t in timers[900:]]
+
+
+def test_stop(r):
+    r.call_later(0, r.stop)
+    r.run()  # Returns rather than looping forever.
+
+
+def test_signal_handler(r):
+    calls = []
+    old = signal.getsignal(signal.SIGUSR1)
+    try:
+        r.add_signal_handler(signal.SIGUSR1, lambda: calls.append(1))
+        os.kill(os.getpid(), signal.SIGUSR1)
+        r.run_once(timeout=1)
+        assert calls == [1]
+    finally:
+        r.close()
+        signal.signal(signal.SIGUSR1, old)
+
+
+def test_call_soon_threadsafe_wakes_reactor(r):
+    calls = []
+    def later():
+        time.sleep(0.05)
+        r.call_soon_threadsafe(calls.append, 1)
+    thread = threading.Thread(target=later)
+    thread.start()
+    try:
+        t0 = time.monotonic()
+        r.run_once(timeout=5)  # Blocked in select when the call comes.
+        assert calls == [1]
+        assert time.monotonic() - t0 < 1
+    finally:
+        thread.join()
+
+
+def test_remove_handler(r, socket_pair):
+    a, b = socket_pair
+    h = RecordingHandler(a)
+    r.add_handler(h)
+    r.remove_handler(h)
+    b.send(b'x')
+    r.run_once(timeout=0)
+    assert h.reads == 0
+    assert h.fileno() not in r.fileno_map
+
+
+class FailingHandler(RecordingHandler):
+
+    def read(self):
+        super().read()
+        raise RuntimeError("bad handler")
+
+
+def test_handler_error_closes_only_that_handler(r, socket_pair):
+    a, b = socket_pair
+    c, d = socket.socketpair()
+    bad = FailingHandler(a)
+    good = RecordingHandler(c)
+    r.add_handler(bad)
+    r.add_handler(good)
+    b.send(b'x')
+    d.send(b'x')
+    r.run_once(timeout=0)
+    d.close()
+    assert bad.fileno() == -1
+    assert bad not in r.fileno_map.values()
+    assert good.reads == 1 and good in r.fileno_map.values()
+
+
+def test_callback_errors_are_logged(r, caplog):
+    calls = []
+
+    def fail():
+        raise RuntimeError("bad callback")
+
+    r.call_soon(fail)
+    r.call_soon(calls.append, 1)
+    r.call_later(0, fail)
+    r.call_later(0, calls.append, 2)
+    r.run_once(timeout=0)
+    r.run_once(timeout=0)
+    assert calls == [1, 2]
+    assert len([rec for rec in caplog.records
+                if rec.exc_info and rec.name == 'cappy.reactor']) == 2
+
+
+def test_base_exceptions_propagate(r):
+
+    def interrupt():
+        raise KeyboardInterrupt()
+
+    r.call_soon(interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        r.run()
+
+
+def test_client_handler_round_trip(r, socket_pair):
+    memo.clear_all()  # add is cacheable; make sure it runs.
+    server_sock, client_sock = socket_pair
+    handler = server_futures.ClientHandler(
+        server_sock, None, r.remove_handler, r.update_handler)
+    r.add_handler(handler)
+    s = stream.Stream(stream.VarintByteStream(), stream.JSONParser())
+
+    client_sock.settimeout(0)
+
+    def receive_one():
+        for _ in range(10):
+            r.run_once(timeout=0.1)
+            try:
+                messages = s.receive(client_sock.recv(1024))
+            except BlockingIOError:
+                continue
+            messages = [m for m in messages if m['id'] != 0]
+            if messages:
+                return messages
+        raise AssertionError("No message received")
+
+    client_sock.sendall(
+        s.pack_message({'method': 'add', 'args': [1, 2], 'id': 1}))
+    [request] = receive_one()
+    assert request['method'] == 'echo'
+    assert request['args'] == 3
+    assert not handler.idle()  # Still waiting to answer add.
+    client_sock.sendall(s.pack_message({'id': -request['id'], 'result': 3}))
+    [response] = receive_one()
+    assert response == {'id': -1, 'result': 3}
+    assert handler.idle()
+
+
+def test_client_handler_flushes_queued_chunks(socket_pair):
+    server_sock, client_sock = socket_pair
+    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    handler = server_futures.ClientHandler(server_sock, None, None)
+    handler.out_chunks.clear()  # Drop the protocol's hello message.
+    handler.out_bytes = 0
+    chunks = [bytes([i % 256]) * (i * 37 % 1000 + 1) for i in range(500)]
+    for chunk in chunks:
+        handler.add_to_buf(chunk)
+    expected = b''.join(chunks)
+    assert handler.out_bytes == len(expected)
+
+    received = bytearray()
+    while handler.register_as_writer():
+        handler.write()
+        while 1:
+            try:
+                received += client_sock.recv(65536, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+    assert received == expected
+    assert handler.out_bytes == 0
+    assert handler.out_offset == 0
+
+
+def test_client_handler_write_to_closed_peer(socket_pair):
+    server_sock, client_sock = socket_pair
+    closed = []
+    handler = server_futures.ClientHandler(server_sock, None, closed.append)
+    client_sock.close()
+    handler.write()
+    assert closed == [handler]
+
+
+@pytest.mark.parametrize('data', [
+    stream.encode_varint(1 << 30),  # Over max_frame_length
+    b'\x02\xee\x00',  # Unknown marker
+    b'\x03\x01\x0c\xff',  # Truncated binary message
+])
+def test_client_handler_closes_on_bad_input(socket_pair, data):
+    server_sock, client_sock = socket_pair
+    closed = []
+    handler = server_futures.ClientHandler(server_sock, None, closed.append)
+    client_sock.sendall(data)
+    handler.read()
+    assert closed == [handler]
+
+
+def test_client_handler_stops_reading_above_write_high(socket_pair):
+    server_sock, client_sock = socket_pair
+    changes = []
+    handler = server_futures.ClientHandler(
+        server_sock, None, None, changes.append,
+        flow=demo_protocol.FlowControl(write_high=1000, write_low=100))
+    assert handler.register_as_reader()
+    handler.add_to_buf(b'x' * 2000)
+    assert handler.protocol.write_paused
+    assert not handler.register_as_reader()
+    assert changes
+    while handler.register_as_writer():
+        handler.write()
+        client_sock.recv(65536)
+    assert not handler.protocol.write_paused
+    assert handler.register_as_reader()
@@ -1,31 +1,42 @@
+import argparse
+import collections
+import functools
+import itertools
+import logging
+import os
+import signal
 import socket
+import time
 
 
-from cappy.calculator import CalculatorFutures as Calculator
-from cappy.future import Future, call_as_future
+from cappy.calculator import CalculatorFutures as Calculator, register_codecs
+from cappy.future import CancelledError, Future
+from cappy.metrics import Metrics
 import cappy.demo_protocol as cprotocol
+import cappy.dispatch as dispatch
+import cappy.endpoints as endpoints
+import cappy.offload as offload
 from cappy.reactor import Handler, Reactor
+import cappy.shm as shm
+import cappy.stream as stream
+from cappy.workers import get_listen_socket, run_workers
 
 
-def get_listen_socket(host, port):
-    """Get a socket that listens for incoming connections.
+logger = logging.getLogger(__name__)
 
-    Args:
-        host (str): Hostname, i.e. 'localhost'.
-        port (int): Port on which to listen for incoming connections.
-
-    Returns (socket): A socket listening for connections on the given host and
-        port.
-    """
-    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    listen_socket.bind((host, port))
-    listen_socket.listen(1)
-    return listen_socket
+_HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = -1
+if _IOV_MAX <= 0:
+    _IOV_MAX = 1024
 
 
-def make_connection_handler(connection_made_callback, host, port):
+def make_connection_handler(connection_made_callback, host, port,
+                            backlog=128, reuse_port=False):
     """Get a connection handler."""
-    listen_socket = get_listen_socket(host, port)
+    listen_socket = get_listen_socket(host, port, backlog, reuse_port)
     connection_handler = ConnectionHandler(
             listen_socket,
             connection_made_callback)
@@ -44,6 +55,9 @@ class ConnectionHandler(Handler):
     """
     def __init__(self, socket, connection_made):
         self.socket = socket
+        # Several worker processes may share the socket, and all of them are
+        # woken for each connection, so accept mustn't block.
+        self.socket.setblocking(False)
         self.connection_made = connection_made
 
     def register_as_reader(self):
@@ -53,7 +67,10 @@ class ConnectionHandler(Handler):
         return False
 
     def read(self):
-        socket, addr = self.socket.accept()
+        try:
+            socket, addr = self.socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return  # Another worker got it.
         self.connection_made(socket, addr)
 
     def write(self):
@@ -62,29 +79,179 @@ class ConnectionHandler(Handler):
     def fileno(self):
         return self.socket.fileno()
 
+    def handle_error(self, reactor):
+        # A failed accept, e.g. for want of file descriptors, needn't stop
+        # us listening.
+        pass
+
     def close(self):
         self.socket.close()
 
 
 class Protocol(cprotocol.Protocol):
+    """Protocol for a Reactor.
+
+    Offloaded methods need a way back onto the reactor from a pool thread,
+    so we only offload if given call_soon_threadsafe (see
+    Reactor.call_soon_threadsafe) as well as executors. Similarly, requests
+    can only have timeouts if we are given Reactor.call_later.
+    """
 
-    def handle_inbound_request(self, message):
+    future_class = Future
+
+    def __init__(self, writer, future_factory, implementation_class,
+                 codecs=cprotocol.DEFAULT_CODECS, executors=None,
+                 call_soon_threadsafe=None, metrics=None, flow=None,
+                 call_later=None):
+        if call_soon_threadsafe is None:
+            executors = None
+        self.call_soon_threadsafe = call_soon_threadsafe
+        self._call_later = call_later
+        super().__init__(writer, future_factory, implementation_class, codecs,
+                         executors, metrics, flow)
+
+    def call_later(self, delay, function, *args):
+        if self._call_later is None:
+            raise RuntimeError("Timeouts need a call_later function")
+        return self._call_later(delay, function, *args)
+
+    def future_result(self, future):
+        if not future.done() or future.failed_with() is not None:
+            raise ValueError("Future has not succeeded")
+        return future.result
+
+    def chain_future(self, source, target):
+        source.add_callbacks(target.set_result, target.set_exception)
+
+    def wrap_concurrent_future(self, cf):
+        f = Future(canceller=lambda f: cf.cancel())
+
+        def settle():
+            if f.done():  # Cancelled.
+                return
+            exception = cf.exception()
+            if exception is None:
+                f.set_result(cf.result())
+            else:
+                f.set_exception(exception)
+
+        cf.add_done_callback(lambda cf: self.call_soon_threadsafe(settle))
+        return f
+
+    def handle_inbound_request(self, message, call, promised=()):
         message_id = message['id']
-        method_name = message['method']
         args = message['args']
-        if not isinstance(args, (tuple, list)):
-            args = (args,)
-        method = getattr(self.implementation, method_name)
-        future = call_as_future(method, *args)
-        def callback(result):
-            response = {'id': -message_id, 'result': result}
-            self.write(self.stream.pack_message(response))
-        future.add_callback(callback)
+        entry, obj = call
+
+        result = None
+        if not promised and entry.kind is dispatch.SYNC and \
+                (entry.policy is offload.INLINE or self.executors is None):
+            # Fast path: call straight away, and respond now if we can.
+            try:
+                result = entry.function(obj, *args)
+            except Exception as e:
+                self.send_error(message_id, e)
+                if message.get('promise'):
+                    return Future.failed(e)
+                return None
+            if type(result) is not Future:
+                self.send_response(message_id, result)
+                if message.get('promise'):
+                    return Future.succeeded(result)
+                return None
+
+        # If the peer cancels the request, we cancel whatever we are waiting
+        # for and answer with an error straight away. Anything which turns
+        # up later is ignored.
+        inner = []
+
+        def cancel(answer):
+            for f in inner:
+                f.cancel()
+            if not answer.done():
+                respond_error(CancelledError("Cancelled by peer"))
+
+        answer = Future(canceller=cancel)
+
+        def respond(result):
+            if not answer.done():
+                self.send_response(message_id, result)
+                answer.set_result(result)
+            return result
+
+        def respond_error(exception):
+            if not answer.done():
+                self.send_error(message_id, exception)
+                answer.set_exception(exception)
+            return exception
+
+        if result is not None:  # A Future from the fast path.
+            inner.append(result)
+            result.add_callbacks(respond, respond_error)
+            return answer
+
+        def invoke():
+            if answer.done():  # Cancelled while waiting for arguments.
+                return
+            if entry.kind is dispatch.COROUTINE:
+                respond_error(TypeError(
+                    "{} is a coroutine; use the asyncio server".format(
+                        entry.name)))
+                return
+            try:
+                if entry.policy is offload.INLINE or self.executors is None:
+                    result = entry.function(obj, *args)
+                else:
+                    result = self.offload(entry, obj, args)
+            except Exception as e:
+                respond_error(e)
+                return
+            if entry.kind is dispatch.FUTURE or type(result) is Future:
+                inner.append(result)
+                result.add_callbacks(respond, respond_error)
+            else:
+                respond(result)
+
+        if not promised:
+            invoke()
+            return answer
+
+        waiting = [len(promised)]
+        def fill(index):
+            def callback(result):
+                args[index] = result
+                waiting[0] -= 1
+                if not waiting[0]:
+                    invoke()
+                # Leave the result alone for anyone else waiting on it.
+                return result
+            return callback
+        def errback(exception):
+            if waiting[0] > 0:
+                waiting[0] = -1  # Respond with the first error only.
+                respond_error(exception)
+            return exception
+        for index, future in promised:
+            future.add_callbacks(fill(index), errback)
+        return answer
 
 
 class ClientHandler(Handler):
     """A handler representing a single client.
 
+    Outbound data is kept as a queue of chunks rather than one bytes object,
+    so queueing a message never copies the data already waiting. When the
+    socket is writable we hand as many chunks as we can to a single sendmsg
+    call (i.e. writev), and remember how far into the first chunk we got if
+    the send was partial.
+
+    Inbound data is read with recv_into straight into the protocol's framing
+    buffer, so reading doesn't allocate.
+
+    We stop reading while out_bytes is above the flow control write_high
+    mark, until it falls to write_low, and while the protocol doesn't want
+    input; see demo_protocol.FlowControl.
+
     Attributes:
         socket (socket): The socket through which we communicate with the
             client.
@@ -93,64 +260,469 @@ class ClientHandler(Handler):
             client.
         connection_closed (function): Function to call when the connection to
             the client is closed.
-        buf (str): Data buffer containing bytes to be sent to the client.
+        interest_changed (function): Function to call with this handler when
+            register_as_reader or register_as_writer may have changed value,
+            typically Reactor.update_handler.
+        recv_size (int): Number of bytes we ask for in each read.
+        codecs (tuple of str): Codecs to offer the client, in order of
+            preference; see demo_protocol.Protocol.
+        implementation_class (type): Class implementing the methods the
+            client may call.
+        future_factory (function): Makes the futures for our outbound
+            requests, e.g. a Future which runs its callbacks on the reactor.
+        executors (offload.Executors): Pools for offloaded methods.
+        call_soon_threadsafe (function): Schedules a call on the reactor
+            from another thread; needed to offload methods.
+        metrics (metrics.Metrics): Collects metrics if given.
+        flow (demo_protocol.FlowControl): Flow control limits.
+        call_later (function): Schedules a timer on the reactor, for
+            request timeouts.
+        call_soon (function): Schedules a call on the reactor. If given,
+            the protocol coalesces the messages it makes in one time around
+            the loop; see demo_protocol.Protocol.
+        out_chunks (deque of bytes): Data waiting to be sent to the client.
+        out_offset (int): Number of bytes of out_chunks[0] already sent.
+        out_bytes (int): Total number of unsent bytes in out_chunks.
     """
-    def __init__(self, socket, addr, connection_closed):
+    def __init__(self, socket, addr, connection_closed, interest_changed=None,
+                 recv_size=65536, codecs=cprotocol.DEFAULT_CODECS,
+                 implementation_class=Calculator, future_factory=Future,
+                 executors=None, call_soon_threadsafe=None, metrics=None,
+                 flow=None, call_later=None, call_soon=None):
         self.socket = socket
+        if socket is not None:
+            socket.setblocking(False)
         self.addr = addr
         self.connection_closed = connection_closed
-        self.buf = b''
-        self.protocol = Protocol(self.add_to_buf, Future, Calculator)
+        self.interest_changed = interest_changed
+        self.recv_size = recv_size
+        self.out_chunks = collections.deque()
+        self.out_offset = 0
+        self.out_bytes = 0
+        if flow is None:
+            flow = cprotocol.FlowControl()
+        self.write_high = flow.write_high
+        self.write_low = flow.write_low
+        self.protocol = None
+        self.protocol = Protocol(
+            self.add_to_buf, future_factory, implementation_class, codecs,
+            executors, call_soon_threadsafe, metrics, flow, call_later)
+        self.protocol.write_buffer_size = lambda: self.out_bytes
+        self.protocol.input_changed = self._interest_changed
+        if call_soon is not None and flow.flush_bytes is not None:
+            self.protocol.schedule_flush = call_soon
+
+    def _interest_changed(self):
+        if self.interest_changed is not None:
+            self.interest_changed(self)
 
     def add_to_buf(self, data):
-        self.buf += data
+        if not len(data):
+            return
+        was_empty = not self.out_chunks
+        self.out_chunks.append(data)
+        self.out_bytes += len(data)
+        if self.out_bytes > self.write_high and self.protocol is not None \
+                and not self.protocol.write_paused:
+            self.protocol.set_write_paused(True)
+            was_empty = True  # Stop reading, too.
+        if was_empty and self.interest_changed is not None:
+            self.interest_changed(self)
+
+    def idle(self):
+        """Whether we have no requests to answer and nothing left to send."""
+        return (not self.out_chunks and not self.protocol.unflushed_bytes
+                and not self.protocol.inbound_in_flight)
 
     def register_as_reader(self):
-        return True
+        return not self.protocol.write_paused and self.protocol.wants_input()
 
     def register_as_writer(self):
-        return len(self.buf) > 0
+        return len(self.out_chunks) > 0
 
     def read(self):
-        data = self.socket.recv(1024)
-        if len(data) == 0:  # Socket is closed
+        buf = self.protocol.get_buffer(self.recv_size)
+        try:
+            nbytes = self.socket.recv_into(buf, self.recv_size)
+        except (BlockingIOError, InterruptedError):
+            nbytes = None
+        except ConnectionError:
+            nbytes = 0
+        if not nbytes:
+            self.protocol.buffer_updated(0)
+            if nbytes == 0:  # Socket is closed
+                self.connection_closed(self)
+            return
+        self._dispatch(nbytes)
+
+    def _dispatch(self, nbytes):
+        try:
+            messages = self.protocol.buffer_updated(nbytes)
+        except stream.PARSE_ERRORS as e:
+            logger.warning("Closing connection from %s: bad input: %s",
+                           self.addr, e)
             self.connection_closed(self)
-        messages = self.protocol.data_received(data)
-        for m in messages:
-            if self.protocol.is_inbound_request(m):
-                    self.protocol.handle_inbound_request(m)
-            elif self.protocol.is_response(m):
-                self.protocol.handle_response(m)
+            return False
+        self.protocol.dispatch(messages)
+        return True
 
     def write(self):
-        num_bytes_sent = self.socket.send(self.buf)
-        self.buf = self.buf[num_bytes_sent:]
+        chunks = self.out_chunks
+        if len(chunks) == 1 or not _HAVE_SENDMSG:
+            iov = [chunks[0]]
+        else:
+            iov = list(itertools.islice(chunks, _IOV_MAX))
+        if self.out_offset:
+            iov[0] = memoryview(iov[0])[self.out_offset:]
+        try:
+            if _HAVE_SENDMSG:
+                num_bytes_sent = self.socket.sendmsg(iov)
+            else:
+                num_bytes_sent = self.socket.send(iov[0])
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:  # e.g. the client has gone
+            self.connection_closed(self)
+            return
+        self._sent(num_bytes_sent)
+
+    def _sent(self, num_bytes_sent):
+        self.out_bytes -= num_bytes_sent
+        # Drop the chunks which were sent completely.
+        chunks = self.out_chunks
+        sent = num_bytes_sent + self.out_offset
+        while chunks and sent >= len(chunks[0]):
+            sent -= len(chunks.popleft())
+        self.out_offset = sent
+        if self.protocol.write_paused and self.out_bytes <= self.write_low:
+            self.protocol.set_write_paused(False)
 
     def fileno(self):
         return self.socket.fileno()
 
+    def handle_error(self, reactor):
+        self.connection_closed(self)
+
     def close(self):
         self.socket.close()
+        self.protocol.connection_lost()
+
+
+class ShmClientHandler(ClientHandler):
+    """A ClientHandler for a peer on this host, reached through a
+    shm.Channel rather than a socket.
+
+    We watch the channel's doorbell, which the peer rings when it has
+    written to us or made room for us to write. Outbound data is queued as
+    usual, and copied into the ring once per time around the loop, by a
+    call_soon callback. When we don't want input we leave the data in the
+    ring, but still listen to the doorbell, since we may be waiting for room
+    to write.
+
+    Attributes:
+        channel (shm.Channel): Our end of the shared memory.
+        call_soon (function): Schedules a call on the reactor.
+    """
+
+    def __init__(self, channel, addr, connection_closed, interest_changed,
+                 call_soon, **kwargs):
+        self.channel = channel
+        self.call_soon = call_soon
+        self._flush_scheduled = False
+        self._stalled = False  # Data is waiting which we didn't want.
+        super().__init__(None, addr, connection_closed, interest_changed,
+                         call_soon=call_soon, **kwargs)
+
+    def _interest_changed(self):
+        super()._interest_changed()
+        # The doorbell won't ring again for data already in the ring.
+        if self._stalled:
+            self._stalled = False
+            self.call_soon(self._receive)
+
+    def add_to_buf(self, data):
+        super().add_to_buf(data)
+        if self.out_chunks and not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.call_soon(self.write)
+
+    def idle(self):
+        try:
+            return super().idle() and not self.channel.available()
+        except shm.RingError:
+            return True  # Nothing more will come of it.
 
+    def register_as_reader(self):
+        return not self.channel.closed
 
-def main():
+    def register_as_writer(self):
+        return False
+
+    def read(self):
+        alive = self.channel.clear_wakeups()
+        if self.out_chunks and alive:
+            self.write()
+        self._receive()
+        if not alive and not self.channel.closed and \
+                not self.channel.available():
+            self.connection_closed(self)
+
+    def _receive(self):
+        channel = self.channel
+        protocol = self.protocol
+        try:
+            while not channel.closed:
+                n = channel.available()
+                if not n:
+                    return
+                if not super().register_as_reader():  # We don't want input.
+                    self._stalled = True
+                    return
+                if not self._dispatch(
+                        channel.recv_into(protocol.get_buffer(n))):
+                    return
+        except shm.RingError as e:
+            self._ring_error(e)
+
+    def _ring_error(self, e):
+        logger.warning("Closing connection from %s: %s", self.addr, e)
+        self.connection_closed(self)
+
+    def write(self):
+        self._flush_scheduled = False
+        if self.out_chunks and not self.channel.closed:
+            try:
+                sent = self.channel.send(self.out_chunks, self.out_offset)
+            except shm.RingError as e:
+                self._ring_error(e)
+                return
+            self._sent(sent)
+        # If anything is left the ring is full, and the peer rings us when
+        # it has made room.
+        if self._stalled and super().register_as_reader():
+            self._stalled = False  # No longer paused for writing.
+            self._receive()
+
+    def fileno(self):
+        return self.channel.fileno()
+
+    def close(self):
+        self.channel.close()
+        self.protocol.connection_lost()
+
+
+def serve(host='localhost', port=12344, backlog=128, reuse_port=False,
+          listen_socket=None, drain_timeout=10.0, max_threads=None,
+          max_processes=None, metrics_file=None, flow=None,
+          listeners=(), codecs=cprotocol.DEFAULT_CODECS):
+    """Serve on a Reactor until SIGTERM, then drain and return.
+
+    On SIGTERM we stop accepting connections, and close each connection as
+    soon as it has answered the requests it has received, waiting at most
+    drain_timeout seconds.
+
+    Args:
+        port (int): Port to listen on with TCP, or None to use only
+            listeners.
+        listen_socket (socket): Accept connections on this socket, e.g. one
+            shared by several worker processes, rather than making one.
+        max_threads, max_processes (int): Pool sizes for offloaded methods;
+            see cappy.offload.
+        metrics_file (str): If given, collect metrics and write a snapshot
+            to this file on SIGUSR1 and when we stop.
+        flow (demo_protocol.FlowControl): Flow control limits for each
+            connection.
+        listeners (list of (endpoints.Endpoint, socket)): Also accept
+            connections on these listening sockets, from endpoints.listen.
+        codecs (tuple of str): Codecs to offer clients, most preferred
+            first.
+    """
     reactor = Reactor()
+    executors = offload.Executors(max_threads, max_processes)
+    metrics = None
+    if metrics_file is not None:
+        metrics = Metrics()
+        reactor.add_signal_handler(
+            signal.SIGUSR1, lambda: metrics.dump(metrics_file))
+    clients = set()
 
     def connection_closed(handler):
+        clients.discard(handler)
         reactor.remove_handler(handler)
+        handler.close()
 
-    def connection_made(new_socket, addr):
-        reactor.add_handler(ClientHandler(new_socket, addr, connection_closed))
-
-    connection_handler =  make_connection_handler(
-            connection_made,
-            'localhost',
-            12344)
+    options = dict(
+        codecs=codecs,
+        future_factory=functools.partial(Future, scheduler=reactor.call_soon),
+        executors=executors,
+        call_soon_threadsafe=reactor.call_soon_threadsafe,
+        metrics=metrics,
+        flow=flow,
+        call_later=reactor.call_later)
 
-    reactor.add_handler(connection_handler)
-    reactor.run()
+    def connection_made(new_socket, addr):
+        handler = ClientHandler(
+            new_socket,
+            addr,
+            connection_closed,
+            reactor.update_handler,
+            call_soon=reactor.call_soon,
+            **options)
+        clients.add(handler)
+        reactor.add_handler(handler)
+
+    def shm_connection_made(new_socket, addr):
+        channel = shm.offer_channel(new_socket)
+        if channel is None:
+            return
+        handler = ShmClientHandler(
+            channel,
+            'shm',
+            connection_closed,
+            reactor.update_handler,
+            reactor.call_soon,
+            **options)
+        clients.add(handler)
+        reactor.add_handler(handler)
+
+    handlers = []
+    if listen_socket is not None:
+        handlers.append(ConnectionHandler(listen_socket, connection_made))
+    elif port is not None:
+        handlers.append(make_connection_handler(
+                connection_made,
+                host,
+                port,
+                backlog,
+                reuse_port))
+    for endpoint, sock in listeners:
+        handlers.append(ConnectionHandler(
+            sock,
+            shm_connection_made if endpoint.scheme == 'shm'
+            else connection_made))
+    draining = []
+
+    def drain(deadline):
+        for handler in list(clients):
+            if handler.idle():
+                connection_closed(handler)
+        if not clients or time.monotonic() >= deadline:
+            reactor.stop()
+        else:
+            reactor.call_later(0.05, drain, deadline)
+
+    def shutdown():
+        if draining:
+            return
+        draining.append(True)
+        for handler in handlers:
+            reactor.remove_handler(handler)
+            handler.close()
+        drain(time.monotonic() + drain_timeout)
+
+    for handler in handlers:
+        reactor.add_handler(handler)
+    reactor.add_signal_handler(signal.SIGTERM, shutdown)
+    try:
+        reactor.run()
+    finally:
+        reactor.close()
+        executors.shutdown()
+        if metrics is not None:
+            metrics.dump(metrics_file)
+
+
+def main(host='localhost', port=12344, workers=1, backlog=128,
+         reuse_port=False, drain_timeout=10.0, max_threads=None,
+         max_processes=None, metrics_file=None, flow=None, urls=None,
+         codecs=cprotocol.DEFAULT_CODECS):
+    """Serve with one process, or several worker processes.
+
+    With more than one worker, the workers share one listening socket,
+    unless reuse_port is set, in which case each binds its own with
+    SO_REUSEPORT; see cappy.workers. Each worker writes its metrics to
+    metrics_file with its index appended. If urls are given we listen at
+    those instead of on host and port; see cappy.endpoints. The workers
+    share each of them.
+    """
+    listeners = []
+    listen_socket = None
+    try:
+        for url in urls or ():
+            endpoint = endpoints.parse(url)
+            listeners.append((endpoint, endpoints.listen(endpoint, backlog)))
+        if listeners:
+            port = None
+        if workers <= 1:
+            serve(host, port, backlog, reuse_port, None, drain_timeout,
+                  max_threads, max_processes, metrics_file, flow, listeners,
+                  codecs)
+            return
+        if port is not None and not reuse_port:
+            listen_socket = get_listen_socket(host, port, backlog)
+
+        def worker_main(index):
+            serve(host, port, backlog, reuse_port, listen_socket,
+                  drain_timeout, max_threads, max_processes,
+                  None if metrics_file is None else
+                  '{}.{}'.format(metrics_file, index), flow, listeners,
+                  codecs)
+
+        run_workers(workers, worker_main, drain_timeout=drain_timeout)
+    finally:
+        if listen_socket is not None:
+            listen_socket.close()
+        for endpoint, sock in listeners:
+            endpoints.close_listener(endpoint, sock)
 
 
 if __name__ == "__main__":
-    main()
-
+    register_codecs()  # So that --codec can offer them.
+    parser = argparse.ArgumentParser(description='Reactor server')
+    parser.add_argument('--host', default='localhost',
+                        help="Sets host address")
+    parser.add_argument('--port', '-p', type=int, default=12344,
+                        help="Sets connection port")
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help="Number of worker processes")
+    parser.add_argument('--backlog', type=int, default=128,
+                        help="Listen backlog")
+    parser.add_argument('--reuse-port', action='store_true',
+                        help="Give each worker its own socket bound with "
+                             "SO_REUSEPORT rather than sharing one")
+    parser.add_argument('--drain-timeout', type=float, default=10.0,
+                        help="Seconds to let connections finish on SIGTERM")
+    parser.add_argument('--threads', type=int,
+                        help="Thread pool size for methods run in threads")
+    parser.add_argument('--processes', type=int,
+                        help="Process pool size for methods run in "
+                             "processes, per worker")
+    parser.add_argument('--metrics-file',
+                        help="Collect metrics, and write them to this file "
+                             "as JSON on SIGUSR1 and on exit")
+    parser.add_argument('--max-in-flight', type=int, default=1024,
+                        help="Most requests to work on at once per "
+                             "connection; 0 for no limit")
+    parser.add_argument('--write-buffer', type=int, default=1 << 20,
+                        help="Stop reading from a connection while it has "
+                             "more than this many bytes waiting to be sent")
+    parser.add_argument('--listen', '-l', metavar='URL', action='append',
+                        help="Listen at URL instead of on host and port: "
+                             "tcp://host:port, unix://path or shm://path; "
+                             "may be repeated")
+    parser.add_argument('--codec',
+                        choices=sorted(stream.PARSERS) +
+                        sorted(stream.COMPRESSORS),
+                        action='append',
+                        help="Offer this codec; may be repeated, most "
+                             "preferred first")
+    args = parser.parse_args()
+    flow = cprotocol.FlowControl(args.write_buffer,
+                                 max_inbound_in_flight=args.max_in_flight)
+    try:
+        main(args.host, args.port, args.workers, args.backlog,
+             args.reuse_port, args.drain_timeout, args.threads,
+             args.processes, args.metrics_file, flow, args.listen,
+             tuple(args.codec or cprotocol.DEFAULT_CODECS))
+    except KeyboardInterrupt:
+        pass
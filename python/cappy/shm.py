@@ -0,0 +1,554 @@
+"""A transport through shared memory, for peers on the same host.
+
+Over TCP loopback every frame costs a send and a recv system call, each
+copying the data through the kernel. Here two peers share a pair of ring
+buffers in an mmap-ed memfd, one for each direction, so a write is one
+memcpy (two if it wraps around the end of the ring) into the ring, and a
+read one memcpy out of it, straight into the framing buffer (see
+HeaderByteStream.get_buffer). Frames bigger than the ring go through a
+ring's worth at a time.
+
+Each peer has a doorbell, the read end of a non-blocking pipe, which its
+event loop watches. The other peer writes a byte to it after writing a
+batch of data, and after reading from a ring which was full, since then
+its writer may be waiting for room. A batch is everything queued since the
+last time around the loop, so busy peers make one system call per batch
+rather than two per frame. When a peer closes, or dies, the pipe's write
+end goes with it and the doorbell reads EOF.
+
+The rings' counters are updated without locks, which is safe with one
+writer and one reader per ring as long as each peer sees the other's
+stores in order. Python has no memory barriers to make sure of that, so we
+rely on x86's ordering of stores, and refuse to make channels elsewhere.
+
+The peer can write anything to the shared memory, so we check its
+counters: a ring claiming more bytes than it holds raises RingError, and
+the transports close the channel.
+
+Peers meet on a unix socket: the server accepts a connection, makes a
+Channel pair, and passes one end's file descriptors to the client, after
+which the socket isn't needed.
+
+```
+server = await shm.start_server(ConnectionFactory(...), '/tmp/cappy.shm')
+...
+transport, connection = await shm.connect(ConnectionFactory(...),
+                                          '/tmp/cappy.shm')
+```
+Both servers listen for these peers given an shm:// URL; see cappy.endpoints.
+"""
+import asyncio
+import collections
+import mmap
+import os
+import platform
+import socket
+import struct
+import tempfile
+
+
+from cappy.workers import get_unix_listen_socket
+
+
+DEFAULT_CAPACITY = 1 << 20
+"""Bytes in each direction's ring."""
+
+HEADER = 128
+"""Bytes before each ring's data: the write counter, and on another cache
+line the read counter."""
+
+MAX_RECV = 256 * 1024
+"""Most bytes ShmTransport passes to data_received at once, as for asyncio's
+socket transports."""
+
+_OFFER = struct.Struct('!QB')  # capacity, side
+
+SUPPORTED = platform.machine().lower() in (
+    'x86_64', 'amd64', 'i386', 'i486', 'i586', 'i686', 'x86')
+"""Whether this machine orders stores the way Ring relies on."""
+
+
+class RingError(ConnectionError):
+    """A ring's counters are inconsistent, so the peer can't be trusted."""
+
+
+class Ring:
+    """A single-producer, single-consumer queue of bytes in shared memory.
+
+    The header holds counters of the bytes ever written and ever read; only
+    the writer stores to the first and only the reader to the second.
+
+    Attributes:
+        capacity (int): Size of the data area; a power of two.
+    """
+
+    def __init__(self, view, capacity):
+        self.capacity = capacity
+        self._mask = capacity - 1
+        self._counters = view[:HEADER].cast('Q')
+        self._data = view[HEADER:HEADER + capacity]
+
+    def used(self):
+        """Get the number of bytes written and not yet read.
+
+        Raises:
+            RingError: The counters say more than capacity, or less than
+                nothing.
+        """
+        counters = self._counters
+        n = counters[0] - counters[8]
+        if not 0 <= n <= self.capacity:
+            raise RingError("Ring counters are inconsistent")
+        return n
+
+    def write(self, data):
+        """Copy as much of data as fits; return the number of bytes copied."""
+        counters = self._counters
+        written = counters[0]
+        n = min(len(data), self.capacity - self.used())
+        if n <= 0:
+            return 0
+        start = written & self._mask
+        first = min(n, self.capacity - start)
+        with memoryview(data) as src:
+            self._data[start:start + first] = src[:first]
+            if n > first:
+                self._data[:n - first] = src[first:n]
+        counters[0] = written + n
+        return n
+
+    def read_into(self, view):
+        """Copy up to len(view) bytes into view; return how many."""
+        counters = self._counters
+        read = counters[8]
+        n = min(len(view), self.used())
+        if n <= 0:
+            return 0
+        start = read & self._mask
+        first = min(n, self.capacity - start)
+        view[:first] = self._data[start:start + first]
+        if n > first:
+            view[first:n] = self._data[:n - first]
+        counters[8] = read + n
+        return n
+
+    def release(self):
+        self._counters.release()
+        self._data.release()
+
+
+class Channel:
+    """One peer's end of a shared-memory connection.
+
+    Attributes:
+        capacity (int): Bytes in each ring.
+        side (int): 0 or 1; we write to ring side and read the other.
+        inbound (Ring): The ring the peer writes to.
+        outbound (Ring): The ring we write to.
+    """
+
+    def __init__(self, mem_fd, capacity, side, wake_fd, peer_fd):
+        if not SUPPORTED:
+            raise RuntimeError(
+                "Shared memory channels need x86, not {}".format(
+                    platform.machine()))
+        if capacity < 4096 or capacity & (capacity - 1):
+            raise ValueError("capacity must be a power of two, at least 4096")
+        self.capacity = capacity
+        self.side = side
+        self._mem_fd = mem_fd
+        self._wake_fd = wake_fd  # Our doorbell; the peer writes to it.
+        self._peer_fd = peer_fd  # The peer's doorbell.
+        os.set_blocking(wake_fd, False)
+        os.set_blocking(peer_fd, False)
+        stride = HEADER + capacity
+        self._mmap = mmap.mmap(mem_fd, 2 * stride)
+        with memoryview(self._mmap) as view:
+            rings = [Ring(view[i * stride:(i + 1) * stride], capacity)
+                     for i in (0, 1)]
+        self.outbound = rings[side]
+        self.inbound = rings[1 - side]
+        self.closed = False
+
+    def fileno(self):
+        """Get our doorbell, to watch for reading."""
+        return self._wake_fd
+
+    def send(self, chunks, offset=0):
+        """Copy as much of a sequence of bytes-like objects as fits.
+
+        Args:
+            chunks (iterable): Data to send, in order.
+            offset (int): Bytes at the start of the first chunk to skip.
+
+        Returns:
+            int: Number of bytes copied, as for socket.sendmsg.
+        """
+        ring = self.outbound
+        sent = 0
+        for chunk in chunks:
+            if offset:
+                with memoryview(chunk) as view:
+                    n = ring.write(view[offset:])
+                    wanted = len(view) - offset
+                offset = 0
+            else:
+                n = ring.write(chunk)
+                wanted = len(chunk)
+            sent += n
+            if n < wanted:
+                break
+        if sent:
+            self.wake_peer()
+        return sent
+
+    def available(self):
+        """Get the number of bytes waiting to be read, at most capacity."""
+        return self.inbound.used()
+
+    def recv_into(self, view):
+        """Copy waiting bytes into view; return how many."""
+        ring = self.inbound
+        was_full = ring.used() == ring.capacity
+        n = ring.read_into(view)
+        if was_full and n:
+            self.wake_peer()  # It may be waiting for room.
+        return n
+
+    def recv(self, n):
+        """Get up to n waiting bytes, as a bytearray."""
+        buf = bytearray(min(n, self.available()))
+        del buf[self.recv_into(buf):]
+        return buf
+
+    def wake_peer(self):
+        try:
+            os.write(self._peer_fd, b'\0')
+        except (BlockingIOError, InterruptedError, BrokenPipeError):
+            pass  # A wakeup is pending already, or the peer is gone.
+
+    def clear_wakeups(self):
+        """Empty our doorbell.
+
+        One read nearly always empties it, and if it doesn't the event loop
+        just calls us again, so we don't spend a system call checking.
+
+        Returns:
+            bool: False if the peer has gone.
+        """
+        try:
+            return bool(os.read(self._wake_fd, 4096))
+        except (BlockingIOError, InterruptedError):
+            return True
+
+    def fds(self):
+        """Get the file descriptors another process needs to use us."""
+        return [self._mem_fd, self._wake_fd, self._peer_fd]
+
+    def close(self):
+        """Let go of the shared memory and doorbells; the peer sees EOF."""
+        if self.closed:
+            return
+        self.closed = True
+        self.inbound.release()
+        self.outbound.release()
+        self._mmap.close()
+        for fd in self.fds():
+            os.close(fd)
+
+
+def _memory_fd(size):
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create('cappy-shm', os.MFD_CLOEXEC)
+    else:
+        fd, path = tempfile.mkstemp(prefix='cappy-shm-')
+        os.unlink(path)
+    try:
+        os.ftruncate(fd, size)
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+
+def channel_pair(capacity=DEFAULT_CAPACITY):
+    """Make the two ends of a connection."""
+    mem_fd = _memory_fd(2 * (HEADER + capacity))
+    a_read, b_write = os.pipe()  # a's doorbell
+    b_read, a_write = os.pipe()  # b's doorbell
+    try:
+        a = Channel(mem_fd, capacity, 0, a_read, a_write)
+        b = Channel(os.dup(mem_fd), capacity, 1, b_read, b_write)
+    except:
+        for fd in (mem_fd, a_read, a_write, b_read, b_write):
+            os.close(fd)
+        raise
+    return a, b
+
+
+def send_channel(sock, channel):
+    """Pass channel to the process at the other end of a unix socket."""
+    socket.send_fds(sock, [_OFFER.pack(channel.capacity, channel.side)],
+                    channel.fds())
+
+
+def receive_channel(sock):
+    """Get a Channel passed with send_channel, waiting for it if sock is
+    blocking."""
+    data, fds, _, _ = socket.recv_fds(sock, _OFFER.size, 3)
+    if len(data) != _OFFER.size or len(fds) != 3:
+        for fd in fds:
+            os.close(fd)
+        raise ConnectionError("Peer didn't offer a shared-memory channel")
+    capacity, side = _OFFER.unpack(data)
+    try:
+        return Channel(fds[0], capacity, side, fds[1], fds[2])
+    except:
+        for fd in fds:
+            os.close(fd)
+        raise
+
+
+def offer_channel(sock, capacity=DEFAULT_CAPACITY):
+    """Make a channel pair, and pass one end to the peer on sock, a newly
+    accepted unix socket, which we then close.
+
+    Returns:
+        Channel: Our end, or None if the peer went away.
+    """
+    ours, theirs = channel_pair(capacity)
+    try:
+        sock.setblocking(True)
+        send_channel(sock, theirs)
+    except OSError:
+        ours.close()
+        return None
+    finally:
+        theirs.close()
+        sock.close()
+    return ours
+
+
+class ShmTransport(asyncio.Transport):
+    """An asyncio transport over a Channel.
+
+    Writes are queued and copied into the ring once per time around the
+    loop. A BufferedProtocol gets inbound bytes copied straight into its
+    buffer; any other protocol gets them as bytes with data_received.
+    """
+
+    def __init__(self, loop, channel, protocol, extra=None):
+        super().__init__(extra)
+        self._loop = loop
+        self._channel = channel
+        self._protocol = protocol
+        self._buffered = isinstance(protocol, asyncio.BufferedProtocol)
+        self._chunks = collections.deque()
+        self._offset = 0  # Bytes of _chunks[0] already sent
+        self._size = 0  # Unsent bytes in _chunks
+        self._high = 64 * 1024
+        self._low = 16 * 1024
+        self._write_paused = False
+        self._reading = True
+        self._closing = False
+        self._closed = False
+        self._eof = False  # The peer has gone.
+        self._flush_handle = None
+        loop.add_reader(channel.fileno(), self._wake)
+        protocol.connection_made(self)
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return 'shm'
+        return super().get_extra_info(name, default)
+
+    def is_closing(self):
+        return self._closing
+
+    def is_reading(self):
+        return self._reading and not self._closing
+
+    def pause_reading(self):
+        self._reading = False
+
+    def resume_reading(self):
+        if not self._reading:
+            self._reading = True
+            self._loop.call_soon(self._receive)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is None:
+            high = 64 * 1024 if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        if not 0 <= low <= high:
+            raise ValueError("high must be >= low must be >= 0")
+        self._high = high
+        self._low = low
+
+    def get_write_buffer_limits(self):
+        return self._low, self._high
+
+    def get_write_buffer_size(self):
+        return self._size
+
+    def write(self, data):
+        if self._closing or not len(data):
+            return
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._flush_handle is None:
+            self._flush_handle = self._loop.call_soon(self._flush)
+        if self._size > self._high and not self._write_paused:
+            self._write_paused = True
+            self._protocol.pause_writing()
+
+    def writelines(self, list_of_data):
+        for data in list_of_data:
+            self.write(data)
+
+    def can_write_eof(self):
+        return False
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        if not self._chunks:
+            self._loop.call_soon(self._finish, None)
+
+    def abort(self):
+        self._finish(None)
+
+    def _flush(self):
+        self._flush_handle = None
+        if self._closed or not self._chunks:
+            return
+        chunks = self._chunks
+        try:
+            sent = self._channel.send(chunks, self._offset)
+        except RingError as e:
+            self._finish(e)
+            return
+        self._size -= sent
+        sent += self._offset
+        while chunks and sent >= len(chunks[0]):
+            sent -= len(chunks.popleft())
+        self._offset = sent
+        if self._write_paused and self._size <= self._low:
+            self._write_paused = False
+            self._protocol.resume_writing()
+        if self._closing and not chunks:
+            self._finish(None)
+        # Otherwise, if anything is left the ring is full, and the peer
+        # rings us when it has made room.
+
+    def _wake(self):
+        if not self._channel.clear_wakeups():
+            self._eof = True
+            self._loop.remove_reader(self._channel.fileno())
+        if self._chunks and not self._eof:
+            self._flush()
+        self._receive()
+
+    def _receive(self):
+        try:
+            self._receive_available()
+        except RingError as e:
+            self._finish(e)
+
+    def _receive_available(self):
+        channel = self._channel
+        protocol = self._protocol
+        while self._reading and not self._closed:
+            n = channel.available()
+            if not n:
+                break
+            if self._buffered:
+                protocol.buffer_updated(
+                    channel.recv_into(protocol.get_buffer(n)))
+            else:
+                protocol.data_received(channel.recv(min(n, MAX_RECV)))
+        if self._eof and not self._closed and not channel.available():
+            self._finish(None)
+
+    def _finish(self, exc):
+        if self._closed:
+            return
+        self._closed = self._closing = True
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._eof:
+            self._loop.remove_reader(self._channel.fileno())
+        self._channel.close()
+        self._chunks.clear()
+        self._size = 0
+        self._loop.call_soon(self._protocol.connection_lost, exc)
+
+
+class Server:
+    """Accepts peers on a listening unix socket, and gives each a Channel
+    and a transport for a protocol from protocol_factory.
+
+    Attributes:
+        sockets (list of socket): The listening socket.
+        transports (set of ShmTransport): Transports we made.
+    """
+
+    def __init__(self, loop, sock, protocol_factory,
+                 capacity=DEFAULT_CAPACITY):
+        self._loop = loop
+        self.sockets = [sock]
+        self._protocol_factory = protocol_factory
+        self.capacity = capacity
+        sock.setblocking(False)
+        loop.add_reader(sock.fileno(), self._accept)
+
+    def _accept(self):
+        try:
+            sock, _ = self.sockets[0].accept()
+        except (BlockingIOError, InterruptedError):
+            return  # Another worker got it.
+        channel = offer_channel(sock, self.capacity)
+        if channel is not None:
+            ShmTransport(self._loop, channel, self._protocol_factory())
+
+    def close(self):
+        """Stop accepting peers; connections carry on."""
+        if self.sockets:
+            sock = self.sockets.pop()
+            self._loop.remove_reader(sock.fileno())
+            sock.close()
+
+
+async def start_server(protocol_factory, path=None, sock=None,
+                       capacity=DEFAULT_CAPACITY):
+    """Accept peers on a unix socket at path, or on the listening unix
+    socket sock, e.g. one shared by several worker processes."""
+    if sock is None:
+        sock = get_unix_listen_socket(path)
+    return Server(asyncio.get_running_loop(), sock, protocol_factory,
+                  capacity)
+
+
+async def connect(protocol_factory, path):
+    """Connect to a peer serving on the unix socket at path.
+
+    Returns:
+        (ShmTransport, protocol)
+    """
+    loop = asyncio.get_running_loop()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.setblocking(False)
+        await loop.sock_connect(sock, path)
+        readable = loop.create_future()
+        loop.add_reader(
+            sock.fileno(), lambda: readable.done() or readable.set_result(None))
+        try:
+            await readable
+        finally:
+            loop.remove_reader(sock.fileno())
+        channel = receive_channel(sock)
+    protocol = protocol_factory()
+    return ShmTransport(loop, channel, protocol), protocol
@@ -0,0 +1,270 @@
+import asyncio
+import os
+import socket
+
+
+import pytest
+
+
+import cappy.client_server_asyncio as client_server_asyncio
+import cappy.memo as memo
+import cappy.reactor as reactor
+import cappy.server_futures as server_futures
+import cappy.shm as shm
+import cappy.stream as stream
+
+
+@pytest.fixture
+def pair():
+    a, b = shm.channel_pair(4096)
+    yield a, b
+    a.close()
+    b.close()
+
+
+def receive_all(channel, n):
+    buf = bytearray(n)
+    got = 0
+    while got < n:
+        nbytes = channel.recv_into(memoryview(buf)[got:])
+        assert nbytes, "Ran dry"
+        got += nbytes
+    return bytes(buf)
+
+
+def test_round_trip(pair):
+    a, b = pair
+    assert a.send([b'hello ', b'world']) == 11
+    assert b.clear_wakeups()
+    assert b.available() == 11
+    assert b.recv(100) == b'hello world'
+    assert not b.available()
+    assert b.send([b'back']) == 4
+    assert a.recv(2) == b'ba'
+    assert a.recv(2) == b'ck'
+
+
+def test_wraps_around(pair):
+    a, b = pair
+    for i in range(10):
+        data = bytes([i]) * 3000
+        assert a.send([data]) == 3000
+        assert receive_all(b, 3000) == data
+    assert a.outbound.used() == 0
+
+
+def test_full_ring_sends_what_fits(pair):
+    a, b = pair
+    chunks = [b'x' * 3000, b'y' * 3000]
+    assert a.send(chunks) == 4096
+    assert a.send(chunks) == 0
+    b.clear_wakeups()
+    assert b.recv(1000) == b'x' * 1000
+    assert a.clear_wakeups()  # b made room in a full ring, and rang.
+    assert a.send(chunks, 4096) == 1000
+    assert receive_all(b, 4096) == b'x' * 2000 + b'y' * 2096
+
+
+def test_wakes_only_from_full(pair):
+    a, b = pair
+    a.send([b'abc'])
+    a.clear_wakeups()
+    b.recv(3)
+    with pytest.raises(BlockingIOError):
+        os.read(a.fileno(), 1)
+
+
+def test_close_is_eof(pair):
+    a, b = pair
+    a.send([b'last'])
+    a.close()
+    assert b.clear_wakeups()  # The wakeup for the data, then EOF.
+    assert not b.clear_wakeups()
+    assert b.recv(10) == b'last'  # Data sent before closing survives.
+
+
+def test_passes_over_unix_socket():
+    left, right = socket.socketpair(socket.AF_UNIX)
+    ours = shm.offer_channel(left, 8192)
+    with right:
+        theirs = shm.receive_channel(right)
+    try:
+        assert (theirs.capacity, theirs.side) == (8192, 1)
+        ours.send([b'ping'])
+        assert theirs.recv(4) == b'ping'
+        theirs.send([b'pong'])
+        assert ours.recv(4) == b'pong'
+    finally:
+        ours.close()
+        theirs.close()
+
+
+def test_bad_capacity():
+    with pytest.raises(ValueError):
+        shm.channel_pair(5000)
+
+
+def test_inconsistent_counters(pair):
+    a, b = pair
+    a.outbound._counters[0] = 1 << 40  # Claims more than the ring holds.
+    with pytest.raises(shm.RingError):
+        b.available()
+    with pytest.raises(shm.RingError):
+        b.recv_into(bytearray(10))
+    b.inbound._counters[8] = 2 << 40  # And now less than nothing.
+    with pytest.raises(shm.RingError):
+        a.send([b'x'])
+
+
+def test_shm_client_handler_closes_on_inconsistent_counters():
+    r = reactor.Reactor()
+    ours, theirs = shm.channel_pair(4096)
+    closed = []
+
+    def connection_closed(handler):
+        closed.append(handler)
+        r.remove_handler(handler)
+        handler.close()
+
+    handler = server_futures.ShmClientHandler(
+        ours, 'shm', connection_closed, r.update_handler, r.call_soon)
+    r.add_handler(handler)
+    try:
+        theirs.outbound._counters[0] = 1 << 40
+        theirs.wake_peer()
+        r.run_once(timeout=0.1)
+        assert closed == [handler]
+    finally:
+        r.close()
+        theirs.close()
+
+
+def test_shm_client_handler_round_trip():
+    memo.clear_all()  # add is cacheable; make sure it runs.
+    r = reactor.Reactor()
+    ours, theirs = shm.channel_pair(1 << 16)
+    closed = []
+
+    def connection_closed(handler):
+        closed.append(handler)
+        r.remove_handler(handler)
+        handler.close()
+
+    handler = server_futures.ShmClientHandler(
+        ours, 'shm', connection_closed, r.update_handler, r.call_soon)
+    r.add_handler(handler)
+    s = stream.Stream(stream.VarintByteStream(), stream.JSONParser())
+
+    def receive_one():
+        for _ in range(10):
+            r.run_once(timeout=0.1)
+            messages = [m for m in s.receive(theirs.recv(1 << 16))
+                        if m['id'] != 0]
+            if messages:
+                return messages
+        raise AssertionError("No message received")
+
+    try:
+        theirs.send([s.pack_message(
+            {'method': 'add', 'args': [1, 2], 'id': 1})])
+        [request] = receive_one()
+        assert request['method'] == 'echo'
+        theirs.send([s.pack_message({'id': -request['id'], 'result': 3})])
+        [response] = receive_one()
+        assert response == {'id': -1, 'result': 3}
+        assert handler.idle()
+        theirs.close()
+        r.run_once(timeout=0.1)
+        assert closed == [handler]
+    finally:
+        r.close()
+
+
+def test_shm_client_handler_waits_for_room():
+    r = reactor.Reactor()
+    ours, theirs = shm.channel_pair(4096)
+    handler = server_futures.ShmClientHandler(
+        ours, 'shm', None, r.update_handler, r.call_soon)
+    r.add_handler(handler)
+    data = bytes(range(256)) * 100
+    handler.add_to_buf(data)
+    received = bytearray()
+    try:
+        for _ in range(100):
+            r.run_once(timeout=0.1)
+            received += theirs.recv(1 << 16)
+            if not handler.out_chunks:
+                break
+        received += theirs.recv(1 << 16)
+        assert received.endswith(data)
+        assert handler.out_bytes == 0
+    finally:
+        r.close()
+        theirs.close()
+
+
+def test_asyncio_round_trip(tmp_path):
+    path = str(tmp_path / 'cappy.shm')
+
+    async def run():
+        server_factory = client_server_asyncio.ConnectionFactory(
+            client_server_asyncio.Protocol, asyncio.get_running_loop)
+        server = await shm.start_server(server_factory, path)
+        client_factory = client_server_asyncio.ConnectionFactory(
+            client_server_asyncio.Protocol, asyncio.get_running_loop)
+        transport, connection = await shm.connect(client_factory, path)
+        try:
+            small = await connection.make_outbound_request(
+                {'method': 'echo', 'args': ['hi']})
+            # Bigger than the ring, so it goes through in pieces.
+            big = 'x' * (3 * shm.DEFAULT_CAPACITY)
+            echoed = await connection.make_outbound_request(
+                {'method': 'echo', 'args': [big]})
+            return small, echoed == big
+        finally:
+            server.close()
+            transport.close()
+            await server_factory.drain(1)
+
+    assert asyncio.run(run()) == ('hi', True)
+
+
+def test_asyncio_peer_closing_loses_connection():
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        ours, theirs = shm.channel_pair(4096)
+        lost = loop.create_future()
+
+        class Recorder(asyncio.Protocol):
+            def connection_lost(self, exc):
+                lost.set_result(exc)
+
+        transport = shm.ShmTransport(loop, ours, Recorder())
+        theirs.close()
+        exc = await asyncio.wait_for(lost, 1)
+        return exc, transport.is_closing()
+
+    assert asyncio.run(run()) == (None, True)
+
+
+def test_asyncio_transport_closes_on_inconsistent_counters():
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        ours, theirs = shm.channel_pair(4096)
+        lost = loop.create_future()
+
+        class Recorder(asyncio.Protocol):
+            def connection_lost(self, exc):
+                lost.set_result(exc)
+
+        shm.ShmTransport(loop, ours, Recorder())
+        theirs.outbound._counters[0] = 1 << 40
+        theirs.wake_peer()
+        try:
+            return await asyncio.wait_for(lost, 1)
+        finally:
+            theirs.close()
+
+    assert isinstance(asyncio.run(run()), shm.RingError)
@@ -1,24 +1,170 @@
 import json
+import math
+import struct
+
+
+import cappy.vector as vector
 
 
 class Stream:
+    """Turn bytes into messages and back.
+
+    Outgoing messages are flattened by the message parser we were given, which
+    can be swapped later with select_parser (e.g. after codec negotiation).
+    Incoming frames may use any parser in PARSERS; each frame's first byte
+    says which one.
+
+    A batch frame holds several messages, which its parser decodes in one
+    go: a JSON array of messages, or a binary list of them. Messages are
+    always maps, so a frame which decodes to a list is a batch. Only send
+    them (see pack_batch) to peers which said they understand them.
+
+    Once both ends agree on a scheme from COMPRESSORS (see
+    cappy.compression), frames may also be compressed: a COMPRESSED marker
+    followed by the compressed bytes of an ordinary frame. Compression runs
+    across the frames of a connection, so compressed frames must be read in
+    the order they were made.
+
+    Attributes:
+        bs: The binary stream, e.g. a HeaderByteStream, splitting bytes into
+            frames.
+        mp: The message parser used for outgoing messages.
+        compressor: Compresses outgoing frames, or None; see compress_with.
+        decompressor: Decompresses incoming frames, or None.
+    """
 
     def __init__(self, binary_stream, message_parser):
         self.bs = binary_stream
         self.mp = message_parser
+        self.parsers_by_marker = {}
+        for parser in [p() for p in PARSERS.values()] + [message_parser]:
+            self.parsers_by_marker[parser.marker] = parser
+            self.parsers_by_marker[parser.batch_marker] = parser
+        self.compressor = None
+        self.decompressor = None
+        self._offered_compressors = ()
+        self._awaiting_hello = False
+
+    def select_parser(self, name):
+        """Use the parser called name for outgoing messages."""
+        cls = PARSERS[name]
+        parser = self.parsers_by_marker.get(cls.marker)
+        self.mp = parser if type(parser) is cls else cls()
+
+    def add_parser(self, name):
+        """Read frames with the parser called name.
+
+        Parsers in PARSERS may share a marker (see cappy.interface), in
+        which case the last one added reads that marker's frames.
+        """
+        cls = PARSERS[name]
+        if type(self.parsers_by_marker.get(cls.marker)) is not cls:
+            parser = cls()
+            self.parsers_by_marker[cls.marker] = parser
+            self.parsers_by_marker[cls.batch_marker] = parser
+
+    def compress_with(self, name):
+        """Compress outgoing frames with the scheme called name."""
+        self.compressor = COMPRESSORS[name].compressor()
+
+    def decompress_with(self, name):
+        """Read compressed frames with the scheme called name."""
+        self.decompressor = COMPRESSORS[name].decompressor()
+
+    def offer_compression(self, names):
+        """Read compressed frames with whichever of names the peer picks.
+
+        The peer picks the first scheme in its hello which we offered too.
+        Its hello is the first frame it sends, but its first compressed
+        frames may come in the same read, and we parse a whole read before
+        anyone handles the messages in it. So we pick for the peer as soon
+        as we parse its hello.
+
+        Args:
+            names (sequence of str): Names of schemes in COMPRESSORS.
+        """
+        self._offered_compressors = tuple(names)
+        self._awaiting_hello = bool(names)
+
+    def _read_hello(self, message):
+        self._awaiting_hello = False
+        if type(message) is dict and message.get('type') == 'hello':
+            for name in message.get('codecs', ()):
+                if name in self._offered_compressors:
+                    self.decompress_with(name)
+                    break
+
+    def parse(self, frame):
+        """Parse one frame with the parser its first byte calls for."""
+        try:
+            parser = self.parsers_by_marker[frame[0]]
+        except IndexError:
+            raise ValueError("Empty frame")
+        except KeyError:
+            if frame[0] == COMPRESSED:
+                return self._parse_compressed(frame)
+            raise ValueError("Unknown frame marker 0x{:02x}".format(frame[0]))
+        return parser.parse(frame)
+
+    def _parse_compressed(self, frame):
+        if self.decompressor is None:
+            raise ValueError("Compressed frame, but no compression was agreed")
+        data = self.decompressor.decompress(frame[1:])
+        try:
+            parser = self.parsers_by_marker[data[0]]
+        except (IndexError, KeyError):
+            raise ValueError("Bad frame inside a compressed frame")
+        return parser.parse(data)
+
+    def _parse_all(self, frames):
+        if self._awaiting_hello:
+            frames = iter(frames)
+            for frame in frames:
+                message = self.parse(frame)
+                self._read_hello(message)
+                return [message] + self._parse_all(frames)
+            return []
+        messages = []
+        for frame in frames:
+            message = self.parse(frame)
+            if type(message) is list:  # A batch frame
+                messages.extend(message)
+            else:
+                messages.append(message)
+        return messages
 
     def receive(self, data):
         """Receive incoming bytes and produce message objects.
 
+        Frames are handed to the message parser as memoryviews into the
+        framing buffer; the only copy happens inside the parser.
+
         Args:
             data (bytes): Bytes off the wire.
 
         Returns:
             (list): message objects, e.g. dicts representing JSON messages.
         """
-        binary_frames = self.bs.receive(data)
-        messages = [self.mp.parse(bf) for bf in binary_frames]
-        return messages
+        return self._parse_all(self.bs.iter_frames(data))
+
+    def get_buffer(self, sizehint):
+        """Get writable space in the framing buffer; see HeaderByteStream."""
+        return self.bs.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        """Produce message objects after bytes were written via get_buffer.
+
+        Args:
+            nbytes (int): Number of bytes written into the buffer.
+
+        Returns:
+            (list): message objects, as for receive.
+        """
+        return self._parse_all(self.bs.buffer_updated(nbytes))
+
+    def flatten(self, message):
+        """Encode a message without framing it; see pack_batch."""
+        return self.mp.flatten(message)
 
     def pack_message(self, message):
         """Flatten a message to binary.
@@ -28,16 +174,297 @@ class Stream:
 
         TODO: Put this in the stream class.
         """
-        return self.bs.pack(self.mp.flatten(message))
+        return self.frame(self.flatten(message))
+
+    def frame(self, payload):
+        """Frame a message from flatten."""
+        return self._frame(payload)
+
+    def _frame(self, payload):
+        compressor = self.compressor
+        if compressor is not None and len(payload) >= compressor.threshold:
+            payload = compressor.compress(payload)
+        return self.bs.pack(payload)
+
+    def _frame_parts(self, payload):
+        compressor = self.compressor
+        if compressor is not None and len(payload) >= compressor.threshold:
+            payload = compressor.compress(payload)
+        if len(payload) < GATHER_MIN:
+            return (self.bs.pack(payload),)
+        return self.bs.header(len(payload)), payload
+
+    def pack_batch(self, payloads, combine=False, gather=False):
+        """Frame messages from flatten to be sent together.
+
+        Args:
+            payloads (list of bytes): Flattened messages, in order.
+            combine (bool): Put each run of messages flattened by the same
+                parser in one batch frame, rather than a frame apiece.
+            gather (bool): Leave payloads of GATHER_MIN bytes or more apart
+                from their headers, and out of batch frames, for a
+                scatter-gather write such as transport.writelines, rather
+                than copying them.
+
+        Returns:
+            (list of bytes): The frames, or with gather, the buffers to
+                write one after another.
+        """
+        frames = []
+        if gather:
+            frame_parts = self._frame_parts
+
+            def pack(payload):
+                frames.extend(frame_parts(payload))
+        else:
+            frame = self.bs.pack if self.compressor is None else self._frame
+            if not combine or len(payloads) == 1:
+                return [frame(payload) for payload in payloads]
+
+            def pack(payload):
+                frames.append(frame(payload))
+        if not combine or len(payloads) == 1:
+            for payload in payloads:
+                pack(payload)
+            return frames
+        start = 0
+        for i in range(1, len(payloads) + 1):
+            # When gathering, large payloads go in frames of their own rather
+            # than being copied into a batch.
+            if i == len(payloads) or payloads[i][0] != payloads[start][0] or \
+                    gather and max(len(payloads[i - 1]),
+                                   len(payloads[i])) >= GATHER_MIN:
+                if i - start == 1:
+                    pack(payloads[start])
+                else:
+                    parser = self.parsers_by_marker[payloads[start][0]]
+                    pack(parser.join(payloads[start:i]))
+                start = i
+        return frames
+
+
+SMALL_READ = 512
+"""Most bytes, read and unread, HeaderByteStream frames without buffering."""
 
 
 class HeaderByteStream:
+    """Split a byte stream into length-prefixed frames.
+
+    Incoming bytes are collected in a growable bytearray. We keep a read
+    offset (start) and a write offset (end) into the buffer rather than
+    re-slicing it, so consuming a frame is just moving the read offset.
+    The unread bytes are only moved back to the front of the buffer when we
+    run out of room at the end, and the buffer only grows when compaction
+    would not free enough space. Once a grown buffer has been fully drained
+    it is replaced by one of the initial size, unless it is within four times
+    the space readers ask get_buffer for.
 
-    def __init__(self, header_length):
-        self.buf = b''
+    Small reads, of at most SMALL_READ bytes counting what is still unread,
+    skip the buffer: we join them to the unread tail, which we keep as a
+    bytes object, find the frames in that, and keep the new tail. Copying a
+    few bytes is cheaper than the buffer's bookkeeping. The tail moves into
+    the buffer when a larger read or get_buffer comes along.
+
+    Attributes:
+        buf (bytearray): Backing storage. Bytes in [start, end) are unread.
+        start (int): Read offset into buf.
+        end (int): Write offset into buf.
+        header_length (int): Number of bytes in the big-endian length header.
+        initial_size (int): Starting size of buf, in bytes.
+    """
+
+    def __init__(self, header_length, initial_size=4096):
+        if initial_size < 1:
+            raise ValueError(
+                "initial_size must be at least 1, got {}".format(initial_size))
+        self.initial_size = initial_size
+        self.buf = bytearray(initial_size)
+        self.start = 0
+        self.end = 0
         self.reading_header = True
         self.payload_length = None
         self.header_length = header_length
+        self._write_view = None
+        self._read_size = 0  # Largest get_buffer sizehint
+        self._tail = b''  # Unread bytes after a small read; buf is empty.
+
+    def _reserve(self, n):
+        """Make sure there are at least n writable bytes after end."""
+        if len(self.buf) - self.end >= n:
+            return
+        unread = self.end - self.start
+        if self.start > 0:
+            self.buf[0:unread] = self.buf[self.start:self.end]
+            self.start = 0
+            self.end = unread
+            if len(self.buf) - self.end >= n:
+                return
+        size = len(self.buf)
+        while size - self.end < n:
+            size *= 2
+        self.buf.extend(bytes(size - len(self.buf)))
+
+    def _append(self, b):
+        n = len(b)
+        end = self.end
+        if len(self.buf) - end < n:
+            self._reserve(n)
+            end = self.end
+        self.buf[end:end + n] = b
+        self.end = end + n
+
+    def _consume_frames(self, b):
+        """Append incoming bytes and consume every complete frame.
+
+        Returns:
+            (bytearray, list): The buffer holding the frames, and a list of
+                (start, stop) offsets of each complete frame payload in it.
+        """
+        tail = self._tail
+        if self.start == self.end and len(tail) + len(b) <= SMALL_READ:
+            data = tail + b if tail else bytes(b)
+            stop, bounds = self._find_frames(data, 0, len(data))
+            self._tail = data[stop:]
+            return data, bounds
+        if tail:
+            self._tail = b''
+            self._append(tail)
+        if len(b):
+            self._append(b)
+        return self._scan()
+
+    def _scan(self):
+        """Consume every complete frame in [start, end).
+
+        Returns:
+            See _consume_frames.
+        """
+        buf = self.buf
+        end = self.end
+        start, bounds = self._find_frames(buf, self.start, end)
+        self.start = start
+
+        if start == end:
+            # Everything has been consumed, so we can rewind for free. If a
+            # large frame made the buffer grow, drop back to the initial size
+            # so that one big message doesn't pin memory for the lifetime of
+            # the connection. Any frames still to be handed out live in the
+            # old buffer, which we return to the caller.
+            self.start = self.end = 0
+            if len(buf) > 4 * max(self.initial_size, self._read_size):
+                self.buf = bytearray(self.initial_size)
+        return buf, bounds
+
+    def _find_frames(self, buf, start, end):
+        """Find the complete frames in buf[start:end].
+
+        Returns:
+            (int, list): The offset just past the last header or frame we
+                consumed, and the (start, stop) offsets of each frame.
+        """
+        header_length = self.header_length
+        reading_header = self.reading_header
+        payload_length = self.payload_length
+        bounds = []
+        while 1:
+            if reading_header:
+                if end - start < header_length:
+                    break
+                payload_length = int.from_bytes(
+                    buf[start:start + header_length], 'big')
+                start += header_length
+                reading_header = False
+            if end - start < payload_length:
+                break
+            bounds.append((start, start + payload_length))
+            start += payload_length
+            reading_header = True
+        self.reading_header = reading_header
+        self.payload_length = payload_length
+        return start, bounds
+
+    def iter_frames(self, b):
+        """Collect complete frames from incoming bytes, without copying.
+
+        The bytes are buffered and all complete frames are consumed when
+        this method is called, not when the returned iterator is advanced.
+        Frames which are not iterated over are discarded.
+
+        Each frame is a memoryview into our buffer. It is only valid until
+        the iterator is advanced; after that the view is released so the
+        buffer may be compacted or grown. Callers who need to keep a frame
+        must copy it, e.g. with bytes(frame).
+
+        Args:
+            b (bytes-like): Some bytes from the wire.
+
+        Returns:
+            iterator of memoryview, each of which is one complete frame.
+        """
+        buf, bounds = self._consume_frames(b)
+        if not bounds:
+            return iter(())
+        if type(buf) is bytes:
+            # Nothing else can change the bytes, so the views needn't be
+            # released.
+            view = memoryview(buf)
+            return iter([view[start:stop] for start, stop in bounds])
+        return self._iter_views(buf, bounds)
+
+    @staticmethod
+    def _iter_views(buf, bounds):
+        view = memoryview(buf)
+        try:
+            for start, stop in bounds:
+                frame = view[start:stop]
+                try:
+                    yield frame
+                finally:
+                    frame.release()
+        finally:
+            view.release()
+
+    def get_buffer(self, sizehint):
+        """Get writable space at the end of our buffer.
+
+        This lets a caller read from a socket (e.g. with recv_into) straight
+        into the framing buffer, without allocating a bytes object per read.
+        The caller must then call buffer_updated with the number of bytes it
+        wrote, and must not use the returned view after that.
+
+        Args:
+            sizehint (int): Minimum number of writable bytes wanted.
+
+        Returns:
+            memoryview: Writable view of at least sizehint bytes.
+        """
+        if self._write_view is not None:
+            self._write_view.release()
+        if sizehint > self._read_size:
+            self._read_size = sizehint
+        if self._tail:
+            self._append(self._tail)
+            self._tail = b''
+        self._reserve(max(sizehint, 1))
+        self._write_view = memoryview(self.buf)[self.end:]
+        return self._write_view
+
+    def buffer_updated(self, nbytes):
+        """Account for bytes written into the view from get_buffer.
+
+        Args:
+            nbytes (int): Number of bytes written at the start of the view.
+
+        Returns:
+            iterator of memoryview: Complete frames, as for iter_frames.
+        """
+        self._write_view.release()
+        self._write_view = None
+        self.end += nbytes
+        buf, bounds = self._scan()
+        if not bounds:
+            return iter(())
+        return self._iter_views(buf, bounds)
 
     def receive(self, b):
         """Collect complete binary frames from incoming byte stream.
@@ -48,39 +475,528 @@ class HeaderByteStream:
         Returns:
             list of byte arrays, each of which represents a complete frame.
         """
-        self.buf = self.buf + b
-        byte_frames = []
+        tail = self._tail
+        if self.start == self.end and len(tail) + len(b) <= SMALL_READ:
+            # As in _consume_frames, inline since small reads are frequent.
+            data = tail + b if tail else bytes(b)
+            stop, bounds = self._find_frames(data, 0, len(data))
+            self._tail = data[stop:]
+            if not bounds:
+                return []
+            return [data[start:stop] for start, stop in bounds]
+        buf, bounds = self._consume_frames(b)
+        if not bounds:
+            return []
+        with memoryview(buf) as view:
+            return [bytes(view[start:stop]) for start, stop in bounds]
 
+    def pack(self, b):
+        return self.header(len(b)) + b
+
+    def header(self, l):
+        """Make the header for a frame of l bytes."""
+        max_message_len = 2**(self.header_length * 8) - 1
+        if l > max_message_len:
+            raise ValueError(
+                "Message length {} exceeds maximum allowed length {}".format(
+                    l, max_message_len))
+        return l.to_bytes(self.header_length, byteorder='big')
+
+
+class VarintByteStream(HeaderByteStream):
+    """Split a byte stream into frames prefixed with a varint length.
+
+    The length is an unsigned LEB128 varint: seven bits per byte, least
+    significant group first, with the top bit set on every byte but the
+    last. Frames under 128 bytes cost one byte of header and frames under
+    16 KiB two, yet there is no fixed limit on frame size. We refuse frames
+    over max_frame_length, in both directions, so that a bad header can't
+    make us buffer without bound; send larger values as streams instead
+    (see cappy.streams).
+
+    Attributes:
+        max_frame_length (int): Largest frame we send or accept, in bytes.
+    """
+
+    def __init__(self, max_frame_length=1 << 26, initial_size=4096):
+        super().__init__(0, initial_size)
+        self.max_frame_length = max_frame_length
+
+    def _find_frames(self, buf, start, end):
+        reading_header = self.reading_header
+        payload_length = self.payload_length
+        bounds = []
         while 1:
-            if not self.reading_header and len(self.buf) >= self.payload_length:
-                byte_frames.append(self.buf[0:self.payload_length])
-                self.buf = self.buf[self.payload_length:]
-                self.reading_header = True
-
-            elif self.reading_header and len(self.buf) >= self.header_length:
-                self.payload_length = int.from_bytes(
-                    self.buf[0:self.header_length], 'big')
-                self.buf = self.buf[self.header_length:]
-                self.reading_header = False
-            else:
+            if reading_header:
+                if start == end:
+                    break
+                payload_length = buf[start]
+                if payload_length < 0x80:
+                    start += 1
+                else:
+                    if end - start >= 2 and buf[start + 1] < 0x80:
+                        # Two bytes, for frames under 16 KiB.
+                        payload_length = (payload_length & 0x7f) | \
+                            (buf[start + 1] << 7)
+                        start += 2
+                    else:
+                        payload_length, header_end = _read_varint(
+                            buf, start, end)
+                        if header_end is None:
+                            break  # Incomplete header.
+                        start = header_end
+                    if payload_length > self.max_frame_length:
+                        raise ValueError(
+                            "Frame length {} exceeds maximum {}".format(
+                                payload_length, self.max_frame_length))
+                reading_header = False
+            if end - start < payload_length:
                 break
-        return byte_frames
+            bounds.append((start, start + payload_length))
+            start += payload_length
+            reading_header = True
+        self.reading_header = reading_header
+        self.payload_length = payload_length
+        return start, bounds
 
     def pack(self, b):
         l = len(b)
-        max_message_len = 2**(self.header_length * 8) - 1
-        if l > max_message_len:
+        if l < 0x80:
+            return bytes((l,)) + b
+        if l > self.max_frame_length:
             raise ValueError(
                 "Message length {} exceeds maximum allowed length {}".format(
-                    l, max_message_len))
-        b = l.to_bytes(self.header_length, byteorder='big') + b
-        return b
+                    l, self.max_frame_length))
+        return encode_varint(l) + b
+
+    def header(self, l):
+        if l > self.max_frame_length:
+            raise ValueError(
+                "Message length {} exceeds maximum allowed length {}".format(
+                    l, self.max_frame_length))
+        return encode_varint(l)
+
+
+def encode_varint(n):
+    """Encode a non-negative int as an unsigned LEB128 varint."""
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _read_varint(buf, start, end):
+    """Decode a varint from buf[start:end].
+
+    Returns:
+        (int, int): The value, and the offset just past it, or (None, None)
+            if the varint continues past end.
+    """
+    value = 0
+    shift = 0
+    for i in range(start, min(end, start + 10)):
+        b = buf[i]
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return value, i + 1
+        shift += 7
+    if end - start >= 10:
+        raise ValueError("Varint longer than 10 bytes")
+    return None, None
 
 
 class JSONParser:
+    """Encode messages as UTF-8 JSON.
+
+    A flattened message is a JSON object, so its first byte is always '{'.
+    Stream uses that byte (our marker) to recognize JSON frames.
+    """
+
+    name = 'json'
+    marker = ord('{')
+    batch_marker = ord('[')
 
     def parse(self, data):
-        return json.loads(data.decode('utf-8'))
+        # str() accepts any bytes-like object, including the memoryview
+        # frames produced by HeaderByteStream.iter_frames.
+        return json.loads(str(data, 'utf-8'))
 
     def flatten(self, message):
-        return bytes(json.dumps(message), 'utf-8')
+        return bytes(_json_encoder.encode(message), 'utf-8')
+
+    def join(self, payloads):
+        """Make a batch frame of flattened messages: a JSON array."""
+        return b'[' + b','.join(payloads) + b']'
+
+
+# Typed arrays (see cappy.vector) go as lists.
+_json_encoder = json.JSONEncoder(default=vector.tolist)
+
+
+_NONE = 0x00
+_FALSE = 0x01
+_TRUE = 0x02
+_INT8 = 0x03
+_INT16 = 0x04
+_INT32 = 0x05
+_INT64 = 0x06
+_BIGINT = 0x07
+_FLOAT = 0x08
+_STR8 = 0x09
+_STR32 = 0x0a
+_BYTES8 = 0x0b
+_BYTES32 = 0x0c
+_LIST8 = 0x0d
+_LIST32 = 0x0e
+_MAP8 = 0x0f
+_MAP32 = 0x10
+_F64_ARRAY = 0x11
+_I32_ARRAY = 0x12
+_I64_ARRAY = 0x13
+_TYPED_ARRAY = 0x14
+
+_ARRAY_FORMATS = {
+    _F64_ARRAY: ('d', 8),
+    _I32_ARRAY: ('i', 4),
+    _I64_ARRAY: ('q', 8),
+}
+
+_TAG_U8 = struct.Struct('>BB')
+_TAG_I8 = struct.Struct('>Bb')
+_TAG_I16 = struct.Struct('>Bh')
+_TAG_I32 = struct.Struct('>Bi')
+_TAG_U32 = struct.Struct('>BI')
+_TAG_I64 = struct.Struct('>Bq')
+_TAG_F64 = struct.Struct('>Bd')
+_U8 = struct.Struct('>B')
+_I8 = struct.Struct('>b')
+_I16 = struct.Struct('>h')
+_I32 = struct.Struct('>i')
+_U32 = struct.Struct('>I')
+_I64 = struct.Struct('>q')
+_F64 = struct.Struct('>d')
+
+
+class BinaryParser:
+    """Encode messages in a compact, self-describing binary format.
+
+    Each value starts with a one byte tag saying what follows. Integers use
+    the smallest of 1, 2, 4 or 8 bytes which fits, floats are 8 byte IEEE
+    doubles, and strings, bytes, lists and maps carry their length (1 byte
+    if it fits, otherwise 4) followed by their contents. Everything is
+    big-endian. Tuples are encoded as lists, so like JSON they come back as
+    lists. Long lists of only floats, or only ints, are packed as flat
+    arrays, which is both smaller and much faster to encode and decode.
+    Typed arrays (see cappy.vector) go as their element type, shape and
+    raw memory, in their own byte order, so encoding them is one copy and
+    decoding them none with NumPy, or one without.
+
+    A flattened message starts with our marker byte, which can't be the
+    first byte of a JSON message, so Stream can tell the two apart.
+    """
+
+    name = 'binary'
+    marker = 0x01
+    batch_marker = marker
+
+    def parse(self, data):
+        # Slicing and decoding bytes is much cheaper than going through a
+        # memoryview, and frames are small, so copy once up front.
+        data = bytes(data)
+        if data[0] != self.marker:
+            raise ValueError("Not a binary frame")
+        value, offset = _decode(data, 1)
+        if offset != len(data):
+            raise ValueError(
+                "{} trailing bytes after message".format(len(data) - offset))
+        return value
+
+    def flatten(self, message):
+        out = bytearray(_U8.pack(self.marker))
+        _encode(message, out)
+        return bytes(out)
+
+    def join(self, payloads):
+        """Make a batch frame of flattened messages: a list of them."""
+        out = bytearray(_TAG_U8.pack(self.marker, _LIST32))
+        out += _U32.pack(len(payloads))
+        for payload in payloads:
+            out += memoryview(payload)[1:]  # Skip the marker.
+        return bytes(out)
+
+
+_str_cache = {}
+_STR_CACHE_MAX_LEN = 32
+_STR_CACHE_MAX_ENTRIES = 4096
+
+# Lists at least this long whose items are all floats, or all ints fitting
+# in 64 bits, are packed as a flat array instead of item by item.
+_MIN_ARRAY_LEN = 8
+_INT32_MIN, _INT32_MAX = -0x80000000, 0x7fffffff
+_INT64_MIN, _INT64_MAX = -0x8000000000000000, 0x7fffffffffffffff
+
+
+def _encode_int(value, out):
+    if -0x80 <= value < 0x80:
+        out += _TAG_I8.pack(_INT8, value)
+    elif -0x8000 <= value < 0x8000:
+        out += _TAG_I16.pack(_INT16, value)
+    elif _INT32_MIN <= value <= _INT32_MAX:
+        out += _TAG_I32.pack(_INT32, value)
+    elif _INT64_MIN <= value <= _INT64_MAX:
+        out += _TAG_I64.pack(_INT64, value)
+    else:
+        length = (value.bit_length() + 8) // 8
+        out += _TAG_U8.pack(_BIGINT, length)
+        out += value.to_bytes(length, 'big', signed=True)
+
+
+def _encode_str(value, out):
+    encoded = _str_cache.get(value)
+    if encoded is not None:
+        out += encoded
+        return
+    b = value.encode('utf-8')
+    n = len(b)
+    if n < 0x100:
+        encoded = _TAG_U8.pack(_STR8, n) + b
+        if n <= _STR_CACHE_MAX_LEN and \
+                len(_str_cache) < _STR_CACHE_MAX_ENTRIES:
+            _str_cache[value] = encoded
+        out += encoded
+    else:
+        out += _TAG_U32.pack(_STR32, n)
+        out += b
+
+
+def _encode_bytes(value, out):
+    n = len(value)
+    if n < 0x100:
+        out += _TAG_U8.pack(_BYTES8, n)
+    else:
+        out += _TAG_U32.pack(_BYTES32, n)
+    out += value
+
+
+def _encode_array(value, out):
+    """Pack a homogeneous numeric list as an array, if we can.
+
+    Returns:
+        bool: True if value was encoded.
+    """
+    t = type(value[0])
+    if t is float:
+        for item in value:
+            if type(item) is not float:
+                return False
+        out += _TAG_U32.pack(_F64_ARRAY, len(value))
+        out += struct.pack('>{}d'.format(len(value)), *value)
+        return True
+    if t is int:
+        for item in value:
+            if type(item) is not int:
+                return False
+        lo = min(value)
+        hi = max(value)
+        if _INT32_MIN <= lo and hi <= _INT32_MAX:
+            out += _TAG_U32.pack(_I32_ARRAY, len(value))
+            out += struct.pack('>{}i'.format(len(value)), *value)
+            return True
+        if _INT64_MIN <= lo and hi <= _INT64_MAX:
+            out += _TAG_U32.pack(_I64_ARRAY, len(value))
+            out += struct.pack('>{}q'.format(len(value)), *value)
+            return True
+    return False
+
+
+def _encode_typed_array(value, out):
+    """Pack an array.array or NumPy array, if we can; see cappy.vector.
+
+    Returns:
+        bool: True if value was encoded.
+    """
+    spec = vector.describe(value)
+    if spec is None:
+        return False
+    typestr, shape, data = spec
+    out += _TAG_U8.pack(_TYPED_ARRAY, len(typestr))
+    out += typestr.encode('ascii')
+    out += _U8.pack(len(shape))
+    out += struct.pack('>{}I'.format(len(shape)), *shape)
+    out += data
+    return True
+
+
+def _encode(value, out):
+    t = type(value)
+    if t is int:
+        if -0x80 <= value < 0x80:
+            out += _TAG_I8.pack(_INT8, value)
+        else:
+            _encode_int(value, out)
+    elif t is str:
+        _encode_str(value, out)
+    elif t is dict:
+        n = len(value)
+        if n < 0x100:
+            out += _TAG_U8.pack(_MAP8, n)
+        else:
+            out += _TAG_U32.pack(_MAP32, n)
+        for k, v in value.items():
+            _encode(k, out)
+            _encode(v, out)
+    elif t is list or t is tuple:
+        n = len(value)
+        if n >= _MIN_ARRAY_LEN and _encode_array(value, out):
+            return
+        if n < 0x100:
+            out += _TAG_U8.pack(_LIST8, n)
+        else:
+            out += _TAG_U32.pack(_LIST32, n)
+        for item in value:
+            _encode(item, out)
+    elif t is float:
+        out += _TAG_F64.pack(_FLOAT, value)
+    elif value is None:
+        out.append(_NONE)
+    elif t is bool:
+        out.append(_TRUE if value else _FALSE)
+    elif t is bytes or t is bytearray or t is memoryview:
+        _encode_bytes(value, out)
+    elif _encode_typed_array(value, out):
+        return
+    else:
+        # Subclasses of the types we know, e.g. IntEnum.
+        for base in (bool, int, float, str, bytes, list, tuple, dict):
+            if isinstance(value, base):
+                _encode(base(value), out)
+                return
+        raise TypeError("Cannot encode object of type {}".format(t))
+
+
+def _read_length(tag, tag8, data, offset):
+    if tag == tag8:
+        return data[offset], offset + 1
+    return _U32.unpack_from(data, offset)[0], offset + 4
+
+
+def _decode(data, offset):
+    """Decode one value from data starting at offset.
+
+    Returns:
+        (value, int): The value, and the offset just past it.
+    """
+    tag = data[offset]
+    offset += 1
+    if tag == _INT8:
+        return _I8.unpack_from(data, offset)[0], offset + 1
+    if tag == _STR8:
+        n = data[offset]
+        offset += 1
+        end = offset + n
+        if end > len(data):
+            raise ValueError("Truncated string")
+        return data[offset:end].decode('utf-8'), end
+    if tag == _MAP8 or tag == _MAP32:
+        n, offset = _read_length(tag, _MAP8, data, offset)
+        result = {}
+        for _ in range(n):
+            if data[offset] == _STR8:
+                # Inline the common case of a short string key.
+                end = offset + 2 + data[offset + 1]
+                key = data[offset + 2:end].decode('utf-8')
+                offset = end
+            else:
+                key, offset = _decode(data, offset)
+            result[key], offset = _decode(data, offset)
+        return result, offset
+    if tag == _LIST8 or tag == _LIST32:
+        n, offset = _read_length(tag, _LIST8, data, offset)
+        result = []
+        append = result.append
+        for _ in range(n):
+            if data[offset] == _INT8:
+                append(_I8.unpack_from(data, offset + 1)[0])
+                offset += 2
+            else:
+                value, offset = _decode(data, offset)
+                append(value)
+        return result, offset
+    if tag == _INT16:
+        return _I16.unpack_from(data, offset)[0], offset + 2
+    if tag == _INT32:
+        return _I32.unpack_from(data, offset)[0], offset + 4
+    if tag == _INT64:
+        return _I64.unpack_from(data, offset)[0], offset + 8
+    if tag == _FLOAT:
+        return _F64.unpack_from(data, offset)[0], offset + 8
+    if tag in _ARRAY_FORMATS:
+        n = _U32.unpack_from(data, offset)[0]
+        offset += 4
+        fmt, size = _ARRAY_FORMATS[tag]
+        values = list(struct.unpack_from('>{}{}'.format(n, fmt), data, offset))
+        return values, offset + n * size
+    if tag == _TYPED_ARRAY:
+        return _decode_typed_array(data, offset)
+    if tag == _NONE:
+        return None, offset
+    if tag == _TRUE:
+        return True, offset
+    if tag == _FALSE:
+        return False, offset
+    if tag == _STR32:
+        n = _U32.unpack_from(data, offset)[0]
+        offset += 4
+        end = offset + n
+        if end > len(data):
+            raise ValueError("Truncated string")
+        return data[offset:end].decode('utf-8'), end
+    if tag == _BYTES8 or tag == _BYTES32:
+        n, offset = _read_length(tag, _BYTES8, data, offset)
+        end = offset + n
+        if end > len(data):
+            raise ValueError("Truncated bytes value")
+        return data[offset:end], end
+    if tag == _BIGINT:
+        n = data[offset]
+        offset += 1
+        return int.from_bytes(data[offset:offset + n], 'big', signed=True), \
+            offset + n
+    raise ValueError("Unknown tag 0x{:02x}".format(tag))
+
+
+def _decode_typed_array(data, offset):
+    n = data[offset]
+    typestr = data[offset + 1:offset + 1 + n].decode('ascii')
+    offset += 1 + n
+    ndim = data[offset]
+    shape = struct.unpack_from('>{}I'.format(ndim), data, offset + 1)
+    offset += 1 + 4 * ndim
+    end = offset
+    if typestr[2:].isdigit():
+        end += int(typestr[2:]) * math.prod(shape)
+    if end > len(data):
+        raise ValueError("Truncated array")
+    return vector.from_buffer(typestr, shape, data, offset), end
+
+
+PARSERS = {p.name: p for p in (JSONParser, BinaryParser)}
+"""Message parser classes by name, for codec negotiation."""
+
+PARSE_ERRORS = (ValueError, struct.error, IndexError)
+"""Exceptions a Stream raises on receiving bytes which aren't valid frames
+of valid messages. The stream can't carry on after one, so the connection
+should be closed."""
+
+COMPRESSED = 0x04
+"""Marker of compressed frames."""
+
+COMPRESSORS = {}
+"""Compression schemes by name, for negotiation alongside codecs; see
+cappy.compression."""
+
+GATHER_MIN = 1024
+"""Smallest payload pack_batch leaves apart from its header when gathering.
+Copying smaller ones is cheaper than another buffer in the write."""
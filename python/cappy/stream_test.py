@@ -25,6 +25,121 @@ class TestHeaderByteStream:
         result = s.receive(data[7:])
         assert result == [b'12']
 
+    def test_one_byte_at_a_time(self):
+        s = stream.HeaderByteStream(2, initial_size=4)
+        data = b'\x00\x03ABC\x00\x00\x00\x0512345'
+        result = []
+        for i in range(len(data)):
+            result.extend(s.receive(data[i:i+1]))
+        assert result == [b'ABC', b'', b'12345']
+
+    def test_buffer_grows_for_large_frame(self):
+        s = stream.HeaderByteStream(2, initial_size=4)
+        payload = bytes(range(256)) * 10
+        data = s.pack(payload)
+        assert s.receive(data[:100]) == []
+        assert s.receive(data[100:]) == [payload]
+        assert s.start == s.end == 0
+
+    def test_initial_size_must_be_positive(self):
+        with pytest.raises(ValueError):
+            stream.HeaderByteStream(2, initial_size=0)
+
+    def test_buffer_shrinks_after_large_frame(self):
+        s = stream.HeaderByteStream(2, initial_size=16)
+        payload = bytes(1000)
+        assert s.receive(s.pack(payload)) == [payload]
+        assert len(s.buf) == 16
+
+    def test_buffer_keeps_read_size(self):
+        s = stream.HeaderByteStream(2, initial_size=16)
+        for _ in range(2):
+            data = s.pack(bytes(100)) * 2
+            buf = s.get_buffer(256)
+            buf[:len(data)] = data
+            assert len(list(s.buffer_updated(len(data)))) == 2
+            assert len(s.buf) == 256
+
+    def test_small_read_tail_moves_to_buffer(self):
+        s = stream.HeaderByteStream(2, initial_size=16)
+        assert s.receive(b'\x00\x02AB\x00\x05CD') == [b'AB']
+        assert s.end == 0  # The tail isn't in the buffer yet.
+        buf = s.get_buffer(100)
+        buf[:3] = b'EFG'
+        assert list(map(bytes, s.buffer_updated(3))) == [b'CDEFG']
+        large = bytes(stream.SMALL_READ)
+        assert s.receive(s.pack(b'H') + s.pack(large)) == [b'H', large]
+
+    def test_iter_frames_buffers_eagerly(self):
+        s = stream.HeaderByteStream(2)
+        s.iter_frames(b'\x00\x02A')  # Never iterated.
+        assert s.receive(b'B\x00\x01C') == [b'AB', b'C']
+        assert list(map(bytes, s.iter_frames(b'\x00\x01D'))) == [b'D']
+
+    def test_get_buffer(self):
+        s = stream.HeaderByteStream(2, initial_size=4)
+        data = b'\x00\x03ABC\x00\x0212'
+        buf = s.get_buffer(5)
+        assert len(buf) >= 5
+        buf[0:5] = data[0:5]
+        assert list(map(bytes, s.buffer_updated(5))) == [b'ABC']
+        buf = s.get_buffer(100)
+        buf[0:4] = data[5:]
+        assert list(map(bytes, s.buffer_updated(4))) == [b'12']
+
+    def test_iter_frames_yields_views(self):
+        s = stream.HeaderByteStream(2)
+        frames = []
+        for frame in s.iter_frames(b'\x00\x02AB\x00\x02CD'):
+            assert isinstance(frame, memoryview)
+            frames.append(bytes(frame))
+        assert frames == [b'AB', b'CD']
+
+
+class TestVarintByteStream:
+
+    @pytest.mark.parametrize('n, encoded', [
+        (0, b'\x00'), (127, b'\x7f'), (128, b'\x80\x01'),
+        (300, b'\xac\x02'), (16384, b'\x80\x80\x01'),
+    ])
+    def test_encode_varint(self, n, encoded):
+        assert stream.encode_varint(n) == encoded
+
+    def test_small_frames_have_one_byte_header(self):
+        s = stream.VarintByteStream()
+        assert s.pack(b'ABC') == b'\x03ABC'
+        assert s.receive(b'\x03ABC\x00\x0212') == [b'ABC', b'', b'12']
+
+    def test_frames_over_64k(self):
+        s = stream.VarintByteStream(initial_size=16)
+        payloads = [bytes(70000), b'x' * 200, b'y']
+        data = b''.join(s.pack(p) for p in payloads)
+        assert data[:3] == stream.encode_varint(70000)
+        result = []
+        for i in range(0, len(data), 7):  # Headers split across reads.
+            result.extend(s.receive(data[i:i + 7]))
+        assert result == payloads
+
+    def test_one_byte_at_a_time(self):
+        s = stream.VarintByteStream(initial_size=4)
+        payloads = [b'a' * 130, b'', b'b' * 5]
+        data = b''.join(s.pack(p) for p in payloads)
+        result = []
+        for i in range(len(data)):
+            result.extend(s.receive(data[i:i + 1]))
+        assert result == payloads
+
+    def test_max_frame_length(self):
+        s = stream.VarintByteStream(max_frame_length=1000)
+        with pytest.raises(ValueError):
+            s.pack(bytes(1001))
+        with pytest.raises(ValueError):
+            s.receive(stream.encode_varint(1001))
+
+    def test_overlong_varint(self):
+        with pytest.raises(ValueError):
+            stream.VarintByteStream().receive(b'\xff' * 10)
+
 
 class TestJSONDataStrem:
 
@@ -47,3 +162,96 @@ class TestJSONDataStrem:
         assert result == []
         result = s.receive(data[10:])
         assert result == [{'id': 1, 'name': "Daniel"}, {'color': "green"}]
+
+
+class TestBinaryParser:
+
+    @pytest.mark.parametrize('value', [
+        None, True, False, 0, 1, -1, 127, -128, 128, 40000, -40000,
+        2**31, -2**31 - 1, 2**63 - 1, -2**63, 2**100, -2**100,
+        1.5, -0.0, float('inf'), '', 'hello', 'ünïcödé', 'x' * 300,
+        b'', b'\x00\xff', b'y' * 300, [], [1, [2, [3]]], list(range(300)),
+        {}, {'id': 1, 'method': 'add', 'args': [1, 2.5]},
+        {i: str(i) for i in range(300)},
+        [0.5] * 10, list(range(-10, 10)), [2**40] * 10, [2**70] * 10,
+        [1] * 9 + [1.0], [True] * 10,
+    ])
+    def test_round_trip(self, value):
+        p = stream.BinaryParser()
+        assert p.parse(p.flatten(value)) == value
+
+    def test_tuples_become_lists(self):
+        p = stream.BinaryParser()
+        assert p.parse(p.flatten({'args': (1, 2)})) == {'args': [1, 2]}
+
+    def test_smaller_than_json(self):
+        message = {'id': 12, 'method': 'add', 'args': [1, 2]}
+        binary = stream.BinaryParser().flatten(message)
+        assert len(binary) < len(stream.JSONParser().flatten(message))
+
+    def test_rejects_unknown_type(self):
+        with pytest.raises(TypeError):
+            stream.BinaryParser().flatten({'x': object()})
+
+    def test_rejects_trailing_bytes(self):
+        p = stream.BinaryParser()
+        with pytest.raises(ValueError):
+            p.parse(p.flatten(1) + b'\x00')
+
+
+class TestStreamCodecs:
+
+    def test_receive_mixed_codecs(self):
+        s = stream.Stream(stream.HeaderByteStream(2), stream.JSONParser())
+        data = s.pack_message({'id': 1})
+        s.select_parser('binary')
+        data += s.pack_message({'id': 2})
+        assert data[2:3] == b'{'
+        assert s.receive(data) == [{'id': 1}, {'id': 2}]
+
+    def test_unknown_marker(self):
+        s = stream.Stream(stream.HeaderByteStream(2), stream.JSONParser())
+        with pytest.raises(ValueError):
+            s.receive(b'\x00\x01\xee')
+
+
+class TestBatchFrames:
+
+    messages = [{'id': i, 'result': 'x' * i} for i in range(1, 5)]
+
+    @pytest.mark.parametrize('codec', ['json', 'binary'])
+    def test_round_trip(self, codec):
+        s = stream.Stream(stream.VarintByteStream(), stream.PARSERS[codec]())
+        payloads = [s.flatten(m) for m in self.messages]
+        [frame] = s.pack_batch(payloads, combine=True)
+        assert s.receive(frame) == self.messages
+
+    def test_uncombined(self):
+        s = stream.Stream(stream.VarintByteStream(), stream.JSONParser())
+        frames = s.pack_batch([s.flatten(m) for m in self.messages])
+        assert frames == [s.pack_message(m) for m in self.messages]
+
+    def test_runs_by_codec(self):
+        s = stream.Stream(stream.VarintByteStream(), stream.JSONParser())
+        payloads = [s.flatten(m) for m in self.messages[:2]]
+        s.select_parser('binary')
+        payloads += [s.flatten(m) for m in self.messages[2:]]
+        frames = s.pack_batch(payloads, combine=True)
+        assert [f[1:2] for f in frames] == [b'[', b'\x01']
+        assert s.receive(b''.join(frames)) == self.messages
+
+    def test_single_message_isnt_batched(self):
+        s = stream.Stream(stream.VarintByteStream(), stream.JSONParser())
+        payload = s.flatten(self.messages[0])
+        assert s.pack_batch([payload], combine=True) == [s.frame(payload)]
+
+    @pytest.mark.parametrize('combine', [False, True])
+    def test_gather(self, combine):
+        s = stream.Stream(stream.VarintByteStream(), stream.BinaryParser())
+        large = s.flatten({'id': -1, 'result': b'x' * stream.GATHER_MIN})
+        payloads = [s.flatten(self.messages[0]), large,
+                    s.flatten(self.messages[1])]
+        buffers = s.pack_batch(payloads, combine, gather=True)
+        assert large in buffers
+        assert s.receive(b''.join(buffers)) == \
+            s.receive(b''.join(s.pack_batch(payloads, combine)))
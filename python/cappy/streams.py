@@ -0,0 +1,131 @@
+"""Values sent a chunk at a time, with per-stream flow control.
+
+An iterator (e.g. a generator) passed as an argument or returned as a
+result isn't sent whole. The message carries a stream id instead, and the
+items follow as chunk control messages, one item per frame, so neither end
+ever holds more than a window of them:
+
+```
+{'id': 0, 'type': 'chunk', 'stream': stream_id, 'data': item}
+{'id': 0, 'type': 'end', 'stream': stream_id}  # Or with 'error'.
+{'id': 0, 'type': 'credit', 'stream': stream_id, 'n': count}
+{'id': 0, 'type': 'stop', 'stream': stream_id}
+```
+
+The sender may send WINDOW chunks before it hears anything back. The
+receiver grants more credit as its consumer takes items, in batches of half
+a window, so it buffers at most WINDOW items; a consumer which stops
+reading soon stops the sender. Stream ids are chosen by the sender, so
+chunk and end refer to the receiver's IncomingStreams and credit and stop
+to the sender's OutgoingStreams.
+
+Items must be values the negotiated codec can encode; with the binary
+codec, bytes chunks of tens of KiB are a good size.
+"""
+import collections
+import collections.abc
+
+
+WINDOW = 16
+"""Chunks a sender may have in flight before the receiver grants more."""
+
+
+def is_stream(value):
+    """Whether value is sent as a stream: any iterator, sync or async."""
+    return isinstance(value, (collections.abc.Iterator,
+                              collections.abc.AsyncIterator))
+
+
+class OutgoingStream:
+    """The sending end of a stream.
+
+    Attributes:
+        iterator: Where the items come from; an iterator, or an async
+            iterator which only the asyncio backend can send.
+        credit (int): Chunks we may send before we hear from the receiver.
+        task: Whatever the backend uses to pump an async iterator, e.g. an
+            asyncio.Task, or None.
+        wakeup: A future the task waits on for more credit, or None.
+    """
+
+    __slots__ = ('iterator', 'credit', 'task', 'wakeup')
+
+    def __init__(self, iterator, credit=WINDOW):
+        self.iterator = iterator
+        self.credit = credit
+        self.task = None
+        self.wakeup = None
+
+    def close(self):
+        close = getattr(self.iterator, 'close', None)
+        if close is not None:
+            close()
+
+
+class IncomingStream:
+    """The receiving end of a stream; the value the peer sent.
+
+    Call read for a future of the next item. At the end of the stream it
+    fails with EOFError, or with demo_protocol.RemoteError if the sender's
+    iterator raised. Only one read may be outstanding at a time. Call close
+    to tell the sender to stop early.
+    """
+
+    def __init__(self, protocol, stream_id):
+        self._protocol = protocol
+        self.stream_id = stream_id
+        self._items = collections.deque()
+        self._waiter = None
+        self._end = None  # Exception reads fail with, once ended
+        self._taken = 0  # Items taken since we last granted credit
+
+    def read(self):
+        f = self._protocol.future_factory()
+        if self._items:
+            f.set_result(self._items.popleft())
+            self._took_one()
+        elif self._end is not None:
+            f.set_exception(self._end_error())
+        elif self._waiter is not None and not self._waiter.done():
+            raise RuntimeError("A read is already pending")
+        else:
+            self._waiter = f
+        return f
+
+    def close(self):
+        """Stop receiving; the sender closes its iterator."""
+        if self._end is None:
+            self._protocol.stop_stream(self.stream_id)
+            self.finish(EOFError("Stream closed"))
+        self._items.clear()
+
+    def feed(self, item):
+        """Called by the protocol with each chunk."""
+        waiter = self._waiter
+        self._waiter = None
+        if waiter is not None and not waiter.done():  # Not cancelled
+            waiter.set_result(item)
+            self._took_one()
+        else:
+            self._items.append(item)
+
+    def finish(self, exception):
+        """Called by the protocol at the end of the stream."""
+        self._end = exception
+        waiter = self._waiter
+        self._waiter = None
+        if waiter is not None and not waiter.done():
+            waiter.set_exception(self._end_error())
+
+    def _end_error(self):
+        # A fresh EOFError each time, so reads don't share a traceback.
+        if type(self._end) is EOFError:
+            return EOFError(*self._end.args)
+        return self._end
+
+    def _took_one(self):
+        self._taken += 1
+        if self._taken >= WINDOW // 2 and self._end is None:
+            self._protocol.send_control(
+                'credit', stream=self.stream_id, n=self._taken)
+            self._taken = 0
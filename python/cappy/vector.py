@@ -0,0 +1,166 @@
+"""Vectorized calls and typed numeric arrays.
+
+A map call applies a method to columns of arguments in one request:
+
+```
+f = protocol.make_outbound_request(
+    {'method': 'add', 'args': [xs, ys], 'map': True})
+```
+
+and gets back the column of results, one per row, as if add(xs[i], ys[i])
+had been called for each i. The columns must be the same length. So a
+million additions cost one request, one response and one dispatch rather
+than a million of each.
+
+An implementation opts in by giving the method a vectorized form, which
+gets the columns themselves and returns the column of results, e.g. with
+one NumPy operation:
+
+```
+class Calculator:
+
+    def add(self, x, y):
+        return x + y
+
+    @vector.vectorized('add')
+    def add_many(self, xs, ys):
+        return numpy.add(xs, ys)
+```
+
+The vectorized form is a method like any other (see cappy.dispatch), so it
+may be offloaded or cached. A map call to a method without one calls the
+method once per row, if it returns its result directly; otherwise the call
+fails with a LookupError.
+
+Numeric columns are best sent as typed arrays: array.array, or a NumPy
+array, or anything else with __array_interface__ and the buffer protocol.
+The binary codec sends these as a header giving their element type and
+shape followed by their raw memory, rather than element by element; see
+stream.BinaryParser. They decode as read-only NumPy arrays over the
+received frame if NumPy is installed, and as array.array otherwise, which
+only holds one dimension. The JSON codec sends them as lists.
+"""
+import array
+import math
+import sys
+
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+ARRAY_TYPES = (array.array,) if numpy is None else (array.array,
+                                                     numpy.ndarray)
+"""Types sent as typed arrays."""
+
+_ORDER = '<' if sys.byteorder == 'little' else '>'
+
+_KINDS = {}  # array.array typecode -> element kind, as in NumPy's typestr
+for _typecode in 'bhilq':
+    _KINDS[_typecode] = 'i'
+    _KINDS[_typecode.upper()] = 'u'
+_KINDS['f'] = _KINDS['d'] = 'f'
+
+# (kind, itemsize) -> an array.array typecode for elements of that type.
+_TYPECODES = {}
+for _typecode, _kind in _KINDS.items():
+    _TYPECODES.setdefault((_kind, array.array(_typecode).itemsize),
+                          _typecode)
+
+_SIZES = {'i': (1, 2, 4, 8), 'u': (1, 2, 4, 8), 'f': (4, 8)}
+
+
+def vectorized(name):
+    """Decorator marking a method as the vectorized form of method name."""
+
+    def decorate(function):
+        function._cappy_vectorizes = name
+        return function
+    return decorate
+
+
+def vectorizes(function):
+    """Get the name of the method function is the vectorized form of, or
+    None."""
+    return getattr(function, '_cappy_vectorizes', None)
+
+
+def rowwise(function):
+    """Make a vectorized form of function which calls it once per row.
+
+    Args:
+        function: Called as function(obj, *row); see dispatch.MethodEntry.
+    """
+
+    def call(obj, *columns):
+        if len(set(map(len, columns))) > 1:
+            raise ValueError("Columns differ in length: {}".format(
+                [len(column) for column in columns]))
+        return [function(obj, *row) for row in zip(*columns)]
+    return call
+
+
+def describe(value):
+    """Get how to send value as a typed array.
+
+    Returns:
+        (str, tuple of int, buffer): The element type as a NumPy typestr
+            (e.g. '<f8'), the shape, and a C-contiguous buffer of the
+            elements; or None if value isn't a numeric array we can send.
+    """
+    if type(value) is array.array:
+        kind = _KINDS.get(value.typecode)
+        if kind is None:
+            return None
+        order = '|' if value.itemsize == 1 else _ORDER
+        return ('{}{}{}'.format(order, kind, value.itemsize), (len(value),),
+                value)
+    interface = getattr(value, '__array_interface__', None)
+    if interface is None:
+        return None
+    typestr = interface['typestr']
+    shape = tuple(interface['shape'])
+    if not _valid(typestr) or not shape:
+        return None
+    data = memoryview(value)
+    if not data.c_contiguous:
+        data = data.tobytes()
+    return typestr, shape, data
+
+
+def _valid(typestr):
+    return len(typestr) == 3 and typestr[0] in '<>|' and \
+        typestr[2].isdigit() and int(typestr[2]) in _SIZES.get(typestr[1], ())
+
+
+def from_buffer(typestr, shape, data, offset):
+    """Make an array of the elements at data[offset:]; see describe.
+
+    Raises:
+        ValueError: If typestr isn't a type describe makes, or NumPy isn't
+            installed and the array has more than one dimension.
+    """
+    if not _valid(typestr):
+        raise ValueError("Unknown array type {!r}".format(typestr))
+    count = math.prod(shape)
+    if numpy is not None:
+        return numpy.frombuffer(data, typestr, count, offset).reshape(shape)
+    if len(shape) != 1:
+        raise ValueError("Need NumPy to decode an array of shape {}".format(
+            shape))
+    result = array.array(_TYPECODES[typestr[1], int(typestr[2])])
+    with memoryview(data) as view:
+        result.frombytes(view[offset:offset + count * result.itemsize])
+    if typestr[0] not in ('|', _ORDER):
+        result.byteswap()
+    return result
+
+
+def tolist(value):
+    """Turn typed arrays into lists, for the JSON codec."""
+    if isinstance(value, ARRAY_TYPES):
+        return value.tolist()
+    raise TypeError("Object of type {} is not JSON serializable".format(
+        type(value).__name__))
@@ -0,0 +1,170 @@
+import array
+import sys
+
+
+import pytest
+
+
+from cappy.future import Future
+import cappy.calculator as calculator
+import cappy.demo_protocol as demo_protocol
+import cappy.dispatch as dispatch
+import cappy.server_futures as server_futures
+import cappy.stream as stream
+import cappy.vector as vector
+
+
+@pytest.mark.parametrize('value', [
+    array.array('d', [1.5, -2.5, 1e300]),
+    array.array('f', [0.5]),
+    array.array('q', [1, -(1 << 62)]),
+    array.array('i', range(-5, 5)),
+    array.array('B', b'\x00\xff'),
+    array.array('h', []),
+])
+def test_binary_round_trip(value):
+    parser = stream.BinaryParser()
+    message = {'id': 1, 'method': 'add', 'args': [value, value]}
+    decoded = parser.parse(parser.flatten(message))
+    assert [list(column) for column in decoded['args']] == \
+        [value.tolist()] * 2
+    if vector.numpy is None:
+        assert type(decoded['args'][0]) is array.array
+
+
+def test_json_sends_lists():
+    message = {'id': -1, 'result': array.array('i', [1, 2, 3])}
+    data = stream.JSONParser().flatten(message)
+    assert stream.JSONParser().parse(data) == {'id': -1, 'result': [1, 2, 3]}
+
+
+def test_describe():
+    value = array.array('d', [1.0, 2.0])
+    typestr, shape, data = vector.describe(value)
+    assert typestr[1:] == 'f8' and shape == (2,)
+    assert bytes(data) == value.tobytes()
+    assert vector.describe(array.array('u', 'ab')) is None
+    assert vector.describe([1.0, 2.0]) is None
+
+
+def test_from_buffer_swaps_bytes():
+    other = '>' if sys.byteorder == 'little' else '<'
+    data = b'\x00\x00\x00\x01\x00\x00\x01\x00'
+    assert list(vector.from_buffer(other + 'i4', (2,), data, 0)) == [1, 256]
+
+
+@pytest.mark.parametrize('typestr', ['<c16', '<f2', '|b1', '<i3', 'i8'])
+def test_from_buffer_rejects(typestr):
+    with pytest.raises(ValueError):
+        vector.from_buffer(typestr, (1,), bytes(16), 0)
+
+
+def test_truncated_array():
+    parser = stream.BinaryParser()
+    data = parser.flatten({'id': -1, 'result': array.array('d', [1.0])})
+    with pytest.raises(ValueError):
+        parser.parse(data[:-1])
+
+
+def test_numpy_round_trip():
+    numpy = pytest.importorskip('numpy')
+    parser = stream.BinaryParser()
+    value = numpy.arange(12, dtype='>i4').reshape(3, 4)
+    decoded = parser.parse(parser.flatten({'id': -1, 'result': value.T}))
+    assert (decoded['result'] == value.T).all()
+    assert decoded['result'].shape == (4, 3)
+
+
+class Vectors:
+
+    def __init__(self, outbound_requester):
+        pass
+
+    def scale(self, x, factor):
+        return x * factor
+
+    async def later(self, x):
+        return x
+
+    def total(self, xs):
+        return sum(xs)
+
+    @vector.vectorized('total')
+    def totals(self, columns):
+        return [sum(column) for column in columns]
+
+
+def test_dispatch_table():
+    table = dispatch.table_for(Vectors)
+    assert table.lookup_vector('total') is table.by_name['totals']
+    assert table.lookup_vector('scale').function(
+        None, [1, 2], [10, 100]) == [10, 200]
+    with pytest.raises(LookupError):
+        table.lookup_vector('later')
+
+
+def test_vectorizes_unknown_method():
+
+    class Broken(Vectors):
+
+        @vector.vectorized('missing')
+        def many(self, xs):
+            return xs
+
+    with pytest.raises(TypeError):
+        dispatch.DispatchTable(Broken)
+
+
+@pytest.fixture
+def pair():
+    queues = ([], [])
+    a = server_futures.Protocol(
+        queues[0].append, Future, calculator.CalculatorFutures, ('binary',))
+    b = server_futures.Protocol(
+        queues[1].append, Future, calculator.CalculatorFutures, ('binary',))
+
+    def pump():
+        while any(queues):
+            for queue, protocol in zip(queues, (b, a)):
+                data = b''.join(queue)
+                queue.clear()
+                protocol.dispatch(protocol.data_received(data))
+
+    pump()
+    return a, pump
+
+
+def call(pair, message):
+    a, pump = pair
+    f = a.make_outbound_request(message)
+    pump()
+    assert f.done()
+    return f
+
+
+def result(f):
+    results = []
+    f.add_callback(results.append)
+    return results[0]
+
+
+def test_map_call(pair):
+    xs = array.array('q', range(1000))
+    ys = array.array('q', range(0, 2000, 2))
+    f = call(pair, {'method': 'add', 'args': [xs, ys], 'map': True})
+    assert list(result(f)) == list(range(0, 3000, 3))
+
+
+def test_map_call_by_row(pair):
+    f = call(pair, {'method': 'echo', 'args': [['a', 'b']], 'map': True})
+    assert result(f) == ['a', 'b']
+
+
+@pytest.mark.parametrize('message', [
+    {'method': 'add', 'args': [[1, 2], [3]], 'map': True},
+    {'method': 'echo', 'args': [['a', 'b'], ['c']], 'map': True},
+    {'method': 'count_bytes', 'args': [[]], 'map': True},
+])
+def test_map_call_fails(pair, message):
+    assert isinstance(call(pair, message).failed_with(),
+                      demo_protocol.RemoteError)
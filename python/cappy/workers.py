@@ -0,0 +1,164 @@
+"""Run a server as several worker processes.
+
+A Python process only uses one core, so to use more we fork worker
+processes which each run their own event loop. The workers either share a
+listening socket created before the fork, in which case the kernel hands
+each new connection to whichever worker accepts first, or each bind their
+own socket with SO_REUSEPORT, in which case the kernel spreads connections
+across the sockets by hashing the connection's addresses.
+
+The parent process just supervises: it starts the workers, starts a new one
+whenever one dies, and on SIGTERM or SIGINT passes SIGTERM on to the
+workers so they can drain their connections, killing any that are still
+running after the drain timeout.
+"""
+import math
+import os
+import signal
+import socket
+import stat
+import sys
+import time
+import traceback
+
+
+def get_listen_socket(host, port, backlog=128, reuse_port=False):
+    """Get a socket that listens for incoming connections.
+
+    The address family is that of the first address host resolves to, so
+    host may be an IPv4 or IPv6 address or a name.
+
+    Args:
+        host (str): Hostname, i.e. 'localhost'.
+        port (int): Port on which to listen for incoming connections.
+        backlog (int): Maximum number of connections waiting to be accepted.
+        reuse_port (bool): Set SO_REUSEPORT, so that other processes can
+            listen on the same port, each with its own socket.
+
+    Returns (socket): A socket listening for connections on the given host and
+        port.
+    """
+    family, _, _, _, address = socket.getaddrinfo(
+        host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+    listen_socket = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            listen_socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listen_socket.bind(address)
+        listen_socket.listen(backlog)
+    except:
+        listen_socket.close()
+        raise
+    return listen_socket
+
+
+def get_unix_listen_socket(path, backlog=128):
+    """Get a unix domain socket listening at path.
+
+    A socket file left at path by an earlier server is replaced; any other
+    file there is an error.
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+    listen_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listen_socket.bind(path)
+        listen_socket.listen(backlog)
+    except:
+        listen_socket.close()
+        raise
+    return listen_socket
+
+
+def run_workers(num_workers, worker_main, respawn=True, drain_timeout=10.0,
+                respawn_delay=1.0):
+    """Run worker_main in num_workers child processes until told to stop.
+
+    Workers ignore SIGINT, so that Ctrl-C at a terminal reaches only the
+    parent, and should stop gracefully when they receive SIGTERM.
+
+    Args:
+        num_workers (int): Number of workers to run.
+        worker_main (function): Called in each worker with the worker's
+            index, from 0 to num_workers - 1. The worker exits with status
+            0 when it returns, or 1 if it raises.
+        respawn (bool): Start a new worker in place of one which exits,
+            unless we are stopping.
+        drain_timeout (float): Seconds to let the workers drain after we
+            pass on SIGTERM before we kill them.
+        respawn_delay (float): Wait this long before replacing a worker
+            which exited within respawn_delay seconds of starting, so a
+            worker which fails on startup doesn't make us spin.
+
+    Returns:
+        dict: Worker index -> exit status of its last process, as from
+            os.waitstatus_to_exitcode.
+    """
+    workers = {}  # pid -> (index, start time)
+    statuses = {}
+    stopping = []
+
+    def start(index):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGALRM, signal.SIG_DFL)
+                worker_main(index)
+                status = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        workers[pid] = (index, time.monotonic())
+
+    def kill(sig):
+        for pid in list(workers):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def stop(signum, frame):
+        if not stopping:
+            stopping.append(signum)
+            kill(signal.SIGTERM)
+            signal.alarm(max(1, math.ceil(drain_timeout)))
+
+    def timed_out(signum, frame):
+        kill(signal.SIGKILL)
+
+    old_handlers = {
+        signum: signal.signal(signum, handler)
+        for signum, handler in ((signal.SIGTERM, stop), (signal.SIGINT, stop),
+                                (signal.SIGALRM, timed_out))}
+    try:
+        for index in range(num_workers):
+            start(index)
+        while workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index, started = workers.pop(pid)
+            statuses[index] = os.waitstatus_to_exitcode(status)
+            if respawn and not stopping:
+                if time.monotonic() - started < respawn_delay:
+                    time.sleep(respawn_delay)
+                if not stopping:
+                    start(index)
+    finally:
+        signal.alarm(0)
+        kill(signal.SIGKILL)
+        for signum, handler in old_handlers.items():
+            signal.signal(signum, handler)
+    return statuses
@@ -0,0 +1,103 @@
+import ast
+import os
+import signal
+import socket
+import subprocess
+import sys
+import textwrap
+
+
+import pytest
+
+
+import cappy.workers as workers
+
+
+def test_run_workers_without_respawn():
+    read_fd, write_fd = os.pipe()
+    try:
+        def worker_main(index):
+            os.write(write_fd, bytes([index]))
+            if index == 1:
+                raise RuntimeError("worker failed")
+
+        statuses = workers.run_workers(3, worker_main, respawn=False)
+        os.close(write_fd)
+        write_fd = None
+        with os.fdopen(read_fd, 'rb') as r:
+            read_fd = None
+            assert sorted(r.read()) == [0, 1, 2]
+        assert statuses == {0: 0, 1: 1, 2: 0}
+    finally:
+        for fd in (read_fd, write_fd):
+            if fd is not None:
+                os.close(fd)
+
+
+# Runs run_workers in a subprocess so that signals don't reach pytest.
+SUPERVISOR = textwrap.dedent("""
+    import os, sys, time
+    import cappy.workers as workers
+
+    def worker_main(index):
+        os.write(1, b"%d\\n" % os.getpid())
+        while True:
+            time.sleep(1)
+
+    print(workers.run_workers(2, worker_main, respawn_delay=0,
+                              drain_timeout=1))
+""")
+
+
+def read_pid(proc):
+    return int(proc.stdout.readline())
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs fork")
+def test_workers_are_respawned_and_stopped():
+    env = dict(os.environ,
+               PYTHONPATH=os.path.dirname(os.path.dirname(__file__)))
+    proc = subprocess.Popen([sys.executable, '-c', SUPERVISOR], env=env,
+                            stdout=subprocess.PIPE, text=True)
+    try:
+        pids = {read_pid(proc), read_pid(proc)}
+        os.kill(pids.pop(), signal.SIGKILL)
+        replacement = read_pid(proc)
+        assert replacement not in pids
+        proc.send_signal(signal.SIGTERM)
+        out, _ = proc.communicate(timeout=10)
+        # Workers die of the SIGTERM we pass on.
+        assert ast.literal_eval(out.strip()) == {
+            0: -signal.SIGTERM, 1: -signal.SIGTERM}
+        assert proc.returncode == 0
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+
+def test_get_listen_socket_reuse_port():
+    a = workers.get_listen_socket('127.0.0.1', 0, reuse_port=True)
+    try:
+        port = a.getsockname()[1]
+        b = workers.get_listen_socket('127.0.0.1', port, reuse_port=True)
+        b.close()
+    finally:
+        a.close()
+
+
+def _has_ipv6_loopback():
+    try:
+        with socket.socket(socket.AF_INET6) as s:
+            s.bind(('::1', 0))
+    except OSError:
+        return False
+    return True
+
+
+@pytest.mark.skipif(not _has_ipv6_loopback(), reason="No IPv6 loopback")
+def test_get_listen_socket_ipv6():
+    with workers.get_listen_socket('::1', 0) as a:
+        assert a.family == socket.AF_INET6
+        with socket.create_connection(a.getsockname()[:2]):
+            pass